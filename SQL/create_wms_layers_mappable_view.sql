@@ -1,10 +1,5 @@
 create view discovery.wms_layers_mappable as
 select
-s.*,
-st_makeenvelope(s.min_x, s.min_y, s.max_x, s.max_y, 4326) AS geom
-from
-(
- select
  id as gid,
  csw_url,
  csw_record_identifier,
@@ -27,9 +22,9 @@ from
  made_get_map_req,
  image_status,
  out_image_fname,
- (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 1))::double precision as min_x,
- (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 2))::double precision as min_y,
- (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 3))::double precision as max_x,
- (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 4))::double precision as max_y
- from discovery.wms_layers
-) s;
\ No newline at end of file
+ min_x,
+ min_y,
+ max_x,
+ max_y,
+ geom
+from discovery.wms_layers;
@@ -1,13 +1,13 @@
 CREATE TABLE discovery.wms_layers (
     id serial,
-	csw_url text,
-	csw_record_identifier text,
+	csw_url text NOT NULL,
+	csw_record_identifier text NOT NULL,
 	csw_record_publisher text,
 	csw_record_title text,
 	csw_record_subjects text,
 	csw_record_abstract text,
 	csw_record_modified text,
-	wms_url text,
+	wms_url text NOT NULL,
 	wms_url_domain text,
 	wms_layer_for_record_title text,
 	wms_layer_for_record_name text,
@@ -20,5 +20,18 @@ CREATE TABLE discovery.wms_layers (
 	wms_get_map_error bool,
 	made_get_map_req bool,
 	image_status text,
-	out_image_fname text
+	out_image_fname text,
+	min_x double precision,
+	min_y double precision,
+	max_x double precision,
+	max_y double precision,
+	proj_min_x double precision,
+	proj_min_y double precision,
+	proj_max_x double precision,
+	proj_max_y double precision,
+	proj_crs text,
+	geom geometry(Polygon, 4326) GENERATED ALWAYS AS (st_makeenvelope(min_x, min_y, max_x, max_y, 4326)) STORED,
+	CONSTRAINT wms_layers_key UNIQUE (csw_url, csw_record_identifier, wms_url)
 );
+
+CREATE INDEX wms_layers_geom_idx ON discovery.wms_layers USING gist (geom);
@@ -0,0 +1,100 @@
+-- brings a discovery.wms_layers table created before the typed bbox columns up to create_wms_layers_table.sql so it
+-- can be loaded by pg_loader.py (PostgreSQL 12+ for the generated geometry column)
+BEGIN;
+
+ALTER TABLE discovery.wms_layers
+    ADD COLUMN min_x double precision,
+    ADD COLUMN min_y double precision,
+    ADD COLUMN max_x double precision,
+    ADD COLUMN max_y double precision,
+    ADD COLUMN proj_min_x double precision,
+    ADD COLUMN proj_min_y double precision,
+    ADD COLUMN proj_max_x double precision,
+    ADD COLUMN proj_max_y double precision,
+    ADD COLUMN proj_crs text;
+
+-- bbox_wgs84 is i.e. (-8.0, 49.0, 2.0, 61.0), bbox_projected i.e. (0.0, 0.0, 700000.0, 1300000.0, 'EPSG:27700')
+UPDATE discovery.wms_layers SET
+    min_x = (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 1))::double precision,
+    min_y = (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 2))::double precision,
+    max_x = (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 3))::double precision,
+    max_y = (split_part(substring(bbox_wgs84, 2, length(bbox_wgs84)-2), ',', 4))::double precision
+WHERE bbox_wgs84 LIKE '(%)';
+
+UPDATE discovery.wms_layers SET
+    proj_min_x = (split_part(substring(bbox_projected, 2, length(bbox_projected)-2), ',', 1))::double precision,
+    proj_min_y = (split_part(substring(bbox_projected, 2, length(bbox_projected)-2), ',', 2))::double precision,
+    proj_max_x = (split_part(substring(bbox_projected, 2, length(bbox_projected)-2), ',', 3))::double precision,
+    proj_max_y = (split_part(substring(bbox_projected, 2, length(bbox_projected)-2), ',', 4))::double precision,
+    proj_crs = nullif(btrim(split_part(substring(bbox_projected, 2, length(bbox_projected)-2), ',', 5), ' '''), 'None')
+WHERE bbox_projected LIKE '(%)';
+
+-- rows imported by hand from a newer wms_layers.csv, bbox_wgs84 i.e. -8.0 49.0 2.0 61.0, bbox_projected i.e.
+-- 0.0 0.0 700000.0 1300000.0 EPSG:27700
+UPDATE discovery.wms_layers SET
+    min_x = split_part(bbox_wgs84, ' ', 1)::double precision,
+    min_y = split_part(bbox_wgs84, ' ', 2)::double precision,
+    max_x = split_part(bbox_wgs84, ' ', 3)::double precision,
+    max_y = split_part(bbox_wgs84, ' ', 4)::double precision
+WHERE bbox_wgs84 NOT LIKE '(%)';
+
+UPDATE discovery.wms_layers SET
+    proj_min_x = split_part(bbox_projected, ' ', 1)::double precision,
+    proj_min_y = split_part(bbox_projected, ' ', 2)::double precision,
+    proj_max_x = split_part(bbox_projected, ' ', 3)::double precision,
+    proj_max_y = split_part(bbox_projected, ' ', 4)::double precision,
+    proj_crs = nullif(nullif(split_part(bbox_projected, ' ', 5), ''), 'None')
+WHERE bbox_projected NOT LIKE '(%)';
+
+ALTER TABLE discovery.wms_layers
+    ADD COLUMN geom geometry(Polygon, 4326) GENERATED ALWAYS AS (st_makeenvelope(min_x, min_y, max_x, max_y, 4326)) STORED;
+
+-- the upsert key, rows imported by hand more than once are reduced to the latest
+UPDATE discovery.wms_layers SET csw_record_identifier = '' WHERE csw_record_identifier IS NULL;
+DELETE FROM discovery.wms_layers a
+USING discovery.wms_layers b
+WHERE a.csw_url = b.csw_url AND a.csw_record_identifier = b.csw_record_identifier AND a.wms_url = b.wms_url AND a.id < b.id;
+
+ALTER TABLE discovery.wms_layers
+    ALTER COLUMN csw_url SET NOT NULL,
+    ALTER COLUMN csw_record_identifier SET NOT NULL,
+    ALTER COLUMN wms_url SET NOT NULL,
+    ADD CONSTRAINT wms_layers_key UNIQUE (csw_url, csw_record_identifier, wms_url);
+
+CREATE INDEX wms_layers_geom_idx ON discovery.wms_layers USING gist (geom);
+
+-- the view now reads the typed columns rather than re-parsing bbox_wgs84 on every query (its geom column changes
+-- type so it is dropped rather than replaced)
+DROP VIEW IF EXISTS discovery.wms_layers_mappable;
+CREATE VIEW discovery.wms_layers_mappable AS
+SELECT
+ id AS gid,
+ csw_url,
+ csw_record_identifier,
+ csw_record_publisher,
+ csw_record_title,
+ csw_record_subjects,
+ csw_record_abstract,
+ csw_record_modified,
+ wms_url,
+ wms_url_domain,
+ wms_layer_for_record_title,
+ wms_layer_for_record_name,
+ wms_access_constraints,
+ only_1_choice,
+ match_dist,
+ bbox_wgs84,
+ bbox_projected,
+ wms_get_cap_error,
+ wms_get_map_error,
+ made_get_map_req,
+ image_status,
+ out_image_fname,
+ min_x,
+ min_y,
+ max_x,
+ max_y,
+ geom
+FROM discovery.wms_layers;
+
+COMMIT;
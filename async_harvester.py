@@ -0,0 +1,509 @@
+import asyncio
+import functools
+import logging
+import time
+from urllib.parse import urlencode
+import aiohttp
+from owslib.crs import Crs
+from owslib.map.common import WMSCapabilitiesReader
+from owslib.util import bind_url, clean_ows_url, ServiceException
+
+from capabilities_cache import normalise_endpoint_url
+from cataloger import csw_record_fields, csw_record_harvest_fields, get_ogc_type, search_wms_for_layer_matching_csw_record_title
+from csw_client import HarvestCatalogueServiceWeb
+from csw_paging import PageCursor, PageSizeController
+from getmap_crs import MODE_NATIVE, MODE_WGS84, WGS84
+from harvest_record import HarvestRecord
+from layer_index import layer_index
+from map_images import MapImageStore
+from record_filter import and_constraints
+from wms_capabilities import web_map_service
+
+
+def getmap_request_url(wms, layers, srs, bbox, size, format):
+    """
+    the WMS 1.3.0 GetMap request url OWSLib WebMapService.getmap() would request (with its default styles,
+    transparent, bgcolor and exceptions), bbox is given in x/y order and swapped where the crs has y/x axis order
+
+    :param wms: OWSLib WebMapService object
+    :param layers: list of layer names
+    :param srs: crs i.e. EPSG:4326
+    :param bbox: (minx, miny, maxx, maxy)
+    :param size: (width, height)
+    :param format: image format i.e. image/png
+    :return: GetMap url
+    """
+    try:
+        base_url = next((m.get('url') for m in wms.getOperationByName('GetMap').methods if m.get('type').lower() == 'get'))
+    except StopIteration:
+        base_url = wms.url
+
+    if Crs(srs).axisorder == 'yx':
+        bbox = (bbox[1], bbox[0], bbox[3], bbox[2])
+
+    request = {
+        'service': 'WMS',
+        'version': '1.3.0',
+        'request': 'GetMap',
+        'layers': ','.join(layers),
+        'styles': '',
+        'width': str(size[0]),
+        'height': str(size[1]),
+        'crs': str(srs),
+        'bbox': ','.join([repr(x) for x in bbox]),
+        'format': str(format),
+        'transparent': 'FALSE',
+        'bgcolor': '0xFFFFFF',
+        'exceptions': 'XML'
+    }
+
+    return bind_url(base_url) + urlencode(request)
+
+
+def parse_wms_capabilities(wms_url, xml, timeout):
+    """
+    :return: OWSLib WebMapService object for the GetCapabilities doc xml, with its layer index built
+    """
+    wms = web_map_service(wms_url, xml=xml, version='1.3.0', timeout=timeout)
+    layer_index(wms)
+    return wms
+
+
+class AsyncHarvester:
+    """
+    asyncio alternative to the thread pool harvest in cataloger.py. Walks the same search_csw_for_ogc_endpoints ->
+    retrieve_and_loop_through_csw_recordset -> test_wms_layer steps and writes the same wms_layers.csv rows, but every
+    CSW GetRecords, WMS GetCapabilities and GetMap request is a coroutine on one event loop so thousands can be in
+    flight without a thread (and its stack) each.
+
+    Concurrency is capped by the aiohttp connection pool: max_in_flight connections in total and max_per_host to any
+    one host. XML parsing, which is CPU bound, and the image checks are run on the loop`s default executor so they do
+    not hold up the requests.
+
+    OWSLib is still used to build the GetRecords requests and to parse the responses (see
+    HarvestCatalogueServiceWeb.prepare_getrecords()) so records are read exactly as in the threaded mode.
+    """
+    def __init__(self, out_path, out_writer, caps_store=None, limit_count=0, ogc_srv_type='WMS:GetCapabilties', test_wms_get_map=True, image_store=None, journal=None, state=None, record_filters=None, probe_element_set=True, max_in_flight=1000, max_per_host=4, timeout=30, extent_planner=None, getmap_crs=None):
+        """
+        :param out_path: where to write images retrieved from WMS
+        :param out_writer: StreamingCsvWriter for wms_layers.csv
+        :param caps_store: optional CapabilitiesStore to read GetCapabilities docs through
+        :param limit_count: limit the number of records searched in each CSW, 0 for no limit
+        :param ogc_srv_type: type of OGC url in CSW record references to search
+        :param test_wms_get_map: issue GetMap request for matched WMS layers & validate image
+        :param image_store: MapImageStore that validates (and writes) the map images, defaults to one writing to out_path
+        :param journal: optional RunJournal, completed pages are journaled and (if resuming) skipped
+        :param state: optional HarvestState, records seen are tracked in it and (if incremental) only those modified
+            since the last complete harvest of each CSW are retrieved
+        :param record_filters: optional RecordFilters applied to the records retrieved from each CSW
+        :param probe_element_set: probe each CSW for the smallest element set holding the record fields harvested
+        :param max_in_flight: max concurrent requests overall
+        :param max_per_host: max concurrent requests to any one host
+        :param timeout: HTTP timeout in seconds
+        :param extent_planner: optional map_extents.ExtentPlanner picking the extent (and size) of each GetMap request
+        :param getmap_crs: optional getmap_crs.GetMapCrs picking the crs of each GetMap request and logging its latency
+        """
+        self.out_path = out_path
+        self.out_writer = out_writer
+        self.caps_store = caps_store
+        self.limit_count = limit_count
+        self.ogc_srv_type = ogc_srv_type
+        self.test_wms_get_map = test_wms_get_map
+        self.image_store = image_store if image_store is not None else MapImageStore(out_path)
+        self.journal = journal
+        self.state = state
+        self.record_filters = record_filters
+        self.probe_element_set = probe_element_set
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.extent_planner = extent_planner
+        self.getmap_crs = getmap_crs
+        self.pages = 0
+        self.wms_hits = 0
+        self.wms_misses = 0
+        self._wms = {}  # normalised WMS url -> asyncio.Task instantiating the OWSLib WebMapService object
+        self._session = None
+
+    async def run(self, csw_urls):
+        """
+        search all the CSWs at once
+
+        :param csw_urls: list of CSW urls
+        """
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, limit_per_host=self.max_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        headers = {'User-Agent': 'OWSLib (https://geopython.github.io/OWSLib)'}
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+            self._session = session
+            for csw_url, searched in zip(csw_urls, await asyncio.gather(*[self.search_csw_for_ogc_endpoints(u) for u in csw_urls])):
+                logging.info('Finished searching CSW: %s', csw_url)
+
+    async def _in_executor(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+    async def getrecords(self, csw, **kwargs):
+        """
+        async getrecords2()
+
+        :param csw: HarvestCatalogueServiceWeb
+        :param kwargs: passed on to getrecords2()
+        :return: copy of csw holding the page of records
+        """
+        request_url, request = csw.prepare_getrecords(**kwargs)
+        headers = {'Content-type': 'text/xml', 'Accept': 'text/xml', 'Accept-Language': csw.lang}
+        async with self._session.post(request_url, data=request, headers=headers) as resp:
+            response = await resp.read()
+
+        return await self._in_executor(csw.getrecords_from_response, response, **kwargs)
+
+    async def search_csw_for_ogc_endpoints(self, csw_url):
+        print('Searching CSW: ', csw_url)
+        logging.info('CSW to search is: %s', csw_url)
+        try:
+            # one GetCapabilities request per CSW, made through the (blocking) capabilities store
+            csw = await self._in_executor(HarvestCatalogueServiceWeb, csw_url, store=self.caps_store, timeout=self.timeout)
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception("Exception raised when initially instantiating CSW.")
+            return
+
+        page_sizer = PageSizeController.for_csw(csw)
+        record_filter = self.record_filters.constraint(csw_url) if self.record_filters is not None else None
+        harvest = None
+        try:
+            # only need the number of matching records here, not the records themselves
+            hits = await self.getrecords(csw, resulttype='hits')
+            total_records = hits.results['matches']
+            logging.info('CSW Total Number of Matching Records: %s', str(total_records))
+            if record_filter is not None:
+                # the record filter is tried out on a hits request, a CSW that rejects it is paged through unfiltered
+                try:
+                    hits = await self.getrecords(csw, constraints=[record_filter], resulttype='hits')
+                # TODO improve caught exception specifity
+                except Exception:
+                    logging.exception("Exception raised when filtering records of CSW.")
+                    self.record_filters.record(csw_url, total_records, None)
+                    record_filter = None
+                else:
+                    self.record_filters.record(csw_url, total_records, hits.results['matches'])
+                    total_records = hits.results['matches']
+
+            if self.state is not None:
+                harvest = self.state.catalogue(csw_url, record_filter=self.record_filters.spec(csw_url) if record_filter is not None else None)
+            constraints = and_constraints([record_filter, harvest.modified_since() if harvest is not None else None])
+            num_records = total_records
+            if harvest is not None and harvest.incremental:
+                hits = await self.getrecords(csw, constraints=constraints, resulttype='hits')
+                num_records = hits.results['matches']
+                logging.info('CSW Number of Records modified since %s: %s', harvest.since, str(num_records))
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception("Exception raised when retrieving initial records from CSW.")
+            return
+
+        matches = num_records
+        if 0 < self.limit_count < num_records:
+            num_records = self.limit_count
+        logging.info('CSW Records to retrieve: %s', str(num_records))
+
+        if self.probe_element_set and num_records > 0:
+            # a couple of (blocking) requests per CSW
+            await self._in_executor(csw.choose_element_set, csw_record_harvest_fields, constraints=constraints)
+
+        skip_ranges = None
+        if self.journal is not None:
+            skip_ranges = self.journal.completed_ranges(csw_url)
+        page_cursor = PageCursor(num_records, page_sizer, skip_ranges=skip_ranges)
+
+        await self.page_through(page_cursor, functools.partial(self.retrieve_and_loop_through_csw_recordset, csw_url, csw, page_cursor, harvest, constraints))
+        logging.info('CSW paging: %s', page_sizer.stats())
+
+        if harvest is not None:
+            # only a harvest that paged through every record (modified since) in this run counts as complete
+            harvest.complete = num_records == matches and len(page_cursor.abandoned) == 0 and len(page_cursor.skip_ranges) == 0
+            if harvest.needs_listing(total_records):
+                logging.info('CSW %s has fewer records than when last harvested, listing them to find those that vanished', csw_url)
+                harvest.present = await self.list_csw_identifiers(csw, total_records, constraints=and_constraints([record_filter]))
+
+    async def page_through(self, page_cursor, page_job):
+        """
+        keep up to max_per_host pages of a CSW in flight, topping up as each one completes. The page job tells the
+        cursor how the page went
+
+        :param page_cursor: PageCursor
+        :param page_job: coroutine function taking (startposition, maxrecords)
+        :return: list of page_job results, in completion order
+        """
+        results = []
+        in_flight = set()
+        while True:
+            while len(in_flight) < self.max_per_host:
+                page = page_cursor.next_page()
+                if page is None:
+                    break
+                in_flight.add(asyncio.ensure_future(page_job(page[0], page[1])))
+
+            if len(in_flight) == 0:
+                break
+
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            results.extend(job.result() for job in done)
+
+        return results
+
+    async def list_csw_identifiers(self, csw, num_records, constraints=None):
+        """
+        async cataloger.list_csw_identifiers()
+
+        :return: set of identifiers or None if some of the records could not be retrieved
+        """
+        page_cursor = PageCursor(num_records, PageSizeController.for_csw(csw))
+
+        async def page_job(start_pos, resultset_size):
+            page_started = time.time()
+            try:
+                page = await self.getrecords(csw, constraints=constraints or [], esn='brief', startposition=start_pos, maxrecords=resultset_size)
+            # TODO improve caught exception specifity
+            except Exception:
+                logging.exception("Exception raised when listing records of CSW.")
+                page_cursor.page_failed(start_pos, resultset_size)
+                return set()
+            page_cursor.page_done(start_pos, resultset_size, returned=page.results['returned'], elapsed=time.time() - page_started, nbytes=len(page.response))
+            return set(r.identifier for r in page.records.values())
+
+        identifiers = set()
+        for page_identifiers in await self.page_through(page_cursor, page_job):
+            identifiers.update(page_identifiers)
+
+        if len(page_cursor.abandoned) > 0:
+            return None
+        return identifiers
+
+    async def retrieve_and_loop_through_csw_recordset(self, csw_url, csw, page_cursor, harvest, constraints, start_pos, resultset_size):
+        page_started = time.time()
+        try:
+            page = await self.getrecords(csw, constraints=constraints, esn=csw.record_esn, startposition=start_pos, maxrecords=resultset_size)
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception("Exception raised when retrieving subsequent set of records from CSW.")
+            page_cursor.page_failed(start_pos, resultset_size)
+            return
+
+        page_cursor.page_done(
+            start_pos,
+            resultset_size,
+            returned=page.results['returned'],
+            elapsed=time.time() - page_started,
+            nbytes=len(page.response)
+        )
+        self.pages += 1
+        logging.info('Processing records for CSW {}, from startposition: {}'.format(csw_url, str(start_pos)))
+
+        # every WMS referenced by every record in the page is searched / tested at once
+        references = []
+        for rec in page.records:
+            r = page.records[rec]
+            if r is None:
+                continue
+            csw_rec_fields = csw_record_fields(r)
+            if harvest is not None:
+                harvest.seen(csw_rec_fields[0], csw_rec_fields[5])
+            if r.references is None:
+                continue
+            for ref in r.references:
+                url = ref['url']
+                logging.info('Found URL {} in record references'.format(url))
+                if url is not None and get_ogc_type(url) == self.ogc_srv_type:
+                    if self.journal is not None and self.journal.already_written({'csw_url': csw_url, 'csw_record_identifier': csw_rec_fields[0], 'wms_url': url}):
+                        logging.info('Row for WMS URL {0} of record {1} written by an earlier run SO SKIPPING'.format(url, csw_rec_fields[0]))
+                        continue
+                    references.append(self.search_wms_reference(csw_url, csw_rec_fields, url))
+
+        # a reference that fails is logged and dropped (as the threaded pipeline does) rather than ending the harvest
+        for result in await asyncio.gather(*references, return_exceptions=True):
+            if isinstance(result, BaseException):
+                logging.error('Exception raised when searching WMS reference: %r', result)
+
+        # all the page`s rows have been handed to the writer, the page is journaled once they are on disk
+        if self.journal is not None and page.results['returned'] > 0:
+            self.journal.page(csw_url, start_pos, page.results['returned']).seal()
+
+    async def get_wms(self, wms_url):
+        """
+        run-scoped cache of OWSLib WebMapService objects. Concurrent requests for the same WMS share the one
+        GetCapabilities request and failures are cached too
+        """
+        key = normalise_endpoint_url(wms_url)
+        task = self._wms.get(key)
+        if task is None:
+            self.wms_misses += 1
+            task = asyncio.ensure_future(self.load_wms(wms_url))
+            self._wms[key] = task
+        else:
+            self.wms_hits += 1
+
+        return await task
+
+    async def load_wms(self, wms_url):
+        caps_url = WMSCapabilitiesReader('1.3.0').capabilities_url(clean_ows_url(wms_url))
+        stored = None
+        headers = {}
+        if self.caps_store is not None:
+            # the store does sqlite / gzip file I/O under a lock the executor threads hold too, so it is kept off the
+            # event loop
+            stored, headers = await self._in_executor(self.caps_store.revalidation_headers, caps_url)
+
+        if headers is None:
+            xml = stored
+        else:
+            logging.info('Requesting capabilities %s (conditional: %s)', caps_url, bool(headers))
+            async with self._session.get(caps_url, headers=headers) as resp:
+                xml = await resp.read()
+                if resp.status != 304 or stored is None:
+                    resp.raise_for_status()
+                if self.caps_store is not None:
+                    xml = await self._in_executor(self.caps_store.record_response, caps_url, stored, resp.status, xml, resp.headers)
+
+        return await self._in_executor(parse_wms_capabilities, wms_url, xml, self.timeout)
+
+    async def search_wms_reference(self, csw_url, csw_rec_fields, url):
+        try:
+            await self._search_wms_reference(csw_url, csw_rec_fields, url)
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception('Exception raised when searching WMS URL {0} of record {1}'.format(url, csw_rec_fields[0]))
+
+    async def _search_wms_reference(self, csw_url, csw_rec_fields, url):
+        csw_rec_identifier, csw_rec_publisher, csw_rec_title, csw_rec_subjects, csw_rec_abstract, csw_rec_modified = csw_rec_fields
+        wms_url_domain = None
+        if url.startswith('http'):
+            wms_url_domain = url.replace('https://', '').replace('http://', '').split('/')[0]
+        logging.info('URL ogc_url_type is: {0} SO searching WMS URL {1} for Matching WMS Layer'.format(self.ogc_srv_type, url))
+
+        try:
+            wms = await self.get_wms(url)
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception("Exception raised when instantiating WMS.")
+            return
+
+        # the fuzzy matching is CPU bound and put() blocks while the writer`s queue is full, so both are kept off the
+        # event loop
+        matched_wms_layer = await self._in_executor(search_wms_for_layer_matching_csw_record_title, wms=wms, csw_record_title=csw_rec_title)
+        if not matched_wms_layer['found_match']:
+            logging.info('Found ZERO matching WMS Layers for CSW record in WMS {0}'.format(url))
+            return
+
+        wms_get_map_error = None
+        made_get_map_req = None
+        image_status = None
+        out_image_fname = None
+        if self.test_wms_get_map:
+            wms_get_map_error, made_get_map_req, image_status, out_image_fname = await self.test_wms_layer(
+                wms, matched_wms_layer['matching_wms_layer_name']
+            )
+
+        await self._in_executor(self.out_writer.put, HarvestRecord(
+            csw_url=csw_url,
+            csw_record_identifier=csw_rec_identifier,
+            csw_record_publisher=csw_rec_publisher,
+            csw_record_title=csw_rec_title,
+            csw_record_subjects=csw_rec_subjects,
+            csw_record_abstract=csw_rec_abstract,
+            csw_record_modified=csw_rec_modified,
+            wms_url=url,
+            wms_url_domain=wms_url_domain,
+            wms_layer_for_record_title=matched_wms_layer['matching_wms_layer_title'],
+            wms_layer_for_record_name=matched_wms_layer['matching_wms_layer_name'],
+            wms_access_constraints=matched_wms_layer['wms_top_level_accessconstraints'],
+            only_1_choice=matched_wms_layer['only_1_choice'],
+            match_dist=matched_wms_layer['match_dist'],
+            bbox_wgs84=matched_wms_layer['matching_wms_layer_wgs84_bbox'],
+            bbox_projected=matched_wms_layer['matching_wms_layer_projected_bbox'],
+            wms_get_cap_error=False,  # rows are only written for WMS that were instantiated
+            wms_get_map_error=wms_get_map_error,
+            made_get_map_req=made_get_map_req,
+            image_status=image_status,
+            out_image_fname=out_image_fname
+        ))
+
+    async def test_wms_layer(self, wms, wms_layer_name):
+        """
+        async cataloger.test_wms_layer() for the layer`s WGS84 bbox (or the extent the extent planner picks within it),
+        or its projected bbox if the GetMap crs picks that
+
+        :param wms: OWSLib WebMapService object
+        :param wms_layer_name: name of WMS layer to request
+        :return: wms_get_map_error, made_get_map_req, image_status, out_image_fname
+        """
+        wms_get_map_error = False
+        made_get_map_req = False
+        image_status = None
+        out_image_fname = None
+
+        if wms_layer_name in wms.contents:
+            mode = MODE_WGS84
+            if self.getmap_crs is not None:
+                mode = self.getmap_crs.choose_mode(wms, wms_layer_name)
+
+            if mode == MODE_NATIVE:
+                logging.info('Requested to test GetMap for Layer {0} projected BBox'.format(wms_layer_name))
+                srs, bbox, size = self.getmap_crs.native_request(wms, wms_layer_name)
+            else:
+                logging.info('Requested to test GetMap for Layer {0} WGS84 BBox'.format(wms_layer_name))
+                srs = WGS84
+                bbox = wms.contents[wms_layer_name].boundingBoxWGS84
+                size = (400, 400)
+                if self.extent_planner is not None:
+                    request_extent = self.extent_planner.request_extent(wms, wms_layer_name)
+                    if request_extent is not None:
+                        bbox, size = request_extent
+
+            img = None
+            started = time.time()
+            try:
+                getmap_url = getmap_request_url(
+                    wms,
+                    layers=[wms_layer_name],
+                    srs=srs,
+                    bbox=bbox,
+                    size=size,
+                    format='image/png'
+                )
+                async with self._session.get(getmap_url) as resp:
+                    img = await resp.read()
+                    resp.raise_for_status()
+                    if resp.headers.get('Content-Type', '').split(';')[0] in ['application/vnd.ogc.se_xml', 'text/xml']:
+                        raise ServiceException(img.decode('utf-8', errors='replace'))
+            # TODO improve caught exception specifity
+            except Exception:
+                logging.exception("Exception raised when making WMS GetMap Request.")
+                wms_get_map_error = True
+            seconds = time.time() - started
+
+            if self.getmap_crs is not None:
+                self.getmap_crs.record(wms, wms_layer_name, mode, srs, size, seconds, len(img) if img is not None else None, wms_get_map_error)
+            if not wms_get_map_error:
+                made_get_map_req = True
+                logging.info('GetMap request made OK')
+                image_status, out_image_fname = await self._in_executor(self.image_store.check, img)
+
+        return wms_get_map_error, made_get_map_req, image_status, out_image_fname
+
+    def stats(self):
+        return {'pages': self.pages, 'wms_hits': self.wms_hits, 'wms_misses': self.wms_misses}
+
+
+def harvest(csw_urls, **kwargs):
+    """
+    run an AsyncHarvester over csw_urls to completion
+
+    :param csw_urls: list of CSW urls
+    :param kwargs: passed on to AsyncHarvester
+    :return: the AsyncHarvester
+    """
+    harvester = AsyncHarvester(**kwargs)
+    asyncio.run(harvester.run(csw_urls))
+    logging.info('Async harvest: %s', harvester.stats())
+    return harvester
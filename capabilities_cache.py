@@ -0,0 +1,133 @@
+import logging
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+# query string parameters that OWSLib adds itself when building a GetCapabilities request, so they play no part
+# in identifying which endpoint a url points at
+OGC_REQUEST_PARAMS = ('service', 'request', 'version')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class CapabilitiesUnavailable(Exception):
+    """
+    raised to every caller asking for an endpoint whose capabilities document could not be fetched / parsed
+    """
+    def __init__(self, url, cause):
+        super().__init__('Capabilities unavailable for {0}: {1!r}'.format(url, cause))
+        self.url = url
+        self.cause = cause
+
+
+def normalise_endpoint_url(url):
+    """
+    normalise an OGC endpoint url so that the different ways CSW records write the same endpoint i.e.
+
+    http://Example.com:80/wms?request=GetCapabilities&service=WMS
+    http://example.com/wms?SERVICE=WMS&REQUEST=GetCapabilities&VERSION=1.3.0
+
+    map on to the same cache key. Scheme and host are lowercased, default ports dropped, the OGC
+    service/request/version params removed and any remaining (vendor) params i.e. MapServer map= sorted
+
+    :param url: an ogc url
+    :return: normalised url string
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and DEFAULT_PORTS.get(scheme) != port:
+        netloc = '{0}:{1}'.format(netloc, port)
+
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in OGC_REQUEST_PARAMS]
+
+    return urlunsplit((scheme, netloc, parts.path or '/', urlencode(sorted(query)), ''))
+
+
+class CapabilitiesCache:
+    """
+    Run-scoped cache of parsed capabilities documents (i.e. OWSLib WebMapService objects) keyed on normalised
+    endpoint url and shared by all harvest worker threads.
+
+    Fetches are single-flight: if several threads ask for the same endpoint at once only the first one calls the
+    loader, the others block until its result is available. Failures are cached too so an endpoint that timed out
+    is not retried by every record that references it.
+    """
+    def __init__(self, loader):
+        """
+        :param loader: callable taking an endpoint url and returning the parsed capabilities object
+        """
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._entries = {}  # normalised url -> (ok, capabilities object or exception)
+        self._in_flight = {}  # normalised url -> threading.Event set once the fetch completes
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # callers that waited on another thread`s in-flight fetch rather than fetching
+        self.parse_failures = 0  # capabilities documents that could not be fetched or parsed
+
+    def get(self, url):
+        """
+        return the parsed capabilities for url, fetching them if no other thread has done so already
+
+        :param url: an ogc endpoint url
+        :return: whatever the loader returns
+        :raises CapabilitiesUnavailable: if the loader raised (now or on an earlier call for the same endpoint)
+        """
+        key = normalise_endpoint_url(url)
+        is_leader = False
+
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                done = None
+            elif key in self._in_flight:
+                self.coalesced += 1
+                done = self._in_flight[key]
+            else:
+                self.misses += 1
+                done = threading.Event()
+                self._in_flight[key] = done
+                is_leader = True
+
+        if is_leader:
+            try:
+                entry = (True, self.loader(url))
+            # loader is the arbitrary OWSLib/requests stack so anything could come back
+            except Exception as ex:
+                logging.info('Could not fetch/parse capabilities for %s', url)
+                entry = (False, ex)
+            with self._lock:
+                if not entry[0]:
+                    self.parse_failures += 1
+                self._entries[key] = entry
+                del self._in_flight[key]
+            done.set()
+        elif done is not None:
+            done.wait()
+
+        ok, value = self._entries[key]
+        if not ok:
+            raise CapabilitiesUnavailable(url, value)
+
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'endpoints': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'parse_failures': self.parse_failures
+            }
+
+    def log_stats(self):
+        logging.info(
+            'Capabilities cache: {endpoints} endpoints, {hits} hits, {misses} misses, '
+            '{coalesced} coalesced waits, {parse_failures} parse failures'.format(**self.stats())
+        )
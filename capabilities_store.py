@@ -0,0 +1,212 @@
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import requests
+
+
+DEFAULT_STORE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mapcatalogue', 'capabilities')
+
+
+class CapabilitiesStore:
+    """
+    Persistent, content-addressed on-disk store of raw (gzip compressed) OGC capabilities documents that survives
+    between harvest runs.
+
+    Documents younger than ttl are served straight from disk. Older ones are revalidated with a conditional GET
+    (If-None-Match / If-Modified-Since) and the stored bytes are reused if the server answers 304 Not Modified.
+    Identical documents served by different urls are only stored once. Once the store grows past max_bytes the
+    least recently used entries are evicted.
+
+    This should NOT live under the harvest out_path since tidy() purges that at the start of every run.
+    """
+    def __init__(self, store_path=DEFAULT_STORE_PATH, ttl=86400, max_bytes=512 * 1024 * 1024, timeout=30):
+        """
+        :param store_path: folder to hold the store, created if it does not exist
+        :param ttl: seconds a stored document is used without revalidating it with the server
+        :param max_bytes: cap on the (compressed) size of the stored documents
+        :param timeout: HTTP timeout in seconds
+        """
+        self.store_path = store_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.fresh_hits = 0  # served from disk without a request
+        self.not_modified = 0  # revalidated with a 304
+        self.downloads = 0  # full 200 responses
+        self.bytes_downloaded = 0
+
+        os.makedirs(os.path.join(self.store_path, 'blobs'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._db = sqlite3.connect(os.path.join(self.store_path, 'index.sqlite'), check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                url text PRIMARY KEY,
+                sha256 text NOT NULL,
+                etag text,
+                last_modified text,
+                fetched_at real NOT NULL,
+                last_access real NOT NULL
+            )""")
+            self._db.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 text PRIMARY KEY,
+                size integer NOT NULL
+            )""")
+
+    def _blob_fname(self, sha256):
+        return os.path.join(self.store_path, 'blobs', sha256[:2], sha256 + '.xml.gz')
+
+    def _read_blob(self, sha256):
+        fname = self._blob_fname(sha256)
+        if not os.path.exists(fname):
+            return None
+        with gzip.open(fname, 'rb') as inpf:
+            return inpf.read()
+
+    def _write_blob(self, content):
+        sha256 = hashlib.sha256(content).hexdigest()
+        fname = self._blob_fname(sha256)
+        if not os.path.exists(fname):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            tmp_fname = '{0}.{1}.tmp'.format(fname, threading.get_ident())
+            with open(tmp_fname, 'wb') as outpf:
+                outpf.write(gzip.compress(content))
+            os.replace(tmp_fname, fname)
+        return sha256, os.path.getsize(fname)
+
+    def fetch(self, url):
+        """
+        return the raw capabilities document for url, from the store where possible
+
+        :param url: full GetCapabilities request url
+        :return: document bytes
+        :raises requests.RequestException: if the server had to be asked and the request failed
+        """
+        stored, headers = self.revalidation_headers(url)
+        if headers is None:
+            return stored
+
+        logging.info('Requesting capabilities %s (conditional: %s)', url, bool(headers))
+        resp = self._session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code != 304 or stored is None:
+            resp.raise_for_status()
+
+        return self.record_response(url, stored, resp.status_code, resp.content, resp.headers)
+
+    def revalidation_headers(self, url):
+        """
+        first half of fetch(), for callers making the request themselves (i.e. the asyncio harvester)
+
+        :param url: full GetCapabilities request url
+        :return: (stored document bytes or None, headers for the conditional GET or None if the stored document is
+            fresh and no request is needed)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._db.execute(
+                'SELECT sha256, etag, last_modified, fetched_at FROM entries WHERE url = ?', (url,)
+            ).fetchone()
+        stored = None
+        if entry is not None:
+            stored = self._read_blob(entry[0])
+
+        if stored is not None and now - entry[3] < self.ttl:
+            with self._lock, self._db:
+                self._db.execute('UPDATE entries SET last_access = ? WHERE url = ?', (now, url))
+                self.fresh_hits += 1
+            return stored, None
+
+        headers = {}
+        if stored is not None:
+            if entry[1] is not None:
+                headers['If-None-Match'] = entry[1]
+            if entry[2] is not None:
+                headers['If-Modified-Since'] = entry[2]
+
+        return stored, headers
+
+    def record_response(self, url, stored, status_code, content, resp_headers):
+        """
+        second half of fetch(), store the (successful) response to the request made with revalidation_headers()
+
+        :param url: full GetCapabilities request url
+        :param stored: stored document bytes returned by revalidation_headers()
+        :param status_code: HTTP status of the response
+        :param content: response body bytes
+        :param resp_headers: response headers
+        :return: document bytes
+        """
+        now = time.time()
+        if status_code == 304 and stored is not None:
+            with self._lock, self._db:
+                self._db.execute(
+                    'UPDATE entries SET fetched_at = ?, last_access = ? WHERE url = ?', (now, now, url)
+                )
+                self.not_modified += 1
+            return stored
+
+        sha256, size = self._write_blob(content)
+
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO blobs (sha256, size) VALUES (?, ?)', (sha256, size))
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries (url, sha256, etag, last_modified, fetched_at, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (url, sha256, resp_headers.get('ETag'), resp_headers.get('Last-Modified'), now, now)
+            )
+            self.downloads += 1
+            self.bytes_downloaded += len(content)
+            self._evict(keep_url=url)
+
+        return content
+
+    def _evict(self, keep_url):
+        """
+        drop least recently used entries (and any blobs no longer referenced) until the store is under max_bytes.
+        Must be called holding self._lock
+        """
+        total = self._db.execute('SELECT coalesce(sum(size), 0) FROM blobs').fetchone()[0]
+        while total > self.max_bytes:
+            lru = self._db.execute(
+                'SELECT url, sha256 FROM entries WHERE url != ? ORDER BY last_access LIMIT 1', (keep_url,)
+            ).fetchone()
+            if lru is None:
+                break
+            self._db.execute('DELETE FROM entries WHERE url = ?', (lru[0],))
+            still_used = self._db.execute('SELECT 1 FROM entries WHERE sha256 = ? LIMIT 1', (lru[1],)).fetchone()
+            if still_used is None:
+                size = self._db.execute('SELECT size FROM blobs WHERE sha256 = ?', (lru[1],)).fetchone()
+                self._db.execute('DELETE FROM blobs WHERE sha256 = ?', (lru[1],))
+                try:
+                    os.remove(self._blob_fname(lru[1]))
+                except OSError:
+                    pass
+                if size is not None:
+                    total -= size[0]
+            logging.info('Evicted capabilities for %s from store', lru[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'fresh_hits': self.fresh_hits,
+                'not_modified': self.not_modified,
+                'downloads': self.downloads,
+                'bytes_downloaded': self.bytes_downloaded
+            }
+
+    def log_stats(self):
+        logging.info(
+            'Capabilities store: {fresh_hits} fresh hits, {not_modified} revalidated (304), '
+            '{downloads} downloads ({bytes_downloaded} bytes)'.format(**self.stats())
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+        self._session.close()
@@ -1,52 +1,56 @@
 from concurrent.futures import ThreadPoolExecutor
 import csv
+import functools
 import glob
 import logging
 import os
 import shutil
-import uuid
+import time
 import click
 from click_option_group import optgroup, RequiredMutuallyExclusiveOptionGroup
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from owslib.csw import CatalogueServiceWeb
-from owslib.wms import WebMapService
-from postgres import Postgres
-from PIL import Image
-import Levenshtein as Lvn # https://rawgit.com/ztane/python-Levenshtein/master/docs/Levenshtein.html
+from owslib.map.common import WMSCapabilitiesReader
+from owslib.util import clean_ows_url
+
+from capabilities_cache import CapabilitiesCache
+from capabilities_store import CapabilitiesStore, DEFAULT_STORE_PATH
+from catalogue_store import CatalogueStore, DEFAULT_CATALOGUE_PATH
+from csw_client import HarvestCatalogueServiceWeb, pooled_session
+from csw_paging import iter_pages, PageCursor, PageSizeController
+from extent_index import build_extent_index
+from getmap_crs import GetMapCrs, MODE_FASTEST, MODE_NATIVE, MODE_WGS84, WGS84
+from geocoder import check_wgs84_bbox, geocode_wms_layers, GEOGRAPHIES_FNAME, reverse_geocoder
+from harvest_record import HarvestRecord, WMS_LAYERS_FIELDS
+from harvest_state import CHANGES_FNAME, DEFAULT_STATE_PATH, HarvestState
+from layer_index import layer_index
+from map_extents import ExtentPlanner, load_regions, REGION_SETS
+from map_images import check_map_image_bytes, DEFAULT_SIGNATURES_PATH, MapImageStore
+from output_writer import CsvSink, export_records, open_sink, OUTPUT_FORMATS, read_records, StreamingCsvWriter, StreamingWriter, TeeSink
+from pg_loader import load_wms_layers
+from pipeline import Pipeline, Stage
+from record_filter import and_constraints, RecordFilters
+from run_journal import RunJournal
+from scheduler import host_slot, HostScheduler, url_host
+from wms_capabilities import load_web_map_service, web_map_service
 
 
 def check_wms_map_image(fn):
+    """
+    validate a map image written to disk, see check_map_image_bytes()
+
+    :param fn: image file
+    :return: image status
+    """
     status = None
     logging.info('Checking image: %s', fn)
 
     if os.path.exists(fn):
-        if os.path.getsize(fn) > 0:
-            with Image.open(fn) as im:
-                try:
-                    im_colors_list = im.getcolors(im.size[0] * im.size[1])
-                # TODO improve caught exception specifity
-                except Exception:
-                    logging.exception("Exception raised when checking image.")
-                    status = "Invalid"
-                else:
-                    try:
-                        number_of_cols_in_img = len(im_colors_list)
-                    # TODO improve caught exception specifity
-                    except Exception:
-                        logging.exception("Exception raised when checking image.")
-                        status = "Invalid"
-                    else:
-                        if number_of_cols_in_img > 1:
-                            status = "seems to be populated"
-                        else:
-                            # other cause of this could be that data is not visible at this scale
-                            status = "seems to all be background / no layer features in extent?"
-        else:
-            status = "seems to be a nosize img"
+        with open(fn, 'rb') as inpf:
+            status = check_map_image_bytes(inpf.read())
     else:
         status = "Image does not exist"
+        logging.info('Image Status is: %s', status)
 
-    logging.info('Image Status is: %s', status)
     return status
 
 
@@ -54,17 +58,13 @@ def generate_report(out_path):
     context = []
     csv_fname = os.path.join(out_path, 'wms_layers.csv')
     if os.path.exists(csv_fname):
-        with open(csv_fname, 'r') as inpf:
-            c = 1
-            my_reader = csv.reader(inpf)
-            for r in my_reader:
-                if c > 1:
-                    context.append(r)
-                c += 1
+        context = list(read_records(csv_fname))
 
     env = Environment(
         loader=FileSystemLoader('templates'),
-        autoescape=select_autoescape(['html', 'xml'])
+        autoescape=select_autoescape(['html', 'xml']),
+        # fields without a value show blank, as they are in wms_layers.csv
+        finalize=lambda v: '' if v is None else v
     )
     template = env.get_template('wms_validation_report_templ.html')
 
@@ -101,51 +101,102 @@ def get_ogc_type(url):
     return ogc_type
 
 
-def reverse_geocode_wgs84_boundingbox(pg_conn_str, wgs84_bbox):
+def reverse_geocode_wgs84_boundingbox(pg_conn_str, wgs84_bbox, geocoder_file=None):
     """
     Given a wgs84 boundingbox provided as a 4 element tuple, identify using a Natural Earth global countries dataset
-    held in PostGIS db which countries the boundingbox intersects with.
+    held in PostGIS db which countries the boundingbox intersects with. Goes through the pooled, memoising
+    ReverseGeocoder of pg_conn_str, use its geocode() directly to geocode many bboxes at once.
 
     :param pg_conn_str: a SQLAlchemy type Pg connection string to the db holding the natural earth polygon data
     :param wgs84_bbox: 4 element tuple i.e. (-74.66163, 39.65041, -72.00061, 41.61214)
+    :param geocoder_file: GeoJSON file of the polygons to geocode offline (see OfflineGeocoder) in place of pg_conn_str
     :return: a list of dictionaries in form: [{'country': 'United States', 'continent': 'North America'}, ...]
     """
     geographies = None
 
-    if isinstance(wgs84_bbox, tuple):
-        if len(wgs84_bbox) == 4:
-            try:
-                db = Postgres(pg_conn_str)
-            except Exception:
-                logging.exception('Could not connect to Pg using provided pg_conn_str')
-            else:
-                sql = """
-                SELECT DISTINCT b.name_long, b.continent
-                FROM
-                geocrud.natural_earth_world_map_units b
-                where st_intersects(st_makeenvelope({bbox_xmin}, {bbox_ymin}, {bbox_xmax}, {bbox_ymax}, 4326), b.geom)
-                """.format(
-                    bbox_xmin=wgs84_bbox[0],
-                    bbox_ymin=wgs84_bbox[1],
-                    bbox_xmax=wgs84_bbox[2],
-                    bbox_ymax=wgs84_bbox[3]
-                )
-                try:
-                    rs = db.all(sql)
-                except Exception:
-                    logging.exception('Problem running query, maybe table geocrud.natural_earth_world_map_units does not exist')
-                else:
-                    geographies = []
-                    for r in rs:
-                        geographies.append({'country':r[0] , 'continent':r[1]})
+    check_wgs84_bbox(wgs84_bbox)
+    try:
+        if geocoder_file is not None:
+            geocoder = reverse_geocoder(fname=geocoder_file)
         else:
-            raise ValueError('wrong number of elements in wgs84_bbox tuple')
+            geocoder = reverse_geocoder(pg_conn_str=pg_conn_str)
+    except Exception:
+        logging.exception('Could not connect to Pg using provided pg_conn_str / read geocoder_file')
     else:
-        raise TypeError('wgs84_bbox must be a 4 item tuple')
+        try:
+            geographies = geocoder.geocode([wgs84_bbox])[wgs84_bbox]
+        except Exception:
+            logging.exception('Problem running query, maybe table geocrud.natural_earth_world_map_units does not exist')
 
     return geographies
 
 
+def load_wms(wms_url, caps_store=None, scheduler=None):
+    """
+    instantiate an OWSLib WebMapService object for wms_url, its GetCapabilities doc parsed by the streaming parser of
+    wms_capabilities (with OWSLib as the fallback). Used as the loader of the run-scoped CapabilitiesCache
+
+    :param wms_url: WMS GetCapabilities url
+    :param caps_store: optional CapabilitiesStore to read the GetCapabilities doc through
+    :param scheduler: optional HostScheduler whose per-host connection cap applies to the request
+    :return: OWSLib WebMapService object
+    """
+    with host_slot(scheduler, wms_url):
+        xml = None
+        if caps_store is not None:
+            # build the same GetCapabilities request url OWSLib would
+            caps_url = WMSCapabilitiesReader('1.3.0').capabilities_url(clean_ows_url(wms_url))
+            xml = caps_store.fetch(caps_url)
+
+        if xml is None:
+            wms = load_web_map_service(wms_url, version='1.3.0', timeout=30)
+        else:
+            wms = web_map_service(wms_url, xml=xml, version='1.3.0', timeout=30)
+
+    # build the layer index now, once, rather than in whichever record first matches against the WMS
+    layer_index(wms)
+    return wms
+
+
+def csw_record_fields(r):
+    """
+    fetch / clean-up the CSW record fields written to wms_layers.csv
+
+    :param r: OWSLib CswRecord
+    :return: tuple of identifier, publisher, title, subjects, abstract, modified
+    """
+    csw_rec_identifier = r.identifier
+    csw_rec_abstract = r.abstract
+    if csw_rec_abstract is not None:
+        csw_rec_abstract = csw_rec_abstract.replace("\n", "")
+    csw_rec_modified = r.modified
+    csw_rec_publisher = r.publisher
+
+    # fetch / clean-up title
+    csw_rec_title = r.title
+    if csw_rec_title is not None:
+        csw_rec_title = csw_rec_title.replace("\n", "")
+
+    # fetch / clean-up subjects
+    # convert the list of subjects to a string. Sometimes the list has a None, so filter these off
+    csw_rec_subjects = r.subjects
+    if csw_rec_subjects is not None:
+        csw_rec_subjects = ', '.join(list(filter(None, csw_rec_subjects)))
+
+    return csw_rec_identifier, csw_rec_publisher, csw_rec_title, csw_rec_subjects, csw_rec_abstract, csw_rec_modified
+
+
+def csw_record_harvest_fields(r):
+    """
+    :param r: OWSLib CswRecord
+    :return: tuple of every field the harvest reads from a CSW record, csw_record_fields() plus the references
+    """
+    references = None
+    if r.references is not None:
+        references = tuple((ref['scheme'], ref['url']) for ref in r.references)
+    return csw_record_fields(r) + (references,)
+
+
 def search_wms_for_layer_matching_csw_record_title(wms, csw_record_title):
     """
     new streamlined version of search_wms_for_layer_matching_csw_record_title() that only retrieves wms layer
@@ -178,27 +229,27 @@ def search_wms_for_layer_matching_csw_record_title(wms, csw_record_title):
     # in the CSW record itself but present in the WMS as point-of-access?
     wms_top_level_accessconstraints = wms.identification.accessconstraints
 
-    # iterate through named layers in WMS and look for a layer whose title matches CSW record title
-    # we cannot just look for CSW record title in wms.contents as wms.contents keys are WMS layer
+    # the layer index of the WMS is built once (when the WMS is first loaded) and shared by every record matched
+    # against it. We cannot just look for CSW record title in wms.contents as wms.contents keys are WMS layer
     # record names and match is on title
-    for i in wms.contents:
-        wms_layer_name = wms[i].name  # WMS Layer <Name> Machine-Readable
-        wms_layer_title = wms[i].title  # WMS Layer <Title> Human-Readable
-
-        # if have an exact match we can shortcut having to go through rest of the layers
-        if wms_layer_title == csw_record_title:
-            matching_wms_layer_name = wms_layer_name
-            exact_match = True
-            break
-        else:
-            # otherwise we need to look through WMS layers and look for a layer whose title most closely matches the
-            # CSW record title. Closeness of match is determined using Levenshtein distance (LD of 0 means 2 strings
-            # are identical
-            levenshtein_dist = Lvn.distance(csw_record_title, wms_layer_title)
-            if levenshtein_dist < min_levenshtein_dist:
-                min_levenshtein_dist = levenshtein_dist
-                matching_wms_layer_name = wms_layer_name
-        layers_checked_count += 1
+    index = layer_index(wms)
+
+    # if have an exact match we can shortcut having to go through rest of the layers
+    exact_position = index.exact_position(csw_record_title)
+    if exact_position is not None:
+        matching_wms_layer_name = index.names[exact_position]
+        exact_match = True
+        # the layers ahead of the exact match are the ones that would have been checked before it
+        layers_checked_count = exact_position
+    else:
+        # otherwise we need to look through WMS layers and look for a layer whose title most closely matches the
+        # CSW record title. Closeness of match is determined using Levenshtein distance (LD of 0 means 2 strings
+        # are identical
+        closest_position, levenshtein_dist = index.closest_position(csw_record_title)
+        if closest_position is not None:
+            min_levenshtein_dist = levenshtein_dist
+            matching_wms_layer_name = index.names[closest_position]
+        layers_checked_count = len(index)
 
     only_1_choice = False
     if layers_checked_count == 1:
@@ -210,7 +261,7 @@ def search_wms_for_layer_matching_csw_record_title(wms, csw_record_title):
         match_dist = min_levenshtein_dist
 
     if matching_wms_layer_name is not None:
-        if matching_wms_layer_name in list(wms.contents):
+        if matching_wms_layer_name in wms.contents:
             found_match = True
             matching_wms_layer_title = wms.contents[matching_wms_layer_name].title
             matching_wms_layer_wgs84_bbox = wms.contents[matching_wms_layer_name].boundingBoxWGS84
@@ -232,10 +283,17 @@ def search_wms_for_layer_matching_csw_record_title(wms, csw_record_title):
     return matched_wms_layer
 
 
-# TODO use reverse_geocode_wgs84_boundingbox() to geocode the CSW record / WMS layer extent
-# TODO improve / use a dictionary or namedtuple to store data since using a list is painful
 def retrieve_and_loop_through_csw_recordset(params):
-    out_records = []
+    """
+    record discovery stage. Fetches a page of CSW records and puts each OGC endpoint reference of the right type onto
+    the pipeline as a task of its own, to be resolved / matched / validated by the later stages
+
+    :param params: list of csw_url, start_pos, resultset_size, ogc_srv_type, out_path, restrict_wms_layers_to_match,
+        test_wms_get_map, wms_cache, csw, page_cursor, pipeline, scheduler, journal (optional RunJournal), harvest
+        (optional CatalogueHarvest), constraints (OWSLib getrecords2() constraints)
+    :return: number of references put onto the pipeline
+    """
+    references_queued = 0
     csw_url = params[0]
     start_pos = params[1]
     resultset_size = params[2]
@@ -243,230 +301,390 @@ def retrieve_and_loop_through_csw_recordset(params):
     out_path = params[4]
     restrict_wms_layers_to_match = params[5]
     test_wms_get_map = params[6]
-
+    wms_cache = params[7]
+    csw = params[8]
+    page_cursor = params[9]
+    pipeline = params[10]
+    scheduler = params[11]
+    journal = params[12] if len(params) > 12 else None
+    harvest = params[13] if len(params) > 13 else None
+    constraints = params[14] if len(params) > 14 else []
+
+    # csw client was built (and its GetCapabilities parsed) once for the catalogue, only the GetRecords request is
+    # made here
+    page_started = time.time()
     try:
-        csw = CatalogueServiceWeb(csw_url)
+        csw = csw.getrecords_page(constraints=constraints, esn=csw.record_esn, startposition=start_pos, maxrecords=resultset_size)
     # TODO improve caught exception specifity
     except Exception:
-        logging.exception("Exception raised when subsequentially instantiating CSW.")
+        logging.exception("Exception raised when retrieving subsequent set of records from CSW.")
+        page_cursor.page_failed(start_pos, resultset_size)
     else:
+        # let the cursor know how the page went so the size of later pages can be adapted
+        page_cursor.page_done(
+            start_pos,
+            resultset_size,
+            returned=csw.results['returned'],
+            elapsed=time.time() - page_started,
+            nbytes=len(csw.response)
+        )
+        logging.info('Processing records for CSW {}, from startposition: {}'.format(csw_url, str(start_pos)))
+
+        # the page is journaled as complete once all the references put onto the pipeline from it have come out
+        journal_page = None
+        if journal is not None and csw.results['returned'] > 0:
+            journal_page = journal.page(csw_url, start_pos, csw.results['returned'])
+
+        for rec in csw.records:
+            r = None
+            r = csw.records[rec]
+
+            if r is not None:
+                csw_rec_identifier, csw_rec_publisher, csw_rec_title, csw_rec_subjects, csw_rec_abstract, csw_rec_modified = csw_record_fields(r)
+                if harvest is not None:
+                    harvest.seen(csw_rec_identifier, csw_rec_modified)
+
+                # fetch / clean-up references
+                csw_rec_references = r.references
+                if csw_rec_references is not None:
+                    # TODO what do we do if there is more than 1 WMS included in CSW references list?
+                    for ref in csw_rec_references:
+                        url = ref['url']
+                        wms_url_domain = None
+                        ogc_url_type = None
+                        logging.info('Found URL {} in record references'.format(url))
+                        if url is not None:
+                            ogc_url_type = get_ogc_type(url)
+
+                        if ogc_url_type is not None:
+                            if ogc_url_type == ogc_srv_type:
+                                if url.startswith('http'):
+                                    wms_url_domain = url.replace('https://', '').replace('http://', '').split('/')[0]
+                                logging.info('URL ogc_url_type is: {0} SO queueing WMS URL {1} to search for Matching WMS Layer'.format(
+                                    ogc_url_type, url
+                                ))
+                                # the reference is carried through the pipeline stages as a dict keyed on the
+                                # wms_layers.csv field names, each stage filling in more of the fields
+                                wms_ref = {
+                                    'csw_url': csw_url,
+                                    'csw_record_identifier': csw_rec_identifier,
+                                    'csw_record_publisher': csw_rec_publisher,
+                                    'csw_record_title': csw_rec_title,
+                                    'csw_record_subjects': csw_rec_subjects,
+                                    'csw_record_abstract': csw_rec_abstract,
+                                    'csw_record_modified': csw_rec_modified,
+                                    'wms_url': url,
+                                    'wms_url_domain': wms_url_domain
+                                }
+                                if journal is not None and journal.already_written(wms_ref):
+                                    logging.info('Row for WMS URL {0} of record {1} written by an earlier run SO SKIPPING'.format(url, csw_rec_identifier))
+                                    continue
+                                if journal_page is not None:
+                                    wms_ref['journal_page'] = journal_page
+                                    journal_page.add()
+                                pipeline.put(wms_ref)
+                                references_queued += 1
+                            else:
+                                logging.info('URL ogc_url_type is NONE-WMS OGC SERVICE: {} SO SKIPPING searching for record title'.format(ogc_url_type))
+                        else:
+                            logging.info('URL ogc_url_type is None i.e. NOT AN OGC SERVICE SO SKIPPING')
+
+        if journal_page is not None:
+            journal_page.seal()
+
+    return references_queued
+
+
+def resolve_wms_reference(ref, wms_cache):
+    """
+    endpoint resolution stage. Fetches the OWSLib WebMapService object from the run-scoped cache, only the first
+    reference (in any thread) to a WMS causes it to be instantiated
+
+    :param ref: reference dict from retrieve_and_loop_through_csw_recordset()
+    :param wms_cache: CapabilitiesCache of WebMapService objects
+    :return: list holding ref, or empty list if the WMS could not be instantiated
+    """
+    try:
+        ref['wms'] = wms_cache.get(ref['wms_url'])
+    # TODO improve caught exception specifity
+    except Exception:
+        logging.exception("Exception raised when instantiating WMS.")
+        return []
+
+    logging.info('WMS WAS instantiated OK')
+    ref['wms_get_cap_error'] = False
+    return [ref]
+
+
+def match_wms_reference(ref):
+    """
+    layer matching stage. Searches the WMS for a layer matching the CSW record title
+
+    :param ref: reference dict from resolve_wms_reference()
+    :return: list holding ref, or empty list if there was no matching layer
+    """
+    matched_wms_layer = search_wms_for_layer_matching_csw_record_title(
+        wms=ref['wms'],
+        csw_record_title=ref['csw_record_title']
+    )
+    if not matched_wms_layer['found_match']:
+        logging.info('Found ZERO matching WMS Layers for CSW record in WMS {0}'.format(ref['wms_url']))
+        return []
+
+    logging.info('Found matching WMS Layer for CSW record in WMS, matched WMS layer title is {}'.format(matched_wms_layer['matching_wms_layer_title']))
+    ref['wms_layer_for_record_title'] = matched_wms_layer['matching_wms_layer_title']
+    ref['wms_layer_for_record_name'] = matched_wms_layer['matching_wms_layer_name']
+    ref['wms_access_constraints'] = matched_wms_layer['wms_top_level_accessconstraints']
+    ref['only_1_choice'] = matched_wms_layer['only_1_choice']
+    ref['match_dist'] = matched_wms_layer['match_dist']
+    ref['bbox_wgs84'] = matched_wms_layer['matching_wms_layer_wgs84_bbox']
+    ref['bbox_projected'] = matched_wms_layer['matching_wms_layer_projected_bbox']
+    return [ref]
+
+
+def validate_wms_reference(ref, out_path, scheduler=None, image_store=None, extent_planner=None, getmap_crs=None):
+    """
+    map validation stage. Tests i.e. does a GetMap request for the matched layer
+
+    :param ref: reference dict from match_wms_reference()
+    :param out_path: where to write image retrieved from WMS
+    :param scheduler: optional HostScheduler whose per-host connection cap applies to the request
+    :param image_store: MapImageStore that validates (and writes) the map images
+    :param extent_planner: optional ExtentPlanner picking the extent of the GetMap request
+    :param getmap_crs: optional GetMapCrs picking the crs of the GetMap request
+    :return: list holding ref
+    """
+    with host_slot(scheduler, ref['wms_url']):
+        ref['wms_get_map_error'], ref['made_get_map_req'], ref['image_status'], ref['out_image_fname'] = test_wms_layer(
+            wms=ref['wms'],
+            wms_layer_name=ref['wms_layer_for_record_name'],
+            out_path=out_path,
+            request_wgs84_layer_extent=True,
+            request_projected_layer_extent=False,
+            request_custom_extent=False,
+            custom_extent_bbox=None,
+            image_store=image_store,
+            extent_planner=extent_planner,
+            getmap_crs=getmap_crs
+        )
+    return [ref]
+
+
+def wms_layers_row(ref):
+    """
+    :param ref: reference dict that has been through the pipeline
+    :return: HarvestRecord of the ref
+    """
+    return HarvestRecord.from_ref(ref)
+
+
+def build_pipeline(out_writer, wms_cache, out_path, test_wms_get_map=True, image_store=None, scheduler=None, resolve_workers=8, match_workers=2, validate_workers=8, max_queued=1000, monitor_seconds=10.0, extent_planner=None, getmap_crs=None):
+    """
+    build (and start) the endpoint resolution -> layer matching -> map validation pipeline that the references
+    found by the record discovery stage are put onto. Rows come out of the end of it into out_writer
+
+    :param out_writer: StreamingCsvWriter for wms_layers.csv
+    :param wms_cache: CapabilitiesCache of WebMapService objects
+    :param out_path: where to write images retrieved from WMS
+    :param test_wms_get_map: include the map validation stage
+    :param image_store: MapImageStore that validates (and writes) the map images, defaults to one writing to out_path
+    :param scheduler: optional HostScheduler that is running the record discovery, its queue depth is monitored along
+        with the stages and its per-host connection cap applies to GetMap requests
+    :param resolve_workers: endpoint resolution threads
+    :param match_workers: layer matching threads
+    :param validate_workers: map validation threads
+    :param max_queued: size of each stage`s queue
+    :param monitor_seconds: how often to log the queue depths
+    :param extent_planner: optional ExtentPlanner picking the extent of each GetMap request
+    :param getmap_crs: optional GetMapCrs picking the crs of each GetMap request
+    :return: started Pipeline
+    """
+    stages = [
+        Stage('resolve', functools.partial(resolve_wms_reference, wms_cache=wms_cache), workers=resolve_workers, max_queued=max_queued),
+        Stage('match', match_wms_reference, workers=match_workers, max_queued=max_queued)
+    ]
+    if test_wms_get_map:
+        if image_store is None:
+            image_store = MapImageStore(out_path)
+        stages.append(
+            Stage('validate', functools.partial(validate_wms_reference, out_path=out_path, scheduler=scheduler, image_store=image_store, extent_planner=extent_planner, getmap_crs=getmap_crs), workers=validate_workers, max_queued=max_queued)
+        )
+
+    upstream_depths = {}
+    if scheduler is not None:
+        upstream_depths['discovery'] = lambda: scheduler.stats()['queued']
+
+    def ref_done(ref):
+        # let the run journal know the reference has left the pipeline, written or not
+        journal_page = ref.get('journal_page')
+        if journal_page is not None:
+            journal_page.ref_done()
+
+    def write_row(ref):
+        out_writer.put(wms_layers_row(ref))
+        ref_done(ref)
+
+    return Pipeline(
+        stages,
+        sink=write_row,
+        on_drop=ref_done,
+        upstream_depths=upstream_depths,
+        monitor_seconds=monitor_seconds
+    ).start()
+
+
+def list_csw_identifiers(csw, num_records, pool, max_in_flight, constraints=None):
+    """
+    identifiers of every record in a CSW. Only the identifiers are needed so the records are paged through using the
+    brief element set
+
+    :param csw: HarvestCatalogueServiceWeb
+    :param num_records: number of records in the CSW
+    :param pool: concurrent.futures Executor to run the page requests on
+    :param max_in_flight: max pages to request at once
+    :param constraints: optional OWSLib getrecords2() constraints the records are limited to
+    :return: set of identifiers or None if some of the records could not be retrieved
+    """
+    page_cursor = PageCursor(num_records, PageSizeController.for_csw(csw))
+
+    def page_job(start_pos, resultset_size):
+        page_started = time.time()
         try:
-            csw.getrecords2(startposition=start_pos, maxrecords=resultset_size)
+            page = csw.getrecords_page(constraints=constraints or [], esn='brief', startposition=start_pos, maxrecords=resultset_size)
         # TODO improve caught exception specifity
         except Exception:
-            logging.exception("Exception raised when retrieving subsequent set of records from CSW.")
-        else:
-            logging.info('Processing records for CSW {}, from startposition: {}'.format(csw_url, str(start_pos)))
-            for rec in csw.records:
-                r = None
-                r = csw.records[rec]
-
-                if r is not None:
-                    csw_rec_identifier = r.identifier
-                    csw_rec_abstract = r.abstract
-                    if csw_rec_abstract is not None:
-                        csw_rec_abstract = csw_rec_abstract.replace("\n", "")
-                    csw_rec_modified = r.modified
-                    csw_rec_publisher = r.publisher
-
-                    # fetch / clean-up title
-                    csw_rec_title = r.title
-                    if csw_rec_title is not None:
-                        csw_rec_title = csw_rec_title.replace("\n", "")
-
-                    # fetch / clean-up subjects
-                    # convert the list of subjects to a string. Sometimes the list has a None, so filter these off
-                    csw_rec_subjects = r.subjects
-                    if csw_rec_subjects is not None:
-                        csw_rec_subjects = ', '.join(list(filter(None, csw_rec_subjects)))
-
-                    # fetch / clean-up references
-                    csw_rec_references = r.references
-                    if csw_rec_references is not None:
-                        ogc_urls = []
-                        # TODO what do we do if there is more than 1 WMS included in CSW references list?
-                        for ref in csw_rec_references:
-                            url = ref['url']
-                            wms_url_domain = None
-                            ogc_url_type = None
-                            logging.info('Found URL {} in record references'.format(url))
-                            if url is not None:
-                                ogc_url_type = get_ogc_type(url)
-
-                            if ogc_url_type is not None:
-                                if ogc_url_type == ogc_srv_type:
-                                    if url.startswith('http'):
-                                        wms_url_domain = url.replace('https://', '').replace('http://', '').split('/')[0]
-                                    wms_layers = None
-                                    logging.info('URL ogc_url_type is: {0} SO searching WMS URL {1} for Matching WMS Layer'.format(
-                                        ogc_url_type, url
-                                    ))
-                                    found_matching_wms_layer = False
-                                    wms_get_cap_error = False
-
-                                    # instantiate OWSLib WebMapService object
-                                    try:
-                                        wms = WebMapService(url, version='1.3.0', timeout=30)
-                                    # TODO improve caught exception specifity
-                                    except Exception:
-                                        logging.exception("Exception raised when instantiating WMS.")
-                                        wms_get_cap_error = True
-                                    else:
-                                        logging.info('WMS WAS instantiated OK')
-                                        # search the WMS for a layer matching CSW record title
-                                        matched_wms_layer = search_wms_for_layer_matching_csw_record_title(
-                                            wms=wms,
-                                            csw_record_title=csw_rec_title
-                                        )
-                                        if matched_wms_layer['found_match']:
-                                            found_matching_wms_layer = True
-
-                                        if found_matching_wms_layer:
-                                            wms_get_map_error = None
-                                            made_get_map_req = None
-                                            image_status = None
-                                            out_image_fname = None
-
-                                            wms_layer_for_record_title = matched_wms_layer['matching_wms_layer_title']
-                                            logging.info('Found matching WMS Layer for CSW record in WMS, matched WMS layer title is'.format(wms_layer_for_record_title))
-                                            wms_layer_for_record_name = matched_wms_layer['matching_wms_layer_name']
-                                            wms_top_level_accessconstraints = matched_wms_layer['wms_top_level_accessconstraints']
-                                            bbox_wgs84 = matched_wms_layer['matching_wms_layer_wgs84_bbox']
-                                            bbox_projected = matched_wms_layer['matching_wms_layer_projected_bbox']
-                                            match_dist = matched_wms_layer['match_dist']
-                                            only_1_choice = matched_wms_layer['only_1_choice']
-
-                                            if test_wms_get_map:
-                                                #test i.e. do GetMap request for the layers from the WMS
-                                                wms_get_map_error, made_get_map_req, image_status, out_image_fname = test_wms_layer(
-                                                    wms=wms,
-                                                    wms_layer_name=matched_wms_layer['matching_wms_layer_name'],
-                                                    out_path=out_path,
-                                                    request_wgs84_layer_extent=True,
-                                                    request_projected_layer_extent=False,
-                                                    request_custom_extent=False,
-                                                    custom_extent_bbox=None
-                                                )
-
-                                            out_records.append([
-                                                csw_url,
-                                                csw_rec_identifier,
-                                                csw_rec_publisher,
-                                                csw_rec_title,
-                                                csw_rec_subjects,
-                                                csw_rec_abstract,
-                                                csw_rec_modified,
-                                                url,
-                                                wms_url_domain,
-                                                wms_layer_for_record_title,
-                                                wms_layer_for_record_name,
-                                                wms_top_level_accessconstraints,
-                                                only_1_choice,
-                                                match_dist,
-                                                bbox_wgs84,
-                                                bbox_projected,
-                                                wms_get_cap_error,
-                                                wms_get_map_error,
-                                                made_get_map_req,
-                                                image_status,
-                                                out_image_fname
-                                            ])
-                                        else:
-                                            logging.info('Found ZERO matching WMS Layers for CSW record in WMS {0}'.format(url))
-                                else:
-                                    logging.info('URL ogc_url_type is NONE-WMS OGC SERVICE: {} SO SKIPPING searching for record title'.format(ogc_url_type))
-                            else:
-                                logging.info('URL ogc_url_type is None i.e. NOT AN OGC SERVICE SO SKIPPING')
+            logging.exception("Exception raised when listing records of CSW.")
+            page_cursor.page_failed(start_pos, resultset_size)
+            return set()
+        page_cursor.page_done(start_pos, resultset_size, returned=page.results['returned'], elapsed=time.time() - page_started, nbytes=len(page.response))
+        return set(r.identifier for r in page.records.values())
+
+    identifiers = set()
+    for page_identifiers in iter_pages(pool, page_cursor, page_job, max_in_flight=max_in_flight):
+        identifiers.update(page_identifiers)
 
-    return out_records
+    if len(page_cursor.abandoned) > 0:
+        return None
+    return identifiers
 
 
-def search_csw_for_ogc_endpoints(out_path, csw_url, limit_count=0, ogc_srv_type='WMS:GetCapabilties', restrict_wms_layers_to_match=True, test_wms_get_map=True):
+def search_csw_for_ogc_endpoints(out_path, csw_url, limit_count=0, ogc_srv_type='WMS:GetCapabilties', restrict_wms_layers_to_match=True, test_wms_get_map=True, wms_cache=None, caps_store=None, pipeline=None, scheduler=None, journal=None, state=None, record_filters=None, probe_element_set=True):
     limit_count = limit_count
+    # without a run-wide scheduler this CSW gets a pool of its own
+    owns_scheduler = False
+    if scheduler is None:
+        scheduler = HostScheduler(max_workers=10, max_per_host=10)
+        owns_scheduler = True
+    if wms_cache is None:
+        wms_cache = CapabilitiesCache(loader=functools.partial(load_wms, caps_store=caps_store, scheduler=scheduler))
+    # never more than max_per_host pages of this CSW queued / running so the other CSWs get their turn
+    max_in_flight = scheduler.max_per_host
     try:
-        csw = CatalogueServiceWeb(csw_url)
+        csw = HarvestCatalogueServiceWeb(csw_url, store=caps_store, session=pooled_session(max_in_flight), timeout=30)
     # TODO improve caught exception specifity
     except Exception:
         logging.exception("Exception raised when initially instantiating CSW.")
     else:
-        # MaxRecordDefault Constraint under OperationsMetadata indicates maximum number of
-        # records that can be returned per query. It may be obtained using:
-        # resultset_size = int(csw.constraints['MaxRecordDefault'].values[0])
-        # however it is not always available. By default OWSLib getrecords2() has maxrecords=10
-        # so just go with this.
-        resultset_size = 10
-        logging.info('NOT using MaxRecordDefault CSW Constraint. Using default of 10')
+        # page size starts from the MaxRecordDefault CSW Constraint (if advertised, otherwise the OWSLib getrecords2()
+        # default of 10) and then adapts to how quickly / how much the CSW returns
+        page_sizer = PageSizeController.for_csw(csw)
 
+        record_filter = record_filters.constraint(csw_url) if record_filters is not None else None
+        harvest = None
         try:
-            csw.getrecords2(startposition=0)
+            # only need the number of matching records here, not the records themselves
+            csw.getrecords2(resulttype='hits')
+            total_records = csw.results['matches']
+            logging.info('CSW Total Number of Matching Records: %s', str(total_records))
+            if record_filter is not None:
+                # the record filter is tried out on a hits request, a CSW that rejects it is paged through unfiltered
+                try:
+                    csw.getrecords2(constraints=[record_filter], resulttype='hits')
+                # TODO improve caught exception specifity
+                except Exception:
+                    logging.exception("Exception raised when filtering records of CSW.")
+                    record_filters.record(csw_url, total_records, None)
+                    record_filter = None
+                else:
+                    record_filters.record(csw_url, total_records, csw.results['matches'])
+                    total_records = csw.results['matches']
+
+            # records seen are tracked for the harvest state, in an incremental run only those modified since the
+            # last complete harvest of the catalogue are retrieved
+            if state is not None:
+                harvest = state.catalogue(csw_url, record_filter=record_filters.spec(csw_url) if record_filter is not None else None)
+            constraints = and_constraints([record_filter, harvest.modified_since() if harvest is not None else None])
+            num_records = total_records
+            if harvest is not None and harvest.incremental:
+                csw.getrecords2(constraints=constraints, resulttype='hits')
+                num_records = csw.results['matches']
+                logging.info('CSW Number of Records modified since %s: %s', harvest.since, str(num_records))
         # TODO improve caught exception specifity
         except Exception:
             logging.exception("Exception raised when retrieving initial records from CSW.")
         else:
-            num_records = csw.results['matches']
-            logging.info('CSW Total Number of Matching Records: %s', str(num_records))
+            matches = num_records
 
             limited = False
             if limit_count > 0:
                 limited = True
                 if limit_count < num_records:
                     num_records = limit_count
-                if limit_count < resultset_size:
-                    resultset_size = limit_count
 
             logging.info('CSW Records to retrieve: %s', str(num_records))
 
-            # create job list
-            jobs = [[csw_url, start_pos, resultset_size, ogc_srv_type, out_path, restrict_wms_layers_to_match, test_wms_get_map] for start_pos in range(0, num_records, resultset_size)]
-
-            pool = ThreadPoolExecutor(max_workers=10)
-
-            write_header = False
-            if not os.path.exists(os.path.join(out_path, 'wms_layers.csv')):
-                write_header = True
-
-            with open(os.path.join(out_path, 'wms_layers.csv'), 'a') as outpf:
-                my_writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-                out_fields = [
-                    'csw_url',  # 0
-                    'csw_record_identifier',  # 1
-                    'csw_record_publisher',  # 2
-                    'csw_record_title',  # 3
-                    'csw_record_subjects',  # 4
-                    'csw_record_abstract',  # 5
-                    'csw_record_modified',  # 6
-                    'wms_url',  # 7
-                    'wms_url_domain',  # 8
-                    'wms_layer_for_record_title',  # 9
-                    'wms_layer_for_record_name',  # 10
-                    'wms_access_constraints',  # 11
-                    'only_1_choice',  # 12
-                    'match_dist',  # 13
-                    'bbox_wgs84',  # 14
-                    'bbox_projected',  # 15
-                    'wms_get_cap_error',  # 16
-                    'wms_get_map_error',  # 17
-                    'made_get_map_req',  # 18
-                    'image_status',  # 19
-                    'out_image_fname'  # 20
-                ]
-
-                if write_header:
-                    my_writer.writerow(out_fields)
-
-                for job in pool.map(retrieve_and_loop_through_csw_recordset, jobs):
-                    out_recs = job
-                    if len(out_recs) > 0:
-                        for r in out_recs:
-                            my_writer.writerow(r)
-
-
-# TODO need to implement request_projected_layer_extent as alternative to issuing request for WGS84 map
+            # ask for no more of each record than the harvest reads, where the CSW supports that
+            if probe_element_set and num_records > 0:
+                csw.choose_element_set(csw_record_harvest_fields, constraints=constraints)
+
+            # pages completed by an earlier run (if resuming) are not fetched again
+            skip_ranges = None
+            if journal is not None:
+                skip_ranges = journal.completed_ranges(csw_url)
+            page_cursor = PageCursor(num_records, page_sizer, skip_ranges=skip_ranges)
+
+            # the references found in the records are resolved / matched / validated by the pipeline stages, rows
+            # come out of the end of it into wms_layers.csv. Without a run-wide pipeline this CSW gets one of its own
+            owns_pipeline = False
+            if pipeline is None:
+                out_writer = StreamingCsvWriter(os.path.join(out_path, 'wms_layers.csv'), header=WMS_LAYERS_FIELDS)
+                pipeline = build_pipeline(out_writer, wms_cache, out_path, test_wms_get_map=test_wms_get_map, scheduler=scheduler)
+                owns_pipeline = True
+
+            def page_job(start_pos, resultset_size):
+                return retrieve_and_loop_through_csw_recordset([csw_url, start_pos, resultset_size, ogc_srv_type, out_path, restrict_wms_layers_to_match, test_wms_get_map, wms_cache, csw, page_cursor, pipeline, scheduler, journal, harvest, constraints])
+
+            # page jobs are queued against the CSW host on the shared scheduler
+            pool = scheduler.executor(url_host(csw_url))
+
+            try:
+                # pages are consumed as they complete, their references have already been put onto the pipeline
+                references_queued = 0
+                for job in iter_pages(pool, page_cursor, page_job, max_in_flight=max_in_flight):
+                    references_queued += job
+                logging.info('Put %s references from CSW %s onto the pipeline', references_queued, csw_url)
+
+                if harvest is not None:
+                    # only a harvest that paged through every record (modified since) in this run counts as complete
+                    harvest.complete = num_records == matches and len(page_cursor.abandoned) == 0 and len(page_cursor.skip_ranges) == 0
+                    if harvest.needs_listing(total_records):
+                        logging.info('CSW %s has fewer records than when last harvested, listing them to find those that vanished', csw_url)
+                        harvest.present = list_csw_identifiers(csw, total_records, pool, max_in_flight, constraints=and_constraints([record_filter]))
+            finally:
+                if owns_pipeline:
+                    pipeline.close()
+                    pipeline.log_stats()
+                    out_writer.close()
+
+            logging.info('CSW paging: %s', page_sizer.stats())
+
+    if owns_scheduler:
+        scheduler.shutdown()
+
+
 # TODO need to implement request_custom_extent to make request for defined extent rather than whole layer extent
-# TODO need to work out some way of working out a more refined bbox so we avoid
-#  making request for very large e.g. all of world/all of UK etc extents when defaulting to layer extent
 # TODO handle WMS Layer Style
-def test_wms_layer(wms, wms_layer_name, out_path, request_wgs84_layer_extent=True, request_projected_layer_extent=False, request_custom_extent=False, custom_extent_bbox=None):
+def test_wms_layer(wms, wms_layer_name, out_path, request_wgs84_layer_extent=True, request_projected_layer_extent=False, request_custom_extent=False, custom_extent_bbox=None, image_store=None, extent_planner=None, getmap_crs=None):
     """
     Test a WMS layer by making a GetMap request for it and then running image processing validation on the retrieved image
 
@@ -478,8 +696,9 @@ def test_wms_layer(wms, wms_layer_name, out_path, request_wgs84_layer_extent=Tru
     wms_get_cap_error - True/False - WMS GetCapabilties error i.e. OWSLib could not instantiate WMS obj using wms_url
     made_get_map_req - True/False - Made GetMap request. Might be false if bbox problematic
     wms_get_map_error - True/False - WMS GetMap error generated when making WMS GetMap request
-    image_status - string describing state of map image returned from the GetMap request and written to disk
-    out_image_fname - full path to the map image returned from the GetMap request and written to disk
+    image_status - string describing state of map image returned from the GetMap request
+    out_image_fname - full path to the map image returned from the GetMap request and written to disk (named by its
+    content hash so identical images share a file), None if not written
 
     :param wms: OWSLib WebMapService object
     :param wms_layer_name: name of WMS layer to request
@@ -488,6 +707,11 @@ def test_wms_layer(wms, wms_layer_name, out_path, request_wgs84_layer_extent=Tru
     :param request_projected_layer_extent: request map corresponding to entire layer projected bbox, defaults to False
     :param request_custom_extent: request map corresponding to a custom bbox, defaults to False
     :param custom_extent_bbox: custom bbox
+    :param image_store: MapImageStore that validates (and writes) the map image, defaults to one writing to out_path
+    :param extent_planner: optional map_extents.ExtentPlanner picking a smaller extent (and image size) within the layer
+    wgs84 bbox to request
+    :param getmap_crs: optional getmap_crs.GetMapCrs that picks whether the wgs84 or projected extent is requested
+    (overriding request_wgs84_layer_extent / request_projected_layer_extent) and logs the latency of the request
     :return:
     """
     wms = wms
@@ -497,43 +721,44 @@ def test_wms_layer(wms, wms_layer_name, out_path, request_wgs84_layer_extent=Tru
     request_projected_layer_extent = request_projected_layer_extent
     request_custom_extent = request_custom_extent
     custom_extent_bbox = custom_extent_bbox
+    if image_store is None:
+        image_store = MapImageStore(out_path)
     wms_get_map_error = False
     made_get_map_req = False
     image_status = None
     out_image_fname = None
 
+    if getmap_crs is not None and wms_layer_name in wms.contents:
+        # which of the wgs84 / projected extent requests is made is picked per layer
+        request_projected_layer_extent = getmap_crs.choose_mode(wms, wms_layer_name) == MODE_NATIVE
+        request_wgs84_layer_extent = not request_projected_layer_extent
+
     if request_wgs84_layer_extent:
         logging.info('Requested to test GetMap for Layer {0} WGS84 BBox'.format(wms_layer_name))
-        if wms_layer_name in list(wms.contents):
+        if wms_layer_name in wms.contents:
             wms_layer_bbox = wms.contents[wms_layer_name].boundingBoxWGS84
-            try:
-                img = wms.getmap(
-                    layers=[wms_layer_name],
-                    srs='EPSG:4326',
-                    bbox=wms_layer_bbox,
-                    size=(400, 400),
-                    format='image/png'
-                )
-            # TODO improve caught exception specifity
-            except Exception:
-                logging.exception("Exception raised when making WMS GetMap Request.")
-                wms_get_map_error = True
-            else:
-                made_get_map_req = True
-                logging.info('GetMap request made OK')
-                logging.info('Writing map to temp image')
-                out_image_fname = os.path.join(
-                    out_path,
-                    "".join([str(uuid.uuid1().int), "_wms_map.png"])
-                )
-                with open(out_image_fname, 'wb') as outpf:
-                    outpf.write(img.read())
-
-                if os.path.exists(out_image_fname):
-                    image_status = check_wms_map_image(out_image_fname)
+            size = (400, 400)
+            if extent_planner is not None:
+                request_extent = extent_planner.request_extent(wms, wms_layer_name)
+                if request_extent is not None:
+                    wms_layer_bbox, size = request_extent
+            wms_get_map_error, made_get_map_req, image_status, out_image_fname = getmap_layer(
+                wms, wms_layer_name, WGS84, wms_layer_bbox, size, image_store, getmap_crs=getmap_crs, mode=MODE_WGS84
+            )
 
     if request_projected_layer_extent:
-        pass
+        logging.info('Requested to test GetMap for Layer {0} projected BBox'.format(wms_layer_name))
+        if wms_layer_name in wms.contents:
+            if getmap_crs is None:
+                getmap_crs = GetMapCrs(MODE_NATIVE, extent_planner=extent_planner)
+            native_request = getmap_crs.native_request(wms, wms_layer_name)
+            if native_request is None:
+                logging.info('Layer {0} has no projected BBox'.format(wms_layer_name))
+            else:
+                crs, wms_layer_bbox, size = native_request
+                wms_get_map_error, made_get_map_req, image_status, out_image_fname = getmap_layer(
+                    wms, wms_layer_name, crs, wms_layer_bbox, size, image_store, getmap_crs=getmap_crs, mode=MODE_NATIVE
+                )
 
     if request_custom_extent:
         if custom_extent_bbox is not None:
@@ -544,6 +769,48 @@ def test_wms_layer(wms, wms_layer_name, out_path, request_wgs84_layer_extent=Tru
     return wms_get_map_error, made_get_map_req, image_status, out_image_fname
 
 
+def getmap_layer(wms, wms_layer_name, srs, bbox, size, image_store, getmap_crs=None, mode=MODE_WGS84):
+    """
+    make a GetMap request for a WMS layer and validate the image, timing the request
+
+    :param srs: crs of the request i.e. EPSG:4326
+    :param bbox: (minx, miny, maxx, maxy) in srs, x / y order
+    :param size: (width, height)
+    :param image_store: MapImageStore that validates (and writes) the map image
+    :param getmap_crs: optional GetMapCrs to record the latency of the request with
+    :param mode: MODE_WGS84 or MODE_NATIVE, the mode of the request
+    :return: wms_get_map_error, made_get_map_req, image_status, out_image_fname
+    """
+    wms_get_map_error = False
+    made_get_map_req = False
+    image_status = None
+    out_image_fname = None
+    img_bytes = None
+    started = time.time()
+    try:
+        img = wms.getmap(
+            layers=[wms_layer_name],
+            srs=srs,
+            bbox=bbox,
+            size=size,
+            format='image/png'
+        )
+        img_bytes = img.read()
+    # TODO improve caught exception specifity
+    except Exception:
+        logging.exception("Exception raised when making WMS GetMap Request.")
+        wms_get_map_error = True
+    seconds = time.time() - started
+
+    if getmap_crs is not None:
+        getmap_crs.record(wms, wms_layer_name, mode, srs, size, seconds, len(img_bytes) if img_bytes is not None else None, wms_get_map_error)
+    if not wms_get_map_error:
+        made_get_map_req = True
+        logging.info('GetMap request made OK')
+        image_status, out_image_fname = image_store.check(img_bytes)
+    return wms_get_map_error, made_get_map_req, image_status, out_image_fname
+
+
 def tidy(path, skip_files=None):
     """
     purge all items in a folder
@@ -577,7 +844,35 @@ def tidy(path, skip_files=None):
 @click.option('-log_level', default='debug', type=click.Choice(['debug', 'info']), help='Log Level')
 @click.option('-createReport', 'create_report', default='y', type=click.Choice(['y', 'n']), help='Generate an HTML report')
 @click.option('-geocoder_db_conn_str', type=str, help='(Geocoder) Pg connection string for db holding Natural Earth World Map Units polygons')
+@click.option('-geocoder_file', type=click.Path(exists=True, dir_okay=False), help='(Geocoder) GeoJSON of the Natural Earth World Map Units polygons to geocode with offline, in place of -geocoder_db_conn_str')
+@click.option('-output_format', 'output_formats', multiple=True, type=click.Choice(sorted(OUTPUT_FORMATS)), help='Also write the harvested rows as JSON Lines / SQLite alongside wms_layers.csv (can be given more than once)')
+@click.option('-catalogue', default='n', type=click.Choice(['y', 'n']), help='Write the harvested rows into the searchable catalogue store as the harvest goes (see catalogue_store.py)')
+@click.option('-catalogue_store', 'catalogue_fname', default=DEFAULT_CATALOGUE_PATH, type=click.Path(dir_okay=False), help='SQLite catalogue store kept between runs (must be outside out_path)')
+@click.option('-load_db_conn_str', type=str, help='Pg connection string for db holding discovery.wms_layers to load (upsert) the harvested rows into')
+@click.option('-load_batch_size', default=10000, type=int, help='Rows loaded into discovery.wms_layers per COPY / transaction')
 @click.option('-test_wms_get_map', default='y', type=click.Choice(['y', 'n']), help='Issue GetMap req to WMS Layers & valiadate image')
+@click.option('-getmap_extent', default='layer', type=click.Choice(['layer', 'planned']), help='Request GetMap images of the whole layer wgs84 bbox, or of a smaller extent planned within it (see -getmap_regions / -getmap_max_span)')
+@click.option('-getmap_regions', type=str, help='(planned GetMap extent) Region set ({0}) or JSON file of region name -> [minx, miny, maxx, maxy] in wgs84 that whole world extents, and those covering a region, are clipped to'.format(', '.join(sorted(REGION_SETS))))
+@click.option('-getmap_max_span', default=2.0, type=float, help='(planned GetMap extent) Max width / height in degrees of a GetMap request extent')
+@click.option('-getmap_crs', 'getmap_crs_mode', default=MODE_WGS84, type=click.Choice([MODE_WGS84, MODE_NATIVE, MODE_FASTEST]), help='Request GetMap images in EPSG:4326, in the crs of each layer`s projected bbox, or in whichever of the two each WMS serves fastest. Request latencies are logged to getmap_latency.csv')
+@click.option('-write_map_images', default='y', type=click.Choice(['y', 'n']), help='Write GetMap images to out_path (they are validated in memory either way)')
+@click.option('-image_signatures', 'image_signatures_fname', default=DEFAULT_SIGNATURES_PATH, type=click.Path(), help='File of known blank / error GetMap image signatures (must be outside out_path)')
+@click.option('-max_workers', default=20, type=int, help='Number of worker threads paging through all CSWs (record discovery stage)')
+@click.option('-max_per_host', default=4, type=int, help='Max concurrent requests to any one CSW / WMS host')
+@click.option('-resolve_workers', default=8, type=int, help='Threads fetching WMS GetCapabilities (endpoint resolution stage)')
+@click.option('-match_workers', default=2, type=int, help='Threads matching CSW record titles to WMS layers (layer matching stage)')
+@click.option('-validate_workers', default=8, type=int, help='Threads making and checking GetMap requests (map validation stage)')
+@click.option('-stage_queue_size', default=1000, type=int, help='Max references queued at each pipeline stage')
+@click.option('-capabilities_store', 'caps_store_path', default=DEFAULT_STORE_PATH, type=click.Path(), help='Path to persistent store of GetCapabilities docs (must be outside out_path)')
+@click.option('-capabilities_ttl', 'caps_ttl', default=24.0, type=float, help='Hours before a stored GetCapabilities doc is revalidated with the server')
+@click.option('-capabilities_store_max_mb', 'caps_store_max_mb', default=512, type=int, help='Size cap of the GetCapabilities store in MB')
+@click.option('-record_filter', type=str, help='OGC Filter on the CSW records retrieved, [property=]pattern i.e. %WMS% (csw:AnyText like %WMS%). Can be set per CSW in a record_filter column of -csv_file')
+@click.option('-probe_element_set', default='y', type=click.Choice(['y', 'n']), help='Probe each CSW for the smallest element set holding the record fields harvested')
+@click.option('-incremental', default='n', type=click.Choice(['y', 'n']), help='Only harvest CSW records modified since the last complete harvest of each CSW and merge them into its results')
+@click.option('-harvest_state', 'harvest_state_path', default=DEFAULT_STATE_PATH, type=click.Path(), help='Path to per CSW state of the last complete harvest (must be outside out_path)')
+@click.option('-resume', default='n', type=click.Choice(['y', 'n']), help='Carry on from an interrupted run in out_path rather than starting afresh')
+@click.option('-engine', default='threads', type=click.Choice(['threads', 'asyncio']), help='Run the harvest on a thread pool or an asyncio event loop')
+@click.option('-max_in_flight', default=1000, type=int, help='(asyncio engine) Max concurrent requests overall')
 def wms_layer_finder(**params):
     """Searching CSW(s) for WMS layers. Using WMS Version 1.3.0. Using WGS84 BBox to test WMS returns map image."""
     csv_file = params['csv_file']
@@ -587,8 +882,37 @@ def wms_layer_finder(**params):
     log_level = params['log_level']
     create_report = params['create_report']
     geocoder_db_conn_str = params['geocoder_db_conn_str']
+    geocoder_file = params['geocoder_file']
+    output_formats = params['output_formats']
+    catalogue = params['catalogue'] == 'y'
+    catalogue_fname = params['catalogue_fname']
+    load_db_conn_str = params['load_db_conn_str']
+    load_batch_size = params['load_batch_size']
     test_wms_get_map = params['test_wms_get_map']
+    getmap_extent = params['getmap_extent']
+    getmap_regions = params['getmap_regions']
+    getmap_max_span = params['getmap_max_span']
+    getmap_crs_mode = params['getmap_crs_mode']
+    write_map_images = params['write_map_images'] == 'y'
+    image_signatures_fname = params['image_signatures_fname']
+    caps_store_path = params['caps_store_path']
+    caps_ttl = params['caps_ttl']
+    caps_store_max_mb = params['caps_store_max_mb']
+    max_workers = params['max_workers']
+    max_per_host = params['max_per_host']
+    engine = params['engine']
+    resume = params['resume'] == 'y'
+    incremental = params['incremental'] == 'y'
+    harvest_state_path = params['harvest_state_path']
+    record_filter = params['record_filter']
+    probe_element_set = params['probe_element_set'] == 'y'
+    resolve_workers = params['resolve_workers']
+    match_workers = params['match_workers']
+    validate_workers = params['validate_workers']
+    stage_queue_size = params['stage_queue_size']
+    max_in_flight = params['max_in_flight']
     csw_list = []
+    record_filter_specs = {}
 
     if log_level == 'debug':
         print('csw_url: ', csw_url)
@@ -598,13 +922,48 @@ def wms_layer_finder(**params):
         print('log_level: ', log_level)
         print('create_report: ', create_report)
         print('geocoder_db_conn_str: ', geocoder_db_conn_str)
+        print('geocoder_file: ', geocoder_file)
+        print('capabilities_store: ', caps_store_path)
+        print('catalogue_store: ', catalogue_fname if catalogue else None)
+        print('engine: ', engine)
+        print('getmap_extent: ', getmap_extent)
+        print('getmap_crs: ', getmap_crs_mode)
+        print('resume: ', resume)
+        print('incremental: ', incremental)
+        print('record_filter: ', record_filter)
+
+    # the capabilities store, image signatures, harvest state and catalogue store have to survive tidy(out_path) below
+    if os.path.commonpath([os.path.abspath(caps_store_path), os.path.abspath(out_path)]) == os.path.abspath(out_path):
+        raise click.BadParameter('must not be inside out_path', param_hint='-capabilities_store')
+    if os.path.commonpath([os.path.abspath(image_signatures_fname), os.path.abspath(out_path)]) == os.path.abspath(out_path):
+        raise click.BadParameter('must not be inside out_path', param_hint='-image_signatures')
+    if os.path.commonpath([os.path.abspath(harvest_state_path), os.path.abspath(out_path)]) == os.path.abspath(out_path):
+        raise click.BadParameter('must not be inside out_path', param_hint='-harvest_state')
+    if catalogue and os.path.commonpath([os.path.abspath(catalogue_fname), os.path.abspath(out_path)]) == os.path.abspath(out_path):
+        raise click.BadParameter('must not be inside out_path', param_hint='-catalogue_store')
+
+    extent_planner = None
+    if getmap_extent == 'planned':
+        regions = None
+        if getmap_regions is not None:
+            try:
+                regions = load_regions(getmap_regions)
+            except ValueError as ex:
+                raise click.BadParameter(str(ex), param_hint='-getmap_regions')
+        extent_planner = ExtentPlanner(regions=regions, max_span=getmap_max_span)
 
     if csv_file is not None:
         with open(csv_file, 'r') as input_file:
             my_reader = csv.DictReader(input_file)
             for r in my_reader:
                 csw_list.append(r['url'])
+                # optional per CSW record filter, blank for the -record_filter default or none for no filter
+                if r.get('record_filter') is not None:
+                    record_filter_specs[r['url']] = r['record_filter']
         print('Found {} CSWs in specified CSV file'.format(str(len(csw_list))))
+        if len(csw_list) == 0:
+            print('Nothing to harvest')
+            return
     else:
         print('Searching single CSW')
         csw_list.append(csw_url)
@@ -614,8 +973,10 @@ def wms_layer_finder(**params):
     else:
         print('Limiting search to {} records in each CSW'.format(str(search_limit)))
 
-    # first purge all files currently in the out_path folder so we start from afresh
-    tidy(out_path)
+    # first purge all files currently in the out_path folder so we start from afresh, unless carrying on from an
+    # interrupted run
+    if not resume:
+        tidy(out_path)
 
     # setup logging
     logging_level = None
@@ -626,7 +987,7 @@ def wms_layer_finder(**params):
 
     logging.basicConfig(
         filename=os.path.join(out_path, 'mapcatalog.log'),
-        filemode='w',
+        filemode='a' if resume else 'w',
         format='%(asctime)s - %(name)s - %(levelname)s - %(threadName)s - %(funcName)s - %(lineno)d - %(message)s',
         level=logging_level
     )
@@ -634,7 +995,10 @@ def wms_layer_finder(**params):
     logging.info('Starting')
 
     have_geocoder = False
-    if geocoder_db_conn_str is not None:
+    if geocoder_file is not None:
+        have_geocoder = True
+        logging.info('Have offline geocoder(Natural Earth)')
+    elif geocoder_db_conn_str is not None:
         have_geocoder = True
         logging.info('Have Pg geocoder(Natural Earth)')
 
@@ -645,18 +1009,213 @@ def wms_layer_finder(**params):
 
     if log_level == 'debug':
         print('test_wms_get_map:', test_wms_get_map)
+        print('write_map_images:', write_map_images)
+
+    # raw GetCapabilities docs are kept between runs and only re-downloaded when they have changed
+    caps_store = CapabilitiesStore(
+        store_path=caps_store_path,
+        ttl=caps_ttl * 3600.0,
+        max_bytes=caps_store_max_mb * 1024 * 1024
+    )
+
+    # completed pages are journaled so an interrupted run can be resumed. When resuming this reads the earlier
+    # journal and the rows already in wms_layers.csv, before the writer starts appending to it
+    journal = RunJournal(out_path, resume=resume, rows_fname=os.path.join(out_path, 'wms_layers.csv'))
 
-    # go through each CSW in turn and search for records that have associated OGC endpoints
-    for csw_url in csw_list:
-        print('Searching CSW: ', csw_url)
-        logging.info('CSW to search is: %s', csw_url)
-        search_csw_for_ogc_endpoints(
+    # one writer streams rows from all CSWs into wms_layers.csv, and into the catalogue store as they come
+    if catalogue:
+        out_writer = StreamingWriter(TeeSink([
+            CsvSink(os.path.join(out_path, 'wms_layers.csv'), header=WMS_LAYERS_FIELDS),
+            CatalogueStore(catalogue_fname)
+        ]))
+    else:
+        out_writer = StreamingCsvWriter(os.path.join(out_path, 'wms_layers.csv'), header=WMS_LAYERS_FIELDS)
+    journal.out_writer = out_writer
+
+    # the records seen in each CSW are tracked so the next run can be incremental, in an incremental run the rows
+    # written are merged into those of earlier runs at the end
+    state = HarvestState(harvest_state_path, incremental=incremental)
+
+    # records that cannot reference an OGC service are filtered out by the CSW where it will do so
+    record_filters = RecordFilters(default_spec=record_filter, specs=record_filter_specs)
+
+    # GetMap images are stored by content hash, blank / error images seen in earlier runs are known on sight
+    image_store = MapImageStore(out_path, signatures_fname=image_signatures_fname, write_images=write_map_images)
+
+    # picks the crs of each GetMap request and logs how long each one takes
+    getmap_crs = None
+    if test_wms_get_map:
+        getmap_crs = GetMapCrs(mode=getmap_crs_mode, out_path=out_path, extent_planner=extent_planner)
+
+    if engine == 'asyncio':
+        # imported here so that aiohttp is only needed by the asyncio engine
+        from async_harvester import harvest
+
+        harvester = harvest(
+            csw_list,
             out_path=out_path,
-            csw_url=csw_url,
+            out_writer=out_writer,
+            caps_store=caps_store,
             limit_count=search_limit,
             ogc_srv_type='WMS:GetCapabilties',
-            test_wms_get_map=test_wms_get_map
+            test_wms_get_map=test_wms_get_map,
+            image_store=image_store,
+            journal=journal,
+            state=state,
+            record_filters=record_filters,
+            probe_element_set=probe_element_set,
+            max_in_flight=max_in_flight,
+            max_per_host=max_per_host,
+            extent_planner=extent_planner,
+            getmap_crs=getmap_crs
         )
+        out_writer.close()
+        logging.info('Wrote %s rows to wms_layers.csv', out_writer.rows_written)
+        if log_level == 'debug':
+            print('Async harvest: ', harvester.stats())
+    else:
+        # one pool of record discovery workers is shared by all the CSWs with requests capped per host
+        scheduler = HostScheduler(max_workers=max_workers, max_per_host=max_per_host)
+
+        # WMS GetCapabilities docs are cached for the whole run, CSWs frequently share WMS endpoints
+        wms_cache = CapabilitiesCache(loader=functools.partial(load_wms, caps_store=caps_store, scheduler=scheduler))
+
+        # the references discovered in all the CSWs flow through one set of pipeline stages, each with its own
+        # queue and pool of workers
+        pipeline = build_pipeline(
+            out_writer,
+            wms_cache,
+            out_path,
+            test_wms_get_map=test_wms_get_map,
+            image_store=image_store,
+            scheduler=scheduler,
+            resolve_workers=resolve_workers,
+            match_workers=match_workers,
+            validate_workers=validate_workers,
+            max_queued=stage_queue_size,
+            extent_planner=extent_planner,
+            getmap_crs=getmap_crs
+        )
+
+        def search_csw(csw_url):
+            print('Searching CSW: ', csw_url)
+            logging.info('CSW to search is: %s', csw_url)
+            search_csw_for_ogc_endpoints(
+                out_path=out_path,
+                csw_url=csw_url,
+                limit_count=search_limit,
+                ogc_srv_type='WMS:GetCapabilties',
+                test_wms_get_map=test_wms_get_map,
+                wms_cache=wms_cache,
+                caps_store=caps_store,
+                pipeline=pipeline,
+                scheduler=scheduler,
+                journal=journal,
+                state=state,
+                record_filters=record_filters,
+                probe_element_set=probe_element_set
+            )
+
+        # search the CSWs for records that have associated OGC endpoints at once. Each CSW (up to max_workers at a time)
+        # gets a (lightweight) thread that feeds its pages to the shared scheduler, which interleaves the work from all
+        # of them
+        with ThreadPoolExecutor(max_workers=max(1, min(len(csw_list), max_workers)), thread_name_prefix='CSW') as csw_pool:
+            for csw_url, searched in zip(csw_list, csw_pool.map(search_csw, csw_list)):
+                logging.info('Finished searching CSW: %s', csw_url)
+
+        # discovery is done once all the CSWs have been searched, then wait for the pipeline to drain
+        scheduler.shutdown()
+        pipeline.close()
+        out_writer.close()
+        logging.info('Wrote %s rows to wms_layers.csv', out_writer.rows_written)
+
+        pipeline.log_stats()
+        wms_cache.log_stats()
+        if log_level == 'debug':
+            print('Pipeline: ', pipeline.stats())
+            print('WMS capabilities cache: ', wms_cache.stats())
+
+    state.merge(os.path.join(out_path, 'wms_layers.csv'), os.path.join(out_path, CHANGES_FNAME))
+    if catalogue:
+        # rows of records that have gone, or no longer reference a WMS, are only known once merged
+        try:
+            catalogue_store = CatalogueStore(catalogue_fname)
+            try:
+                catalogue_store.apply_changes(os.path.join(out_path, 'wms_layers.csv'), os.path.join(out_path, CHANGES_FNAME))
+            finally:
+                catalogue_store.close()
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception('Could not remove the rows of updated / vanished records from %s', catalogue_fname)
+    record_filters.log_stats()
+    if log_level == 'debug':
+        print('Record filters: ', record_filters.stats())
+
+    # the layer extents are indexed once merged, see extent_index.py to query them
+    try:
+        build_extent_index(out_path)
+    # TODO improve caught exception specifity
+    except Exception:
+        logging.exception('Could not build the extent index of wms_layers.csv')
+
+    if have_geocoder:
+        # the layers are geocoded in batches once the run is done, layers sharing a bbox are only geocoded once
+        geocoder = None
+        try:
+            # the offline geocoder is used in place of the db if both are given
+            if geocoder_file is not None:
+                geocoder = reverse_geocoder(fname=geocoder_file)
+            else:
+                geocoder = reverse_geocoder(pg_conn_str=geocoder_db_conn_str)
+            geocode_wms_layers(geocoder, os.path.join(out_path, 'wms_layers.csv'), os.path.join(out_path, GEOGRAPHIES_FNAME))
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception('Could not geocode WMS layers using provided geocoder_db_conn_str / geocoder_file')
+        if geocoder is not None:
+            geocoder.log_stats()
+            if log_level == 'debug':
+                print('Reverse geocoder: ', geocoder.stats())
+
+    if load_db_conn_str is not None:
+        # loaded once merged so an incremental run leaves the table covering the whole of each catalogue
+        try:
+            loader = load_wms_layers(
+                load_db_conn_str,
+                out_path,
+                changes_fname=os.path.join(out_path, CHANGES_FNAME),
+                batch_size=load_batch_size
+            )
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception('Could not load wms_layers.csv into discovery.wms_layers using provided load_db_conn_str')
+        else:
+            if log_level == 'debug':
+                print('PostGIS load: ', loader.stats())
+
+    if len(output_formats) > 0:
+        # written from the final (merged) wms_layers.csv so every output holds the same rows
+        n = export_records(os.path.join(out_path, 'wms_layers.csv'), [open_sink(f, out_path) for f in output_formats])
+        logging.info('Wrote %s rows as %s', n, ', '.join(output_formats))
+
+    if extent_planner is not None:
+        extent_planner.log_stats()
+        if log_level == 'debug':
+            print('GetMap extent planner: ', extent_planner.stats())
+    if getmap_crs is not None:
+        getmap_crs.close()
+        getmap_crs.log_stats()
+        if log_level == 'debug':
+            print('GetMap crs: ', getmap_crs.stats())
+
+    journal.close()
+    logging.info('Run journal: %s', journal.stats())
+    image_store.save_signatures()
+    image_store.log_stats()
+    caps_store.log_stats()
+    if log_level == 'debug':
+        print('Map images: ', image_store.stats())
+        print('Capabilities store: ', caps_store.stats())
+    caps_store.close()
 
     if create_report == 'y':
         # generate HTML report
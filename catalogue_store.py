@@ -0,0 +1,226 @@
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import time
+import click
+
+from harvest_record import WMS_LAYERS_FIELDS
+from harvest_state import CHANGE_UPDATED, CHANGE_VANISHED, read_rows
+from map_images import IMAGE_BACKGROUND, IMAGE_INVALID, IMAGE_NO_SIZE, IMAGE_POPULATED
+from output_writer import SQLITE_COLUMNS, sqlite_record, sqlite_values, SqliteSink
+
+
+DEFAULT_CATALOGUE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mapcatalogue', 'catalogue.sqlite')
+
+# fields identifying a layer of the catalogue, the upsert key
+KEY_FIELDS = ('csw_url', 'csw_record_identifier', 'wms_url')
+
+# fields of the full text index
+FTS_FIELDS = ('csw_record_title', 'csw_record_abstract', 'csw_record_subjects')
+
+# fields with a secondary index
+INDEXED_FIELDS = ('wms_url_domain', 'image_status', 'match_dist')
+
+# short names of the image_status values, for the query command
+IMAGE_STATUSES = {
+    'populated': IMAGE_POPULATED,
+    'background': IMAGE_BACKGROUND,
+    'nosize': IMAGE_NO_SIZE,
+    'invalid': IMAGE_INVALID
+}
+
+
+class CatalogueStore(SqliteSink):
+    """
+    Embedded SQLite catalogue of the harvested layers that survives between harvest runs, written as the harvest goes
+    (in commit_every row transactions) alongside wms_layers.csv.
+
+    Rows are upserted on (csw_url, csw_record_identifier, wms_url) so the store holds one row per record / WMS however
+    many runs (incremental or not) are written into it, rows that have not changed are left untouched. The record
+    title, abstract and subjects are full text indexed (an FTS5 external content table kept in step by triggers,
+    porter stemmed so flooding finds flood and floods) and wms_url_domain, image_status and match_dist have b-tree
+    indexes, so search() over millions of rows takes milliseconds.
+
+    The db is in WAL mode so it can be searched while a harvest is writing to it. This should NOT live under the
+    harvest out_path since tidy() purges that at the start of every run.
+    """
+    def __init__(self, fname=DEFAULT_CATALOGUE_PATH, commit_every=1000):
+        """
+        :param fname: SQLite db file, created if it does not exist
+        :param commit_every: rows per transaction
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        super().__init__(fname, commit_every=commit_every)
+
+    def _create_tables(self):
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS layers ({0}, UNIQUE ({1}))'.format(
+                ', '.join('{0} {1}'.format(c, t) for c, t in SQLITE_COLUMNS), ', '.join(KEY_FIELDS)
+            ))
+            for f in INDEXED_FIELDS:
+                self._conn.execute('CREATE INDEX IF NOT EXISTS layers_{0}_idx ON layers ({0})'.format(f))
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS layers_fts USING fts5({0}, content='layers', content_rowid='rowid', "
+                "tokenize='porter unicode61')".format(', '.join(FTS_FIELDS))
+            )
+            # keep the external content FTS index in step with the layers table
+            fts_columns = ', '.join(FTS_FIELDS)
+            new_values = ', '.join('new.' + f for f in FTS_FIELDS)
+            old_values = ', '.join('old.' + f for f in FTS_FIELDS)
+            self._conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS layers_ai AFTER INSERT ON layers BEGIN
+                INSERT INTO layers_fts (rowid, {columns}) VALUES (new.rowid, {new});
+            END;
+            CREATE TRIGGER IF NOT EXISTS layers_ad AFTER DELETE ON layers BEGIN
+                INSERT INTO layers_fts (layers_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old});
+            END;
+            CREATE TRIGGER IF NOT EXISTS layers_au AFTER UPDATE ON layers BEGIN
+                INSERT INTO layers_fts (layers_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old});
+                INSERT INTO layers_fts (rowid, {columns}) VALUES (new.rowid, {new});
+            END;
+            """.format(columns=fts_columns, new=new_values, old=old_values))
+
+    def _insert_statement(self):
+        columns = [c for c, _ in SQLITE_COLUMNS]
+        updated = [c for c in columns if c not in KEY_FIELDS]
+        return """
+        INSERT INTO layers ({columns}) VALUES ({params})
+        ON CONFLICT ({key}) DO UPDATE SET ({updated}) = ({excluded})
+        WHERE ({updated}) IS NOT ({excluded})
+        """.format(
+            columns=', '.join(columns),
+            params=', '.join('?' * len(columns)),
+            key=', '.join(KEY_FIELDS),
+            updated=', '.join(updated),
+            excluded=', '.join('excluded.' + c for c in updated)
+        )
+
+    def write(self, record):
+        values = list(sqlite_values(record))
+        # NULLs are never equal so would never match the upsert key, a missing key value is stored as ''
+        for i, (c, _) in enumerate(SQLITE_COLUMNS):
+            if c in KEY_FIELDS and values[i] is None:
+                values[i] = ''
+        self._pending.append(values)
+        if len(self._pending) >= self.commit_every:
+            self.flush()
+
+    def apply_changes(self, rows_fname, changes_fname):
+        """
+        delete the rows of records that have vanished from their CSW, and those of updated records for WMSs they no
+        longer reference
+
+        :param rows_fname: the (merged) wms_layers.csv of the run
+        :param changes_fname: record_changes.csv of the run
+        :return: number of rows deleted
+        """
+        header, changes = read_rows(changes_fname)
+        if header is None:
+            return 0
+        changed = set(
+            (r[header.index('csw_url')], r[header.index('csw_record_identifier')] or '') for r in changes
+            if r[header.index('change')] in (CHANGE_UPDATED, CHANGE_VANISHED)
+        )
+        if len(changed) == 0:
+            return 0
+
+        header, rows = read_rows(rows_fname)
+        current = set()
+        if header is not None:
+            key_is = [header.index(f) for f in KEY_FIELDS]
+            current = set(tuple(r[i] or '' for i in key_is) for r in rows)
+
+        self.flush()
+        select_sql = 'SELECT {0} FROM layers WHERE csw_url = ? AND csw_record_identifier = ?'.format(', '.join(KEY_FIELDS))
+        stale = [k for record in changed for k in self._conn.execute(select_sql, record).fetchall() if k not in current]
+        with self._conn:
+            self._conn.executemany(
+                'DELETE FROM layers WHERE {0}'.format(' AND '.join('{0} = ?'.format(f) for f in KEY_FIELDS)), stale
+            )
+        logging.info('Deleted %s rows of updated / vanished records from %s', len(stale), self.fname)
+        return len(stale)
+
+
+def search(fname, text=None, image_status=None, domain=None, max_match_dist=None, rank=False, limit=100):
+    """
+    search a CatalogueStore
+
+    :param fname: SQLite db file of the CatalogueStore
+    :param text: FTS5 query over the record titles, abstracts and subjects i.e. flooding or "flood risk" OR inundation
+    :param image_status: only layers whose GetMap image had this image_status
+    :param domain: only layers of WMSs in this wms_url_domain
+    :param max_match_dist: only layers matched to their record with at most this distance
+    :param rank: order text matches best first. Every match is then scored before the first is returned, which takes
+    a while for terms common to much of the store, unranked the first limit matches are returned as they are found
+    :param limit: max layers returned, 0 for no limit
+    :return: list of HarvestRecords
+    """
+    where = []
+    params = []
+    if text is not None:
+        sql = 'SELECT l.* FROM layers_fts JOIN layers l ON l.rowid = layers_fts.rowid'
+        where.append('layers_fts MATCH ?')
+        params.append(text)
+        order_by = 'layers_fts.rank' if rank else None
+    else:
+        sql = 'SELECT l.* FROM layers l'
+        order_by = None
+    if image_status is not None:
+        where.append('l.image_status = ?')
+        params.append(image_status)
+    if domain is not None:
+        where.append('l.wms_url_domain = ?')
+        params.append(domain)
+    if max_match_dist is not None:
+        where.append('l.match_dist <= ?')
+        params.append(max_match_dist)
+    if len(where) > 0:
+        sql += ' WHERE ' + ' AND '.join(where)
+    if order_by is not None:
+        sql += ' ORDER BY ' + order_by
+    if limit > 0:
+        sql += ' LIMIT ?'
+        params.append(limit)
+
+    conn = sqlite3.connect('file:{0}?mode=ro'.format(fname), uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [sqlite_record(r) for r in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+@click.command()
+@click.option('-store', 'store_fname', default=DEFAULT_CATALOGUE_PATH, type=click.Path(exists=True, dir_okay=False), help='Catalogue store written by the harvest (-catalogue_store)')
+@click.option('-text', type=str, help='Full text query over the record titles, abstracts and subjects i.e. flooding or "flood risk" OR inundation')
+@click.option('-image_status', type=click.Choice(sorted(IMAGE_STATUSES)), help='Only layers whose GetMap image was of this status')
+@click.option('-domain', type=str, help='Only layers of WMSs in this domain')
+@click.option('-max_match_dist', type=float, help='Only layers matched to their CSW record title with at most this distance')
+@click.option('-rank', default='n', type=click.Choice(['y', 'n']), help='List the best -text matches first (slower for common terms)')
+@click.option('-limit', default=100, type=int, help='Max layers listed, 0 for no limit')
+def query_catalogue(**params):
+    """Search the catalogue store for WMS layers. Writes the matching layers to stdout as wms_layers.csv rows."""
+    started = time.time()
+    records = search(
+        params['store_fname'],
+        text=params['text'],
+        image_status=IMAGE_STATUSES.get(params['image_status']),
+        domain=params['domain'],
+        max_match_dist=params['max_match_dist'],
+        rank=params['rank'] == 'y',
+        limit=params['limit']
+    )
+    took = time.time() - started
+
+    writer = csv.writer(sys.stdout, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(WMS_LAYERS_FIELDS)
+    for record in records:
+        writer.writerow(record.as_row())
+    click.echo('Found {0} layers in {1:.1f}ms'.format(len(records), took * 1000.0), err=True)
+
+
+if __name__ == "__main__":
+    query_catalogue()
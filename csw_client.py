@@ -0,0 +1,292 @@
+import copy
+from io import BytesIO
+import logging
+from urllib.parse import parse_qsl, urlsplit
+from owslib import ows
+from owslib import util
+from owslib.csw import CatalogueServiceWeb, namespaces
+from owslib.etree import etree
+from owslib.util import add_namespaces, bind_url, cleanup_namespaces, http_post, openURL
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# root elements of the responses a CSW may legitimately send back
+CSW_RESPONSE_ROOTS = [
+    util.nspath_eval(p, namespaces) for p in [
+        'ows:ExceptionReport',
+        'csw:Capabilities',
+        'csw:DescribeRecordResponse',
+        'csw:GetDomainResponse',
+        'csw:GetRecordsResponse',
+        'csw:GetRecordByIdResponse',
+        'csw:HarvestResponse',
+        'csw:TransactionResponse'
+    ]
+]
+
+
+# ElementSetName that HarvestCatalogueServiceWeb sends as a csw:ElementName per property of element_names instead
+ELEMENT_NAMES = 'elementnames'
+
+# record properties read by the harvest
+HARVEST_ELEMENT_NAMES = [
+    'dc:identifier',
+    'dc:title',
+    'dc:publisher',
+    'dc:subject',
+    'dct:abstract',
+    'dct:modified',
+    'dct:references'
+]
+
+
+def pooled_session(max_workers):
+    """
+    requests Session whose keep-alive connection pool is big enough for max_workers threads to share it
+
+    :param max_workers: number of threads that will issue requests through the session concurrently
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _CapturedRequest(Exception):
+    def __init__(self, request_url, request):
+        super().__init__(request_url)
+        self.request_url = request_url
+        self.request = request
+
+
+def _capture_post(request_url, request):
+    raise _CapturedRequest(request_url, request)
+
+
+class HarvestCatalogueServiceWeb(CatalogueServiceWeb):
+    """
+    OWSLib CatalogueServiceWeb that lets the harvester control how requests reach the server. The GetCapabilities
+    document is read through a CapabilitiesStore (if supplied) so that it is only downloaded again when it has
+    changed, and GetRecords requests are POSTed over a shared keep-alive session (if supplied) rather than a new
+    connection per request.
+
+    The capabilities are parsed once when the client is created; use getrecords_page() to page through the
+    catalogue from many threads with that one client.
+
+    record_esn is the element set the harvest pages through the catalogue with, choose_element_set() narrows it down
+    to the smallest one that still carries every field the harvest reads. Besides the standard element sets it may
+    be ELEMENT_NAMES, where GetRecords asks for just the element_names properties.
+
+    OWSLib`s own _invoke() works out which operation is being invoked by inspecting the call stack, so it cannot
+    simply be wrapped. Instead it is replaced here with an equivalent that takes the operation from the request itself.
+    """
+    def __init__(self, url, store=None, session=None, **kwargs):
+        """
+        :param url: CSW url
+        :param store: optional CapabilitiesStore
+        :param session: optional requests.Session i.e. from pooled_session()
+        :param kwargs: passed on to OWSLib CatalogueServiceWeb
+        """
+        self.store = store
+        self.session = session
+        self.record_esn = 'summary'  # the OWSLib getrecords2() default
+        self.element_names = HARVEST_ELEMENT_NAMES
+        super().__init__(url, **kwargs)
+
+    def getrecords_page(self, **kwargs):
+        """
+        thread-safe getrecords2(). getrecords2() leaves its results (.records, .results, .response etc) on the client
+        so is issued here on a shallow copy which shares the parsed capabilities and session with this client but
+        holds its own results
+
+        :param kwargs: passed on to getrecords2()
+        :return: copy of this client holding the page of records
+        """
+        page = copy.copy(self)
+        page.getrecords2(**kwargs)
+        return page
+
+    def prepare_getrecords(self, **kwargs):
+        """
+        build, but do not send, the GetRecords request getrecords2(**kwargs) would make. Lets the request be sent by
+        some other means (i.e. the asyncio harvester) with the response handed back via getrecords_from_response()
+
+        :param kwargs: passed on to getrecords2()
+        :return: (url to POST to, request body bytes)
+        """
+        page = copy.copy(self)
+        page._post = _capture_post
+        try:
+            page.getrecords2(**kwargs)
+        except _CapturedRequest as captured:
+            return captured.request_url, captured.request
+        raise RuntimeError('getrecords2() did not make a POST request')
+
+    def getrecords_from_response(self, response, **kwargs):
+        """
+        parse a GetRecords response exactly as getrecords2(**kwargs) would have done had it made the request itself
+
+        :param response: GetRecords response bytes for the request prepare_getrecords(**kwargs) built
+        :param kwargs: passed on to getrecords2()
+        :return: copy of this client holding the page of records
+        """
+        page = copy.copy(self)
+        page._post = lambda request_url, request: response
+        page.getrecords2(**kwargs)
+        return page
+
+    def choose_element_set(self, record_fields, constraints=None, sample_size=10):
+        """
+        probe the CSW for the smallest element set whose records give the same record_fields as full records and
+        make it record_esn. The candidates are tried smallest first on a sample page, any the server rejects or that
+        lose a field are passed over, leaving full records as the fallback
+
+        :param record_fields: callable taking an OWSLib CswRecord and returning the fields the harvest reads from it
+        :param constraints: OWSLib getrecords2() constraints the harvest applies
+        :param sample_size: number of records to compare
+        :return: dict of element set -> response bytes per record of the sample, for those that were tried
+        """
+        constraints = constraints or []
+        bytes_per_record = {}
+        try:
+            baseline = self.getrecords_page(constraints=constraints, esn='full', maxrecords=sample_size)
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception("Exception raised when retrieving sample of full records from CSW.")
+            return bytes_per_record
+        if len(baseline.records) == 0:
+            return bytes_per_record
+
+        expected = sorted((record_fields(r) for r in baseline.records.values()), key=repr)
+        bytes_per_record['full'] = len(baseline.response) / len(baseline.records)
+        self.record_esn = 'full'
+        for esn in (ELEMENT_NAMES, 'summary'):
+            try:
+                page = self.getrecords_page(constraints=constraints, esn=esn, maxrecords=sample_size)
+            # TODO improve caught exception specifity
+            except Exception:
+                logging.info('CSW %s rejected element set %s', self.url, esn)
+                continue
+            if len(page.records) > 0:
+                bytes_per_record[esn] = len(page.response) / len(page.records)
+            if sorted((record_fields(r) for r in page.records.values()), key=repr) == expected:
+                self.record_esn = esn
+                break
+            logging.info('Records of element set %s from CSW %s are missing fields the harvest reads', esn, self.url)
+
+        logging.info(
+            'Retrieving %s records from CSW %s, %s bytes per record (full records %s bytes per record)',
+            self.record_esn, self.url, round(bytes_per_record.get(self.record_esn, 0)), round(bytes_per_record['full'])
+        )
+        return bytes_per_record
+
+    def _set_element_names(self):
+        """
+        swap an ElementSetName of ELEMENT_NAMES in the GetRecords request for a csw:ElementName per element_names
+        property
+        """
+        query = self.request.find(util.nspath_eval('csw:Query', namespaces))
+        if query is None:
+            return
+        esn = query.find(util.nspath_eval('csw:ElementSetName', namespaces))
+        if esn is None or esn.text != ELEMENT_NAMES:
+            return
+        position = list(query).index(esn)
+        query.remove(esn)
+        for i, name in enumerate(self.element_names):
+            element_name = etree.Element(util.nspath_eval('csw:ElementName', namespaces))
+            element_name.text = name
+            query.insert(position + i, element_name)
+        # the property names are qualified so their namespaces have to be declared
+        self.request = add_namespaces(self.request, sorted(set(name.split(':')[0] for name in self.element_names)))
+
+    def _operation_name(self):
+        if isinstance(self.request, str):
+            for k, v in parse_qsl(self.request):
+                if k.lower() == 'request':
+                    return v
+            return None
+        return self.request.tag.split('}')[-1]
+
+    def _operation_url(self, operation_name, method):
+        """
+        url advertised in the capabilities for operation_name / method (Get or Post), else the CSW url. Where more
+        than one Post url is advertised prefer the one with an XML PostEncoding
+        """
+        if operation_name is None or not hasattr(self, 'operations'):
+            return self.url
+        try:
+            op = self.get_operation_by_name(operation_name)
+        except KeyError:
+            return self.url
+
+        verbs = [x for x in op.methods if x.get('type').lower() == method]
+        if len(verbs) == 0:
+            return self.url
+        if len(verbs) > 1 and method == 'post':
+            for pv in verbs:
+                for const in pv.get('constraints'):
+                    if const.name.lower() == 'postencoding' and 'xml' in [v.lower() for v in const.values]:
+                        return pv.get('url')
+
+        return verbs[0].get('url')
+
+    def _get(self, request_url, operation_name):
+        if self.store is not None and operation_name == 'GetCapabilities':
+            return self.store.fetch(request_url)
+        return openURL(request_url, None, 'Get', timeout=self.timeout, auth=self.auth).read()
+
+    def _post(self, request_url, request):
+        if self.session is None:
+            return http_post(request_url, request, self.lang, self.timeout, auth=self.auth)
+
+        # same request as owslib.util.http_post() but over the pooled session and honouring the timeout
+        headers = {
+            'User-Agent': 'OWSLib (https://geopython.github.io/OWSLib)',
+            'Content-type': 'text/xml',
+            'Accept': 'text/xml',
+            'Accept-Language': self.lang,
+            'Accept-Encoding': 'gzip,deflate',
+            'Host': urlsplit(request_url).netloc,
+        }
+        rkwargs = {'verify': self.auth.verify, 'cert': self.auth.cert, 'timeout': self.timeout}
+        if self.auth.username is not None and self.auth.password is not None:
+            rkwargs['auth'] = (self.auth.username, self.auth.password)
+
+        return self.session.post(request_url, request, headers=headers, **rkwargs).content
+
+    def _invoke(self):
+        operation_name = self._operation_name()
+
+        if isinstance(self.request, str):  # GET KVP
+            self.request = '%s%s' % (bind_url(self._operation_url(operation_name, 'get')), self.request)
+            self.response = self._get(self.request, operation_name)
+        else:
+            request_url = self._operation_url(operation_name, 'post')
+            self.request = cleanup_namespaces(self.request)
+            if operation_name == 'GetRecords':
+                self._set_element_names()
+            # Add any namespaces used in the "typeNames" attribute of the csw:Query element to the query`s xml
+            # namespaces
+            for query in self.request.findall(util.nspath_eval('csw:Query', namespaces)):
+                ns = query.get('typeNames', None)
+                if ns is not None:
+                    ns_keys = [x.split(':')[0] for x in ns.split(' ')]
+                    self.request = add_namespaces(self.request, ns_keys)
+            self.request = add_namespaces(self.request, 'ows')
+            self.request = util.element_to_string(self.request, encoding='utf-8')
+            self.response = self._post(request_url, self.request)
+
+        self._exml = etree.parse(BytesIO(self.response))
+
+        if self._exml.getroot().tag not in CSW_RESPONSE_ROOTS:
+            raise RuntimeError('Document is XML, but not CSW-ish')
+
+        val = self._exml.find(util.nspath_eval('ows:Exception', namespaces))
+        if val is not None:
+            raise ows.ExceptionReport(self._exml, self.owscommon.namespace)
+        else:
+            self.exceptionreport = None
@@ -0,0 +1,221 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+import logging
+import threading
+
+
+def advertised_page_size(csw):
+    """
+    MaxRecordDefault Constraint under OperationsMetadata indicates maximum number of records that can be returned per
+    query, however it is not always available
+
+    :param csw: OWSLib CatalogueServiceWeb object
+    :return: int or None
+    """
+    try:
+        return int(csw.constraints['MaxRecordDefault'].values[0])
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+class PageSizeController:
+    """
+    Decides how many records to ask a CSW for per GetRecords request.
+
+    Starts from the catalogue`s advertised MaxRecordDefault (if there is one) and then, as pages come back, doubles
+    the page size while responses are quick and small, shrinks it in proportion when a response is slower / larger
+    than the targets and halves it when the server errors. If the server returns fewer records than asked for
+    mid-catalogue that becomes the page size ceiling since the server is evidently capping pages.
+    """
+    def __init__(self, page_size=10, min_size=1, max_size=1000, target_seconds=10.0, max_page_bytes=10 * 1024 * 1024):
+        """
+        :param page_size: initial page size
+        :param min_size: smallest page size to shrink to
+        :param max_size: largest page size to grow to
+        :param target_seconds: GetRecords response time to aim for
+        :param max_page_bytes: GetRecords response size to aim to stay under
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.page_size = max(min_size, min(page_size, max_size))
+        self.target_seconds = target_seconds
+        self.max_page_bytes = max_page_bytes
+        self.pages = 0
+        self.errors = 0
+        self.records = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_csw(cls, csw, default_page_size=10, **kwargs):
+        page_size = advertised_page_size(csw)
+        if page_size is not None and page_size > 0:
+            logging.info('Starting from MaxRecordDefault CSW Constraint page size of %s', page_size)
+        else:
+            page_size = default_page_size
+            logging.info('No MaxRecordDefault CSW Constraint. Starting from page size of %s', page_size)
+
+        return cls(page_size=page_size, **kwargs)
+
+    def record(self, requested, returned, elapsed, nbytes, truncated=False):
+        """
+        adjust the page size given how a GetRecords request went
+
+        :param requested: maxrecords asked for
+        :param returned: number of records the server returned
+        :param elapsed: seconds the request took
+        :param nbytes: size of the response
+        :param truncated: True if the server returned fewer records than asked for although more were available
+        """
+        with self._lock:
+            self.pages += 1
+            self.records += returned
+            self.bytes += nbytes
+            if truncated and returned > 0:
+                self.max_size = max(self.min_size, returned)
+                self.page_size = min(self.page_size, self.max_size)
+
+            if elapsed > self.target_seconds or nbytes > self.max_page_bytes:
+                # shrink in proportion to how far over target we were but by no more than half at a time
+                factor = max(0.5, min(self.target_seconds / max(elapsed, 0.001), self.max_page_bytes / max(nbytes, 1)))
+                self.page_size = max(self.min_size, int(self.page_size * factor))
+            elif elapsed < self.target_seconds / 2 and nbytes < self.max_page_bytes / 2 and requested >= self.page_size:
+                # only grow on the back of a page at least as big as the current size
+                self.page_size = min(self.max_size, self.page_size * 2)
+
+    def record_error(self):
+        with self._lock:
+            self.pages += 1
+            self.errors += 1
+            self.page_size = max(self.min_size, self.page_size // 2)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pages': self.pages,
+                'errors': self.errors,
+                'page_size': self.page_size,
+                'records': self.records,
+                'bytes_per_record': round(self.bytes / self.records) if self.records > 0 else None
+            }
+
+
+class PageCursor:
+    """
+    Hands out (startposition, maxrecords) pages of a CSW result set to worker threads, sized by a PageSizeController
+    at the time each page is handed out. CSW startposition is 1-based.
+
+    Record ranges a server did not return in full (capped or failed pages) are queued and handed out again before the
+    cursor moves on. A failed range is retried once (at the by then smaller page size) before being given up on.
+
+    Ranges already harvested (i.e. by an earlier, interrupted, run) can be given as skip_ranges, pages are then only
+    handed out for the gaps between them.
+    """
+    max_attempts = 2
+
+    def __init__(self, num_records, controller, first_position=1, skip_ranges=None):
+        """
+        :param num_records: number of records to page through
+        :param controller: PageSizeController
+        :param first_position: startposition of the first record
+        :param skip_ranges: optional list of (startposition, number of records) ranges not to hand out
+        """
+        self.controller = controller
+        self.end_position = first_position + num_records  # exclusive
+        self.next_position = first_position
+        self.pending = []  # (startposition, number of records, attempts) ranges to hand out again
+        self.attempts = {}  # startposition of handed out page -> attempts
+        self.abandoned = []  # (startposition, number of records) ranges given up on
+        self.skip_ranges = sorted((start, start + count) for start, count in (skip_ranges or []) if count > 0)
+        self._lock = threading.Lock()
+
+    def _skip_completed(self, position):
+        """
+        :return: first position at or after position that is not in a skip range
+        """
+        for start, end in self.skip_ranges:
+            if start <= position < end:
+                position = end
+        return position
+
+    def _next_skip_start(self, position):
+        """
+        :return: start of the first skip range after position, or end_position
+        """
+        for start, end in self.skip_ranges:
+            if start > position:
+                return min(start, self.end_position)
+        return self.end_position
+
+    def next_page(self):
+        """
+        :return: (startposition, maxrecords) of the next page to fetch or None if there is currently nothing to fetch
+        """
+        with self._lock:
+            page_size = self.controller.page_size
+            if len(self.pending) > 0:
+                start, count, attempts = self.pending.pop()
+                if count > page_size:
+                    self.pending.append((start + page_size, count - page_size, attempts))
+                    count = page_size
+            else:
+                self.next_position = self._skip_completed(self.next_position)
+                if self.next_position >= self.end_position:
+                    return None
+                start = self.next_position
+                count = min(page_size, self._next_skip_start(start) - start)
+                attempts = 0
+                self.next_position += count
+            self.attempts[start] = attempts + 1
+
+            return start, count
+
+    def page_done(self, start, requested, returned, elapsed, nbytes):
+        with self._lock:
+            attempts = self.attempts.pop(start, 1)
+            truncated = 0 < returned < requested
+            if truncated:
+                self.pending.append((start + returned, requested - returned, attempts - 1))
+            elif returned == 0 and requested > 0:
+                logging.info('CSW returned no records from startposition %s, abandoning range', start)
+                self.abandoned.append((start, requested))
+
+        self.controller.record(requested, returned, elapsed, nbytes, truncated=truncated)
+
+    def page_failed(self, start, requested):
+        with self._lock:
+            attempts = self.attempts.pop(start, 1)
+            if attempts < self.max_attempts:
+                self.pending.append((start, requested, attempts))
+            else:
+                logging.info('Giving up on CSW records %s to %s', start, start + requested - 1)
+                self.abandoned.append((start, requested))
+
+        self.controller.record_error()
+
+
+def iter_pages(pool, cursor, page_job, max_in_flight):
+    """
+    keep up to max_in_flight pages from cursor running on pool, yielding each page_job result as it completes. The
+    page job is responsible for telling the cursor how the page went (page_done() / page_failed()) so that page sizes
+    adapt before the next page is handed out
+
+    :param pool: concurrent.futures Executor
+    :param cursor: PageCursor
+    :param page_job: callable taking (startposition, maxrecords)
+    :param max_in_flight: max pages to have submitted at once
+    :return: generator of page_job results, in completion order
+    """
+    in_flight = set()
+    while True:
+        while len(in_flight) < max_in_flight:
+            page = cursor.next_page()
+            if page is None:
+                break
+            in_flight.add(pool.submit(page_job, page[0], page[1]))
+
+        if len(in_flight) == 0:
+            break
+
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for job in done:
+            yield job.result()
@@ -0,0 +1,236 @@
+import csv
+import logging
+import math
+import os
+import sys
+import time
+import click
+import numpy as np
+
+from harvest_record import WMS_LAYERS_FIELDS
+from output_writer import read_records
+
+
+EXTENTS_FNAME = 'wms_layers_extents.npy'
+EXTENT_ROWS_FNAME = 'wms_layers_extents_rows.npy'
+
+# children per node of the tree
+NODE_SIZE = 16
+
+
+def level_sizes(n, node_size=NODE_SIZE):
+    """
+    :param n: number of leaves (bboxes)
+    :param node_size: children per node
+    :return: list of the number of nodes at each level of the tree, leaves first, root last
+    """
+    sizes = [n]
+    while sizes[-1] > 1:
+        sizes.append(int(math.ceil(sizes[-1] / float(node_size))))
+    return sizes
+
+
+def str_order(bboxes, node_size=NODE_SIZE):
+    """
+    Sort-Tile-Recursive order of bboxes, so that each run of node_size bboxes (a leaf node) covers a compact area
+
+    :param bboxes: (n, 4) array of minx, miny, maxx, maxy
+    :return: array of indices into bboxes
+    """
+    n = len(bboxes)
+    cx = (bboxes[:, 0] + bboxes[:, 2]) / 2.0
+    cy = (bboxes[:, 1] + bboxes[:, 3]) / 2.0
+    # vertical slices of slice_size bboxes by x, each sorted by y
+    slice_size = node_size * int(math.ceil(math.sqrt(math.ceil(n / float(node_size)))))
+    by_x = np.argsort(cx, kind='stable')
+    slices = np.empty(n, dtype=np.int64)
+    slices[by_x] = np.arange(n) // max(slice_size, 1)
+    return np.lexsort((cy, slices))
+
+
+class ExtentIndex:
+    """
+    Static packed R-tree over the wgs84 bboxes of the harvested layers (the rows of wms_layers.csv), to answer which
+    layers cover an area without PostGIS.
+
+    The leaves are packed Sort-Tile-Recursive, NODE_SIZE to a node, and each level of the tree is stored one after the
+    other (leaves first) in a single (nodes, 4) float64 array, so the tree is just two flat arrays that are saved next
+    to wms_layers.csv as .npy files and memory mapped when loaded, only the pages a query touches being read.
+
+    Queries go a level at a time over (query, node) pairs as numpy array operations, so a bulk query of many bboxes /
+    points costs about the same number of numpy calls as one.
+    """
+    def __init__(self, extents, rows, node_size=NODE_SIZE):
+        """
+        :param extents: (nodes, 4) array of node bboxes, level by level from the leaves up
+        :param rows: array of the row number (in wms_layers.csv) of each leaf
+        :param node_size: children per node
+        """
+        self.extents = extents
+        self.rows = rows
+        self.node_size = node_size
+        self.sizes = level_sizes(len(rows), node_size) if len(rows) > 0 else []
+        self.offsets = np.cumsum([0] + self.sizes[:-1]).tolist()
+
+    @classmethod
+    def from_bboxes(cls, bboxes, rows=None, node_size=NODE_SIZE):
+        """
+        :param bboxes: sequence of (minx, miny, maxx, maxy)
+        :param rows: the row number of each bbox, their position in bboxes if None
+        :param node_size: children per node
+        """
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        rows = np.arange(len(bboxes), dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        if len(bboxes) == 0:
+            return cls(bboxes, rows, node_size=node_size)
+
+        order = str_order(bboxes, node_size)
+        levels = [bboxes[order]]
+        for size in level_sizes(len(bboxes), node_size)[1:]:
+            children = levels[-1]
+            # pad the last node`s children with empty bboxes, that do not change its extent
+            padded = np.empty((size * node_size, 4), dtype=np.float64)
+            padded[:len(children)] = children
+            padded[len(children):, :2] = np.inf
+            padded[len(children):, 2:] = -np.inf
+            padded = padded.reshape(size, node_size, 4)
+            levels.append(np.hstack([padded[:, :, :2].min(axis=1), padded[:, :, 2:].max(axis=1)]))
+        return cls(np.vstack(levels), rows[order], node_size=node_size)
+
+    @classmethod
+    def build(cls, rows_fname, node_size=NODE_SIZE):
+        """
+        :param rows_fname: wms_layers.csv, rows without a bbox_wgs84 are left out
+        """
+        bboxes = []
+        rows = []
+        for i, record in enumerate(read_records(rows_fname)):
+            if record.bbox_wgs84 is not None:
+                bboxes.append(record.bbox_wgs84)
+                rows.append(i)
+        return cls.from_bboxes(bboxes, rows, node_size=node_size)
+
+    def save(self, out_path):
+        """
+        :param out_path: folder holding wms_layers.csv
+        """
+        for fname, a in ((EXTENTS_FNAME, self.extents), (EXTENT_ROWS_FNAME, self.rows)):
+            tmp_fname = os.path.join(out_path, fname + '.tmp')
+            with open(tmp_fname, 'wb') as outpf:
+                np.save(outpf, a)
+            os.replace(tmp_fname, os.path.join(out_path, fname))
+
+    @classmethod
+    def load(cls, out_path, node_size=NODE_SIZE):
+        """
+        :param out_path: folder holding wms_layers.csv and the index saved with it
+        """
+        return cls(
+            np.load(os.path.join(out_path, EXTENTS_FNAME), mmap_mode='r'),
+            np.load(os.path.join(out_path, EXTENT_ROWS_FNAME), mmap_mode='r'),
+            node_size=node_size
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def query_bboxes(self, bboxes):
+        """
+        :param bboxes: sequence of (minx, miny, maxx, maxy), a point being (x, y, x, y)
+        :return: (query, row) arrays of the position in bboxes of each query and the row number of a layer whose bbox
+        intersects it, ordered by query
+        """
+        queries = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        if len(self.sizes) == 0 or len(queries) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        q = np.arange(len(queries), dtype=np.int64)
+        nodes = np.zeros(len(queries), dtype=np.int64)  # every query starts at the root
+        for level in range(len(self.sizes) - 1, -1, -1):
+            ext = self.extents[self.offsets[level] + nodes]
+            qb = queries[q]
+            hit = (ext[:, 0] <= qb[:, 2]) & (ext[:, 2] >= qb[:, 0]) & (ext[:, 1] <= qb[:, 3]) & (ext[:, 3] >= qb[:, 1])
+            q, nodes = q[hit], nodes[hit]
+            if level == 0:
+                break
+            # expand each node hit to its children
+            first = nodes * self.node_size
+            counts = np.minimum(self.node_size, self.sizes[level - 1] - first)
+            starts = np.cumsum(counts) - counts
+            q = np.repeat(q, counts)
+            nodes = np.repeat(first - starts, counts) + np.arange(counts.sum(), dtype=np.int64)
+
+        # expanding in order keeps the pairs ordered by query (then leaf)
+        return q, np.asarray(self.rows)[nodes]
+
+    def query_points(self, points):
+        """
+        :param points: sequence of (x, y)
+        :return: (query, row) arrays as query_bboxes()
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return self.query_bboxes(np.hstack([points, points]))
+
+    def query_bbox(self, bbox):
+        """
+        :param bbox: (minx, miny, maxx, maxy)
+        :return: array of the row numbers of the layers whose bbox intersects bbox
+        """
+        return self.query_bboxes([bbox])[1]
+
+
+def build_extent_index(out_path):
+    """
+    build the ExtentIndex of wms_layers.csv of out_path and save it there
+
+    :return: ExtentIndex
+    """
+    index = ExtentIndex.build(os.path.join(out_path, 'wms_layers.csv'))
+    index.save(out_path)
+    logging.info('Indexed the extents of %s layers', len(index))
+    return index
+
+
+def parse_coords(value, n):
+    try:
+        coords = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        raise click.BadParameter('{0} is not {1} comma separated numbers'.format(value, n))
+    if len(coords) != n:
+        raise click.BadParameter('{0} is not {1} comma separated numbers'.format(value, n))
+    return coords
+
+
+@click.command()
+@click.option('-out_path', required=True, type=click.Path(exists=True, file_okay=False), help='Path the harvest wrote wms_layers.csv and its extent index to')
+@click.option('-bbox', 'bboxes', multiple=True, type=str, help='wgs84 minx,miny,maxx,maxy to find the layers covering (can be given more than once)')
+@click.option('-point', 'points', multiple=True, type=str, help='wgs84 x,y to find the layers covering (can be given more than once)')
+def query_extents(**params):
+    """Find the harvested WMS layers whose extent intersects each bbox / point. Writes them to stdout as wms_layers.csv rows, after the bbox / point they matched."""
+    queries = [parse_coords(b, 4) for b in params['bboxes']] + [parse_coords(p, 2) * 2 for p in params['points']]
+    if len(queries) == 0:
+        raise click.UsageError('give at least one -bbox or -point')
+
+    started = time.time()
+    index = ExtentIndex.load(params['out_path'])
+    query_is, rows = index.query_bboxes(queries)
+    took = time.time() - started
+
+    wanted = {}
+    for i, r in zip(query_is.tolist(), rows.tolist()):
+        wanted.setdefault(r, []).append(i)
+    matches = []
+    for r, record in enumerate(read_records(os.path.join(params['out_path'], 'wms_layers.csv'))):
+        for i in wanted.get(r, []):
+            matches.append((i, record))
+    matches.sort(key=lambda m: m[0])
+
+    writer = csv.writer(sys.stdout, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(['query'] + WMS_LAYERS_FIELDS)
+    for i, record in matches:
+        writer.writerow([','.join(str(v) for v in queries[i])] + record.as_row())
+    click.echo('Found {0} layers in {1:.1f}ms'.format(len(matches), took * 1000.0), err=True)
+
+
+if __name__ == "__main__":
+    query_extents()
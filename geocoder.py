@@ -0,0 +1,231 @@
+import csv
+import functools
+import json
+import logging
+import numbers
+import os
+import threading
+from postgres import Postgres
+from shapely.geometry import box, shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from harvest_record import parse_bbox
+
+
+GEOGRAPHIES_FNAME = 'layer_geographies.csv'
+GEOGRAPHIES_FIELDS = ['csw_url', 'csw_record_identifier', 'wms_url', 'country', 'continent']
+
+# one set-based query for a whole batch of bboxes, sent as arrays (one per coordinate) so the query text is the same
+# whatever the batch size
+BATCH_SQL = """
+SELECT DISTINCT q.i, b.name_long, b.continent
+FROM
+unnest(%(xmin)s::float8[], %(ymin)s::float8[], %(xmax)s::float8[], %(ymax)s::float8[]) WITH ORDINALITY AS q(xmin, ymin, xmax, ymax, i)
+JOIN geocrud.natural_earth_world_map_units b
+ON st_intersects(st_makeenvelope(q.xmin, q.ymin, q.xmax, q.ymax, 4326), b.geom)
+ORDER BY q.i, b.name_long, b.continent
+"""
+
+
+def check_wgs84_bbox(wgs84_bbox):
+    if not isinstance(wgs84_bbox, tuple):
+        raise TypeError('wgs84_bbox must be a 4 item tuple')
+    if len(wgs84_bbox) != 4:
+        raise ValueError('wrong number of elements in wgs84_bbox tuple')
+
+
+class ReverseGeocoder:
+    """
+    Reverse geocodes wgs84 bboxes against a Natural Earth global countries dataset held in PostGIS, many at a time.
+
+    Each batch of bboxes goes to PostGIS as one parameterised query over a connection from the geocoder`s pool (the
+    Postgres object`s psycopg2-pool), rather than a connection and a query per bbox. Results are memoised so a bbox
+    shared by many layers (i.e. all the layers of a WMS) is only geocoded once.
+    """
+    def __init__(self, pg_conn_str, batch_size=5000, maxconn=4):
+        """
+        :param pg_conn_str: a SQLAlchemy type Pg connection string to the db holding the natural earth polygon data
+        :param batch_size: max bboxes per query
+        :param maxconn: max pooled connections
+        """
+        self.db = Postgres(pg_conn_str, maxconn=maxconn)
+        self.batch_size = batch_size
+        self._cache = {}  # bbox -> list of geographies
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def geocode(self, wgs84_bboxes):
+        """
+        :param wgs84_bboxes: iterable of 4 element tuples i.e. (-74.66163, 39.65041, -72.00061, 41.61214)
+        :return: dict of bbox -> list of dictionaries in form: [{'country': 'United States', 'continent': 'North America'}, ...]
+        """
+        wgs84_bboxes = list(wgs84_bboxes)
+        for wgs84_bbox in wgs84_bboxes:
+            check_wgs84_bbox(wgs84_bbox)
+
+        unique_bboxes = list(dict.fromkeys(wgs84_bboxes))
+        with self._lock:
+            todo = [bb for bb in unique_bboxes if bb not in self._cache]
+            self.hits += len(unique_bboxes) - len(todo)
+            self.misses += len(todo)
+
+        for start in range(0, len(todo), self.batch_size):
+            batch = todo[start:start + self.batch_size]
+            geographies = self._query(batch)
+            with self._lock:
+                self._cache.update(zip(batch, geographies))
+
+        with self._lock:
+            return {bb: self._cache[bb] for bb in unique_bboxes}
+
+    def _query(self, batch):
+        """
+        :param batch: list of bboxes
+        :return: list of the geographies of each bbox
+        """
+        params = {k: [float(bb[j]) for bb in batch] for j, k in enumerate(('xmin', 'ymin', 'xmax', 'ymax'))}
+        rs = self.db.all(BATCH_SQL, params)
+        with self._lock:
+            self.queries += 1
+        geographies = [[] for _ in batch]
+        for r in rs:
+            # ordinality is 1 based
+            geographies[r[0] - 1].append({'country': r[1], 'continent': r[2]})
+        return geographies
+
+    def stats(self):
+        with self._lock:
+            return {'bboxes': len(self._cache), 'hits': self.hits, 'misses': self.misses, 'queries': self.queries}
+
+    def log_stats(self):
+        logging.info('Reverse geocoder: %s', self.stats())
+
+
+class OfflineGeocoder:
+    """
+    Reverse geocodes wgs84 bboxes in process against the Natural Earth map units read once from a local GeoJSON file
+    (i.e. exported from geocrud.natural_earth_world_map_units), for harvests run where there is no PostGIS. Answers
+    as ReverseGeocoder does.
+
+    The map units go in a shapely STRtree, a bbox query narrows them to those whose envelopes overlap the bbox then
+    only those are tested for intersection (each map unit geometry is prepared for that). Results are kept in an LRU
+    cache.
+    """
+    def __init__(self, fname, cache_size=100000, batch_size=5000):
+        """
+        :param fname: GeoJSON FeatureCollection of the map units with name_long and continent properties (either case)
+        :param cache_size: max bboxes in the LRU cache
+        :param batch_size: bboxes per batch of geocode_wms_layers()
+        """
+        self.fname = fname
+        self.batch_size = batch_size
+        with open(fname, 'r') as inpf:
+            features = json.load(inpf)['features']
+
+        self._geometries = []
+        self._prepared = []
+        self._geographies = []  # (country, continent) of each map unit
+        for f in features:
+            if f.get('geometry') is None:
+                continue
+            properties = {k.lower(): v for k, v in f['properties'].items()}
+            geometry = shape(f['geometry'])
+            self._geometries.append(geometry)
+            self._prepared.append(prep(geometry))
+            self._geographies.append((properties.get('name_long'), properties.get('continent')))
+        self._tree = STRtree(self._geometries)
+        # shapely 1.x STRtree queries return the geometries themselves rather than their indices
+        self._indices = {id(g): i for i, g in enumerate(self._geometries)}
+        self._geocode_cached = functools.lru_cache(maxsize=cache_size)(self._geocode)
+        logging.info('Loaded %s map units from %s', len(self._geometries), fname)
+
+    def _geocode(self, wgs84_bbox):
+        envelope = box(*wgs84_bbox)
+        geographies = set()
+        for hit in self._tree.query(envelope):
+            i = hit if isinstance(hit, numbers.Integral) else self._indices[id(hit)]
+            if self._prepared[i].intersects(envelope):
+                geographies.add(self._geographies[i])
+        # the order of the DISTINCT / ORDER BY of the PostGIS query, NULLs last
+        return tuple(sorted(geographies, key=lambda g: tuple((v is None, v or '') for v in g)))
+
+    def geocode(self, wgs84_bboxes):
+        """
+        :param wgs84_bboxes: iterable of 4 element tuples i.e. (-74.66163, 39.65041, -72.00061, 41.61214)
+        :return: dict of bbox -> list of dictionaries in form: [{'country': 'United States', 'continent': 'North America'}, ...]
+        """
+        geographies = {}
+        for wgs84_bbox in wgs84_bboxes:
+            check_wgs84_bbox(wgs84_bbox)
+            if wgs84_bbox not in geographies:
+                geographies[wgs84_bbox] = [
+                    {'country': country, 'continent': continent} for country, continent in self._geocode_cached(wgs84_bbox)
+                ]
+        return geographies
+
+    def stats(self):
+        info = self._geocode_cached.cache_info()
+        return {'map_units': len(self._geometries), 'bboxes': info.currsize, 'hits': info.hits, 'misses': info.misses}
+
+    def log_stats(self):
+        logging.info('Offline geocoder: %s', self.stats())
+
+
+_geocoders = {}
+_geocoders_lock = threading.Lock()
+
+
+def reverse_geocoder(pg_conn_str=None, fname=None):
+    """
+    :param pg_conn_str: Pg connection string of the db holding the map units
+    :param fname: GeoJSON file of the map units to geocode offline, in place of pg_conn_str
+    :return: the process wide ReverseGeocoder (and so connection pool and memo) of pg_conn_str, or OfflineGeocoder of
+    fname
+    """
+    if (pg_conn_str is None) == (fname is None):
+        raise ValueError('give one of pg_conn_str or fname')
+    key = ('file', fname) if fname is not None else ('pg', pg_conn_str)
+    with _geocoders_lock:
+        geocoder = _geocoders.get(key)
+        if geocoder is None:
+            if fname is not None:
+                geocoder = OfflineGeocoder(fname)
+            else:
+                geocoder = ReverseGeocoder(pg_conn_str)
+            _geocoders[key] = geocoder
+    return geocoder
+
+
+def geocode_wms_layers(geocoder, rows_fname, out_fname):
+    """
+    reverse geocode the wgs84 bbox of every row of wms_layers.csv, writing a row per layer / country to out_fname
+
+    :param geocoder: ReverseGeocoder
+    :param rows_fname: wms_layers.csv
+    :param out_fname: CSV of GEOGRAPHIES_FIELDS to write
+    """
+    with open(rows_fname, 'r', newline='') as inpf, open(out_fname, 'w', newline='') as outpf:
+        reader = csv.DictReader(inpf)
+        writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(GEOGRAPHIES_FIELDS)
+
+        def write_batch(batch):
+            geographies = geocoder.geocode(bb for bb, _ in batch)
+            for bb, r in batch:
+                for g in geographies[bb]:
+                    writer.writerow([r['csw_url'], r['csw_record_identifier'], r['wms_url'], g['country'], g['continent']])
+
+        batch = []
+        for r in reader:
+            bbox = parse_bbox(r['bbox_wgs84'] if r['bbox_wgs84'] != '' else None)
+            if bbox is None or len(bbox) != 4:
+                continue
+            batch.append((bbox, r))
+            if len(batch) >= geocoder.batch_size:
+                write_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            write_batch(batch)
@@ -0,0 +1,236 @@
+import collections
+import logging
+import os
+import statistics
+import threading
+import weakref
+import numpy as np
+from pyproj import Transformer
+
+from output_writer import StreamingCsvWriter
+
+
+WGS84 = 'EPSG:4326'
+
+# crs of a bbox that is the wgs84 bbox over again rather than one in the layer`s native crs
+WGS84_CRS = ('EPSG:4326', 'CRS:84', 'OGC:CRS84')
+
+# GetMap request modes
+MODE_WGS84 = 'wgs84'
+MODE_NATIVE = 'native'
+MODE_FASTEST = 'fastest'
+
+LATENCY_FNAME = 'getmap_latency.csv'
+LATENCY_FIELDS = ['wms_url', 'wms_layer_name', 'mode', 'crs', 'width', 'height', 'seconds', 'bytes', 'wms_get_map_error']
+
+# points along each edge of an extent that are transformed, so that the transformed extent takes in the curve of the
+# edges
+EDGE_POINTS = 11
+
+_transformers = threading.local()
+
+
+def wgs84_transformer(crs):
+    """
+    :param crs: crs i.e. EPSG:27700
+    :return: pyproj Transformer from wgs84 (lon / lat) to crs (x / y), one per thread as they are not thread safe
+    """
+    transformers = getattr(_transformers, 'by_crs', None)
+    if transformers is None:
+        transformers = _transformers.by_crs = {}
+    transformer = transformers.get(crs)
+    if transformer is None:
+        transformer = transformers[crs] = Transformer.from_crs(WGS84, crs, always_xy=True)
+    return transformer
+
+
+def transform_extents(extents, crs):
+    """
+    transform wgs84 extents to crs in one pyproj call
+
+    :param extents: (n, 4) array of wgs84 minx, miny, maxx, maxy
+    :param crs: crs to transform them to
+    :return: (n, 4) array of the extents in crs (x / y order), nan where an extent could not be transformed
+    """
+    t = np.linspace(0.0, 1.0, EDGE_POINTS)
+    minx, miny, maxx, maxy = (extents[:, i:i + 1] for i in range(4))
+    # the points along the bottom, right, top and left edges of each extent
+    xs = np.hstack([minx + (maxx - minx) * t, np.repeat(maxx, EDGE_POINTS, axis=1), maxx - (maxx - minx) * t, np.repeat(minx, EDGE_POINTS, axis=1)])
+    ys = np.hstack([np.repeat(miny, EDGE_POINTS, axis=1), miny + (maxy - miny) * t, np.repeat(maxy, EDGE_POINTS, axis=1), maxy - (maxy - miny) * t])
+    x, y = wgs84_transformer(crs).transform(xs.ravel(), ys.ravel())
+    x = np.asarray(x, dtype=np.float64).reshape(xs.shape)
+    y = np.asarray(y, dtype=np.float64).reshape(ys.shape)
+    # points outside the area of use of crs come back as inf
+    with np.errstate(invalid='ignore'):
+        x[~np.isfinite(x)] = np.nan
+        y[~np.isfinite(y)] = np.nan
+        transformed = np.stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)], axis=1)
+    return transformed
+
+
+class GetMapCrs:
+    """
+    Picks the crs (and extent) of the GetMap request validating each layer, and logs the latency of every request to
+    getmap_latency.csv so the modes can be compared.
+
+    In native mode a layer with a projected bbox (the first BoundingBox of the capabilities doc, with its crs) is
+    requested in that crs, so that a server (i.e. an EPSG:27700 one) does not have to reproject its data on the fly.
+    With an ExtentPlanner the planned (wgs84) extents of all the layers of a WMS in each crs are transformed with one
+    pyproj call, the first time any of them is requested, otherwise the projected bbox is requested as advertised.
+
+    In fastest mode requests to a WMS alternate between native and wgs84 until there have been trial_requests of each,
+    then it gets whichever has the lower median latency of its recent requests, a failed request counting as never
+    returning.
+    Layers without a projected bbox are always requested in wgs84.
+    """
+    def __init__(self, mode=MODE_NATIVE, out_path=None, extent_planner=None, trial_requests=3, recent_requests=20):
+        """
+        :param mode: MODE_NATIVE, MODE_FASTEST or MODE_WGS84 (only logging the latency)
+        :param out_path: folder to write getmap_latency.csv to, None for no log
+        :param extent_planner: optional ExtentPlanner whose (wgs84) request extents are transformed to the native crs
+        :param trial_requests: requests of each mode to a WMS before fastest mode picks one
+        :param recent_requests: latencies per WMS and mode that fastest mode goes on
+        """
+        self.mode = mode
+        self.extent_planner = extent_planner
+        self.trial_requests = trial_requests
+        self.recent_requests = recent_requests
+        self._native = weakref.WeakKeyDictionary()  # WebMapService -> name -> (crs, bbox, size)
+        self._latencies = {}  # wms url -> mode -> deque of seconds
+        self._chosen = {}  # wms url -> mode -> requests chosen in fastest mode
+        self._lock = threading.Lock()
+        self.requests = {MODE_NATIVE: 0, MODE_WGS84: 0}
+        self.seconds = {MODE_NATIVE: 0.0, MODE_WGS84: 0.0}
+        self.errors = {MODE_NATIVE: 0, MODE_WGS84: 0}
+        self.transform_errors = 0
+        self.latency_log = None
+        if out_path is not None:
+            self.latency_log = StreamingCsvWriter(os.path.join(out_path, LATENCY_FNAME), header=LATENCY_FIELDS)
+
+    def _wms_native(self, wms):
+        with self._lock:
+            native = self._native.get(wms)
+        if native is not None:
+            return native
+
+        names = []
+        bboxes = []
+        for name in wms.contents:
+            bbox = wms.contents[name].boundingBox
+            if bbox is not None and len(bbox) == 5 and bbox[4] is not None and bbox[4].upper() not in WGS84_CRS:
+                names.append(name)
+                bboxes.append(bbox)
+
+        native = {}
+        if self.extent_planner is None:
+            for name, bbox in zip(names, bboxes):
+                native[name] = (bbox[4], tuple(bbox[:4]), (400, 400))
+        else:
+            # the planned extents of the layers in each crs are transformed together
+            by_crs = collections.defaultdict(list)
+            for name, bbox in zip(names, bboxes):
+                request_extent = self.extent_planner.request_extent(wms, name)
+                if request_extent is not None:
+                    by_crs[bbox[4]].append((name, request_extent[0]))
+            for crs, extents in by_crs.items():
+                try:
+                    transformed = transform_extents(np.array([e for _, e in extents], dtype=np.float64), crs)
+                # TODO improve caught exception specifity
+                except Exception:
+                    logging.exception('Could not transform GetMap extents to %s', crs)
+                    with self._lock:
+                        self.transform_errors += len(extents)
+                    continue
+                spans = transformed[:, 2:] - transformed[:, :2]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    sizes = np.rint(self.extent_planner.max_size * spans / spans.max(axis=1)[:, None])
+                for (name, _), extent, size in zip(extents, transformed, sizes):
+                    if np.isfinite(extent).all() and np.isfinite(size).all():
+                        native[name] = (crs, tuple(extent.tolist()), tuple(int(max(v, 1)) for v in size))
+                    else:
+                        with self._lock:
+                            self.transform_errors += 1
+
+        with self._lock:
+            self._native[wms] = native
+        return native
+
+    def native_request(self, wms, wms_layer_name):
+        """
+        :param wms: OWSLib WebMapService object (or a streamed one)
+        :param wms_layer_name: name of a layer of wms
+        :return: (crs, bbox, (width, height)) of the native crs GetMap request for the layer, or None if it has no
+        projected bbox
+        """
+        return self._wms_native(wms).get(wms_layer_name)
+
+    def choose_mode(self, wms, wms_layer_name):
+        """
+        :param wms: OWSLib WebMapService object (or a streamed one)
+        :param wms_layer_name: name of a layer of wms
+        :return: MODE_NATIVE or MODE_WGS84, the mode to request the layer in
+        """
+        if self.mode == MODE_WGS84 or self.native_request(wms, wms_layer_name) is None:
+            return MODE_WGS84
+        if self.mode == MODE_NATIVE:
+            return MODE_NATIVE
+
+        with self._lock:
+            latencies = self._latencies.get(wms.url, {})
+            native = list(latencies.get(MODE_NATIVE, []))
+            wgs84 = list(latencies.get(MODE_WGS84, []))
+            # requests chosen rather than recorded are counted, as the asyncio engine chooses the mode of many
+            # requests to a WMS before any of them has returned
+            chosen = self._chosen.setdefault(wms.url, {MODE_NATIVE: 0, MODE_WGS84: 0})
+            if min(chosen.values()) < self.trial_requests or len(native) == 0 or len(wgs84) == 0:
+                mode = MODE_NATIVE if chosen[MODE_NATIVE] <= chosen[MODE_WGS84] else MODE_WGS84
+            else:
+                mode = MODE_NATIVE if statistics.median(native) <= statistics.median(wgs84) else MODE_WGS84
+            chosen[mode] += 1
+        return mode
+
+    def record(self, wms, wms_layer_name, mode, crs, size, seconds, nbytes, wms_get_map_error):
+        """
+        record the latency of a GetMap request
+
+        :param wms: OWSLib WebMapService object the request was made to
+        :param mode: MODE_NATIVE or MODE_WGS84
+        :param seconds: time from sending the request to having read the whole response
+        :param nbytes: size of the response, None if it failed
+        """
+        with self._lock:
+            latencies = self._latencies.setdefault(wms.url, {})
+            recent = latencies.get(mode)
+            if recent is None:
+                recent = latencies[mode] = collections.deque(maxlen=self.recent_requests)
+            recent.append(float('inf') if wms_get_map_error else seconds)
+            self.requests[mode] += 1
+            self.seconds[mode] += seconds
+            if wms_get_map_error:
+                self.errors[mode] += 1
+        if self.latency_log is not None:
+            self.latency_log.put([wms.url, wms_layer_name, mode, crs, size[0], size[1], round(seconds, 4), nbytes, wms_get_map_error])
+
+    def close(self):
+        if self.latency_log is not None:
+            self.latency_log.close()
+
+    def stats(self):
+        with self._lock:
+            faster = {MODE_NATIVE: 0, MODE_WGS84: 0}
+            for latencies in self._latencies.values():
+                if len(latencies.get(MODE_NATIVE, [])) > 0 and len(latencies.get(MODE_WGS84, [])) > 0:
+                    if statistics.median(latencies[MODE_NATIVE]) <= statistics.median(latencies[MODE_WGS84]):
+                        faster[MODE_NATIVE] += 1
+                    else:
+                        faster[MODE_WGS84] += 1
+            return {
+                'requests': dict(self.requests),
+                'mean_seconds': {m: round(self.seconds[m] / self.requests[m], 4) if self.requests[m] > 0 else None for m in self.requests},
+                'errors': dict(self.errors),
+                'transform_errors': self.transform_errors,
+                'wms_faster': faster
+            }
+
+    def log_stats(self):
+        logging.info('GetMap crs: %s', self.stats())
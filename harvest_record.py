@@ -0,0 +1,200 @@
+import ast
+import math
+
+
+# columns of wms_layers.csv, index is position of value in the out_record lists
+WMS_LAYERS_FIELDS = [
+    'csw_url',  # 0
+    'csw_record_identifier',  # 1
+    'csw_record_publisher',  # 2
+    'csw_record_title',  # 3
+    'csw_record_subjects',  # 4
+    'csw_record_abstract',  # 5
+    'csw_record_modified',  # 6
+    'wms_url',  # 7
+    'wms_url_domain',  # 8
+    'wms_layer_for_record_title',  # 9
+    'wms_layer_for_record_name',  # 10
+    'wms_access_constraints',  # 11
+    'only_1_choice',  # 12
+    'match_dist',  # 13
+    'bbox_wgs84',  # 14
+    'bbox_projected',  # 15
+    'wms_get_cap_error',  # 16
+    'wms_get_map_error',  # 17
+    'made_get_map_req',  # 18
+    'image_status',  # 19
+    'out_image_fname'  # 20
+]
+
+BOOL_FIELDS = ('only_1_choice', 'wms_get_cap_error', 'wms_get_map_error', 'made_get_map_req')
+
+# positions of the bbox fields in WMS_LAYERS_FIELDS
+BBOX_FIELD_INDEXES = (WMS_LAYERS_FIELDS.index('bbox_wgs84'), WMS_LAYERS_FIELDS.index('bbox_projected'))
+
+# fields held as text
+TEXT_FIELDS = [f for f in WMS_LAYERS_FIELDS if f not in BOOL_FIELDS and f not in ('match_dist', 'bbox_wgs84', 'bbox_projected')]
+
+
+def format_bbox(bbox):
+    """
+    :param bbox: tuple of 4 numbers (and the crs, if given) or None
+    :return: the bbox as written to wms_layers.csv, its numbers (then crs) space separated i.e. -8.0 49.0 2.0 61.0 or
+    0.0 0.0 700000.0 1300000.0 EPSG:27700, None for no bbox
+    """
+    if bbox is None:
+        return None
+    return ' '.join([repr(float(v)) for v in bbox[:4]] + [str(v) for v in bbox[4:]])
+
+
+def parse_bbox(value):
+    """
+    :param value: bbox as written to wms_layers.csv (see format_bbox()), or as the tuple of an older wms_layers.csv /
+    OWSLib i.e. (0.0, 0.0, 700000.0, 1300000.0, 'EPSG:27700')
+    :return: tuple of 4 floats (and the crs, if given) or None if value is not a bbox
+    """
+    if value is None:
+        return None
+    if value.startswith('('):
+        try:
+            bbox = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return None
+        if not isinstance(bbox, tuple):
+            return None
+    else:
+        bbox = value.split()
+        if len(bbox) == 5 and bbox[4] == 'None':
+            bbox[4] = None
+    if len(bbox) not in (4, 5):
+        return None
+    try:
+        return tuple(float(v) for v in bbox[:4]) + tuple(bbox[4:])
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    return {'True': True, 'False': False}.get(value)
+
+
+def parse_number(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+class HarvestRecord:
+    """
+    One row of the harvest output (a CSW record / WMS layer) with the fields of WMS_LAYERS_FIELDS as attributes.
+
+    Bboxes are held as float coordinates rather than tuples (nan for no bbox) and the flags as bools, so rows read
+    back from any of the sinks (see output_writer) come back typed. as_row() gives the values written to
+    wms_layers.csv, the bboxes as plain space separated numbers (see format_bbox()) rather than tuple text that has to
+    be evaluated to be read back.
+    """
+    __slots__ = tuple(TEXT_FIELDS) + BOOL_FIELDS + (
+        'match_dist',
+        'min_x', 'min_y', 'max_x', 'max_y',
+        'proj_min_x', 'proj_min_y', 'proj_max_x', 'proj_max_y', 'proj_crs', 'proj_has_crs'
+    )
+
+    def __init__(self, **values):
+        """
+        :param values: field name -> value for the fields of WMS_LAYERS_FIELDS, any left out are None
+        """
+        for f in TEXT_FIELDS:
+            setattr(self, f, values.get(f))
+        for f in BOOL_FIELDS:
+            setattr(self, f, values.get(f))
+        self.match_dist = values.get('match_dist')
+        self.bbox_wgs84 = values.get('bbox_wgs84')
+        self.bbox_projected = values.get('bbox_projected')
+
+    @classmethod
+    def from_ref(cls, ref):
+        """
+        :param ref: reference dict that has been through the pipeline
+        """
+        return cls(**{f: ref.get(f) for f in WMS_LAYERS_FIELDS})
+
+    @classmethod
+    def from_row(cls, fields, row):
+        """
+        :param fields: header of wms_layers.csv
+        :param row: list of values read from wms_layers.csv, '' or None for no value
+        """
+        values = {f: (None if v == '' else v) for f, v in zip(fields, row)}
+        for f in BOOL_FIELDS:
+            values[f] = parse_bool(values.get(f))
+        values['match_dist'] = parse_number(values.get('match_dist'))
+        values['bbox_wgs84'] = parse_bbox(values.get('bbox_wgs84'))
+        values['bbox_projected'] = parse_bbox(values.get('bbox_projected'))
+        return cls(**values)
+
+    @property
+    def bbox_wgs84(self):
+        if math.isnan(self.min_x):
+            return None
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+    @bbox_wgs84.setter
+    def bbox_wgs84(self, bbox):
+        if bbox is None:
+            self.min_x = self.min_y = self.max_x = self.max_y = math.nan
+        else:
+            self.min_x, self.min_y, self.max_x, self.max_y = (float(v) for v in bbox[:4])
+
+    @property
+    def bbox_projected(self):
+        if math.isnan(self.proj_min_x):
+            return None
+        bbox = (self.proj_min_x, self.proj_min_y, self.proj_max_x, self.proj_max_y)
+        if self.proj_has_crs:
+            bbox += (self.proj_crs,)
+        return bbox
+
+    @bbox_projected.setter
+    def bbox_projected(self, bbox):
+        if bbox is None:
+            self.proj_min_x = self.proj_min_y = self.proj_max_x = self.proj_max_y = math.nan
+            self.proj_crs = None
+            self.proj_has_crs = False
+        else:
+            self.proj_min_x, self.proj_min_y, self.proj_max_x, self.proj_max_y = (float(v) for v in bbox[:4])
+            # OWSLib falls back to the (4 value) wgs84 bbox where a layer has no BoundingBox
+            self.proj_has_crs = len(bbox) > 4
+            self.proj_crs = bbox[4] if self.proj_has_crs else None
+
+    def key(self):
+        return self.csw_url, self.csw_record_identifier, self.wms_url
+
+    def as_row(self):
+        """
+        :return: list of values in WMS_LAYERS_FIELDS order, as written to wms_layers.csv
+        """
+        row = [getattr(self, f) for f in WMS_LAYERS_FIELDS]
+        for i in BBOX_FIELD_INDEXES:
+            row[i] = format_bbox(row[i])
+        return row
+
+    def as_dict(self):
+        """
+        :return: dict of field name -> value, bboxes as lists of numbers
+        """
+        values = {f: getattr(self, f) for f in WMS_LAYERS_FIELDS}
+        for f in ('bbox_wgs84', 'bbox_projected'):
+            if values[f] is not None:
+                values[f] = list(values[f])
+        return values
+
+    def __repr__(self):
+        return 'HarvestRecord({0!r})'.format(self.key())
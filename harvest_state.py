@@ -0,0 +1,275 @@
+import csv
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+from owslib.fes import PropertyIsGreaterThanOrEqualTo
+
+from capabilities_cache import normalise_endpoint_url
+from harvest_record import HarvestRecord, WMS_LAYERS_FIELDS
+
+
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mapcatalogue', 'harvest_state')
+
+CHANGES_FNAME = 'record_changes.csv'
+CHANGES_FIELDS = ['csw_url', 'csw_record_identifier', 'csw_record_modified', 'change']
+
+# change values written to record_changes.csv
+CHANGE_NEW = 'new'
+CHANGE_UPDATED = 'updated'
+CHANGE_VANISHED = 'vanished'
+
+
+def read_rows(fname):
+    """
+    :param fname: CSV file with a header row, as written by StreamingCsvWriter
+    :return: (header, list of rows), with '' read back as None
+    """
+    if not os.path.exists(fname):
+        return None, []
+    with open(fname, 'r', newline='') as inpf:
+        reader = csv.reader(inpf)
+        header = next(reader, None)
+        return header, [[None if v == '' else v for v in r] for r in reader]
+
+
+def read_record_rows(fname):
+    """
+    :param fname: wms_layers.csv (or the rows of a catalogue kept by HarvestState)
+    :return: (header, list of rows), with the values typed as HarvestRecord has them so that write_rows() writes them
+    back as StreamingCsvWriter first did (the flags and numbers unquoted)
+    """
+    header, rows = read_rows(fname)
+    if header is None:
+        return None, []
+    rows = [dict(zip(WMS_LAYERS_FIELDS, HarvestRecord.from_row(header, r).as_row())) for r in rows]
+    return header, [[r[f] for f in header] for r in rows]
+
+
+def write_rows(fname, header, rows):
+    """
+    (re)write a CSV file the way StreamingCsvWriter does, replacing it in one go
+    """
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w', newline='') as outpf:
+        writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_fname, fname)
+
+
+class CatalogueHarvest:
+    """
+    What one run saw of one CSW: the identifier / dc:modified of every record returned and whether the whole result
+    set was paged through.
+
+    In an incremental run only records modified on or after the day the previous complete harvest of the catalogue
+    started are asked for. Records that have since been deleted do not show up in that query so the catalogue`s
+    total record count is checked too. Every record now in the catalogue is either one we already knew of or one
+    modified since (i.e. new), so if the total is less than the two together some have vanished and only then are
+    the identifiers of the whole catalogue listed to find out which. Records without a dc:modified are only picked up
+    by a full harvest.
+
+    Where the records asked for are limited by a record filter only the records matching it are tracked, so a
+    previous harvest with a different filter does not count.
+    """
+    def __init__(self, csw_url, previous=None, incremental=False, record_filter=None):
+        """
+        :param csw_url: CSW url
+        :param previous: state saved by the previous complete harvest of the catalogue or None
+        :param incremental: only harvest records modified since the previous complete harvest (if there was one)
+        :param record_filter: record filter limiting the records asked for, or None
+        """
+        self.csw_url = csw_url
+        self.record_filter = record_filter
+        if previous is not None and previous.get('record_filter') != record_filter:
+            logging.info('CSW %s was last harvested with record filter %s, not %s', csw_url, previous.get('record_filter'), record_filter)
+            previous = None
+        self.previous = previous
+        self.started = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        self.since = None
+        if incremental and previous is not None:
+            # dc:modified is as often a date as a datetime, so ask for everything from that day on
+            self.since = previous['harvest_started'][:10]
+        self.records = {}  # identifier -> dc:modified of every record returned this run
+        self.present = None  # identifiers of every record in the catalogue, if they had to be listed
+        self.complete = False
+        self._lock = threading.Lock()
+
+    @property
+    def incremental(self):
+        return self.since is not None
+
+    def previous_records(self):
+        return self.previous['records'] if self.previous is not None else {}
+
+    def modified_since(self):
+        """
+        :return: OWSLib fes constraint on dc:modified for GetRecords, or None if the harvest is not incremental
+        """
+        if self.since is None:
+            return None
+        return PropertyIsGreaterThanOrEqualTo('dc:modified', self.since)
+
+    def seen(self, identifier, modified):
+        if identifier is None:
+            return
+        with self._lock:
+            self.records[identifier] = modified
+
+    def needs_listing(self, total_records):
+        """
+        :param total_records: number of records now in the catalogue
+        :return: True if records have vanished and the catalogue`s identifiers need listing to find out which
+        """
+        if not self.incremental or not self.complete:
+            return False
+        return total_records < len(set(self.previous_records()) | set(self.records))
+
+    def changes(self):
+        """
+        :return: list of (identifier, dc:modified, change) since the previous complete harvest
+        """
+        previous_records = self.previous_records()
+        changes = []
+        for identifier, modified in self.records.items():
+            if identifier not in previous_records:
+                changes.append((identifier, modified, CHANGE_NEW))
+            elif previous_records[identifier] != modified:
+                changes.append((identifier, modified, CHANGE_UPDATED))
+        for identifier in sorted(self.vanished()):
+            changes.append((identifier, previous_records[identifier], CHANGE_VANISHED))
+        return changes
+
+    def vanished(self):
+        """
+        :return: set of identifiers of records in the catalogue at the previous complete harvest that are no longer
+        """
+        if not self.complete or self.previous is None:
+            return set()
+        if self.incremental:
+            if self.present is None:
+                return set()
+            return set(self.previous_records()) - self.present - set(self.records)
+        return set(self.previous_records()) - set(self.records)
+
+    def current_records(self):
+        """
+        :return: identifier -> dc:modified of every record in the catalogue as of this harvest
+        """
+        if not self.incremental:
+            return dict(self.records)
+        vanished = self.vanished()
+        records = {k: v for k, v in self.previous_records().items() if k not in vanished}
+        records.update(self.records)
+        return records
+
+
+class HarvestState:
+    """
+    Per catalogue state of the last complete harvest, kept between runs in state_path (outside out_path, which is
+    purged at the start of every run): when it started, the identifier / dc:modified of every record and the
+    wms_layers.csv rows of the catalogue.
+
+    An incremental run only re-harvests the records modified since and merge() then folds the rows it wrote into the
+    rows kept from earlier runs, dropping those of updated and vanished records, so wms_layers.csv still covers the
+    whole catalogue. The record changes are written to record_changes.csv. Full runs save their state too, so they
+    become the baseline of the next incremental run.
+
+    Rows carried over from earlier runs keep the out_image_fname of the run that validated them.
+    """
+    def __init__(self, state_path, incremental=False):
+        """
+        :param state_path: folder holding the state
+        :param incremental: only harvest the records of each catalogue modified since its previous complete harvest
+        """
+        self.state_path = state_path
+        self.incremental = incremental
+        self.harvests = {}  # csw_url -> CatalogueHarvest
+        self._lock = threading.Lock()
+        os.makedirs(state_path, exist_ok=True)
+
+    def _fname(self, csw_url, suffix):
+        key = hashlib.sha1(normalise_endpoint_url(csw_url).encode('utf-8')).hexdigest()
+        return os.path.join(self.state_path, key + suffix)
+
+    def catalogue(self, csw_url, record_filter=None):
+        """
+        :param csw_url: CSW url
+        :param record_filter: record filter limiting the records asked for, or None
+        :return: CatalogueHarvest to track this run`s harvest of csw_url
+        """
+        previous = None
+        state_fname = self._fname(csw_url, '.json')
+        if os.path.exists(state_fname):
+            with open(state_fname, 'r') as inpf:
+                previous = json.load(inpf)
+        harvest = CatalogueHarvest(csw_url, previous=previous, incremental=self.incremental, record_filter=record_filter)
+        if harvest.incremental:
+            logging.info('Harvesting records of CSW %s modified since %s', csw_url, harvest.since)
+        with self._lock:
+            self.harvests[csw_url] = harvest
+        return harvest
+
+    def merge(self, rows_fname, changes_fname):
+        """
+        fold the rows written this run into those kept from earlier runs, write the record changes report and save
+        the state of every catalogue harvested in full
+
+        :param rows_fname: wms_layers.csv of the run, rewritten with the merged rows if any harvest was incremental
+        :param changes_fname: record changes report to write
+        """
+        header, fresh_rows = read_record_rows(rows_fname)
+        if header is None:
+            return
+        csw_url_i = header.index('csw_url')
+        identifier_i = header.index('csw_record_identifier')
+
+        merged_rows = []
+        changes = []
+        for csw_url, harvest in self.harvests.items():
+            rows = [r for r in fresh_rows if r[csw_url_i] == csw_url]
+            if harvest.incremental:
+                # rows of records harvested again (or gone) this run replace those kept from earlier runs
+                replaced = set(harvest.records) | harvest.vanished() | set(r[identifier_i] for r in rows)
+                _, kept_rows = read_record_rows(self._fname(csw_url, '_wms_layers.csv'))
+                kept_rows = [r for r in kept_rows if r[identifier_i] not in replaced]
+                logging.info('Carried %s rows of CSW %s over from earlier runs', len(kept_rows), csw_url)
+                rows = kept_rows + rows
+            merged_rows.extend(rows)
+
+            harvest_changes = harvest.changes()
+            changes.extend([csw_url] + list(c) for c in harvest_changes)
+            logging.info(
+                'CSW %s: %s', csw_url,
+                {c: sum(1 for hc in harvest_changes if hc[2] == c) for c in (CHANGE_NEW, CHANGE_UPDATED, CHANGE_VANISHED)}
+            )
+
+            if harvest.complete:
+                write_rows(self._fname(csw_url, '_wms_layers.csv'), header, rows)
+                self._save(harvest)
+            else:
+                logging.info('CSW %s was not harvested in full, its harvest state is left as it was', csw_url)
+
+        # only an incremental harvest adds rows kept from earlier runs, otherwise the rows written this run are left as
+        # they are
+        if any(h.incremental for h in self.harvests.values()):
+            # rows of any catalogue not tracked are passed through as they are
+            merged_rows.extend(r for r in fresh_rows if r[csw_url_i] not in self.harvests)
+            write_rows(rows_fname, header, merged_rows)
+        write_rows(changes_fname, CHANGES_FIELDS, changes)
+
+    def _save(self, harvest):
+        state = {
+            'csw_url': harvest.csw_url,
+            'harvest_started': harvest.started,
+            'record_filter': harvest.record_filter,
+            'records': harvest.current_records()
+        }
+        state_fname = self._fname(harvest.csw_url, '.json')
+        tmp_fname = state_fname + '.tmp'
+        with open(tmp_fname, 'w') as outpf:
+            json.dump(state, outpf)
+        os.replace(tmp_fname, state_fname)
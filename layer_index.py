@@ -0,0 +1,196 @@
+from collections import Counter
+import threading
+import Levenshtein as Lvn # https://rawgit.com/ztane/python-Levenshtein/master/docs/Levenshtein.html
+import numpy as np
+
+from wms_capabilities import LayerTable
+
+
+# q-gram length used to prune fuzzy match candidates
+Q = 2
+
+
+def qgrams(s):
+    """
+    :param s: a string
+    :return: Counter of the overlapping q-grams of s
+    """
+    return Counter(s[i:i + Q] for i in range(len(s) - Q + 1))
+
+
+def bounded_distance(s1, s2, cutoff=None):
+    """
+    Levenshtein distance between s1 and s2 or, where the installed Levenshtein supports score_cutoff, any value
+    greater than cutoff once the distance is known to exceed it (so the calculation can stop early)
+
+    :param cutoff: the largest distance of interest or None for no cutoff
+    """
+    if cutoff is None or not _HAVE_SCORE_CUTOFF:
+        return Lvn.distance(s1, s2)
+    return Lvn.distance(s1, s2, score_cutoff=cutoff)
+
+
+# the cutoff is best effort: python-Levenshtein 0.12 (as pinned in requirements.txt) has no score_cutoff, so there
+# every verified title is measured in full. The q-gram pruning does not depend on it and gives the same answer either way
+try:
+    Lvn.distance('', '', score_cutoff=0)
+    _HAVE_SCORE_CUTOFF = True
+except TypeError:
+    _HAVE_SCORE_CUTOFF = False
+
+
+class LayerIndex:
+    """
+    Index of the named layers of one WMS, built once per GetCapabilities document and then shared (read-only) by
+    every record / thread matching against that WMS.
+
+    Layer names and titles are held in wms.contents order, exact titles map to the position of the first layer with
+    that title and names map to their position, so exact title matches and name lookups are hash lookups rather
+    than scans of wms.contents.
+
+    Fuzzy (Levenshtein) matching prunes the layers using an inverted index of title q-grams. Strings d edits apart
+    share at least max(len) - Q + 1 - Q * d q-grams and differ in length by at most d, so a lower bound on the
+    distance to every title falls out of counting the q-grams each shares with the record title. Titles are then
+    verified in order of their lower bound, stopping as soon as no remaining title can beat (or tie with an earlier
+    layer than) the best found, which gives the same answer as scanning them all.
+    """
+    prune_min_layers = 64  # below this many layers a plain scan is quicker than pruning
+
+    def __init__(self, wms):
+        """
+        :param wms: OWSLib WebMapService object
+        """
+        contents = wms.contents
+        if isinstance(contents, LayerTable):
+            # names / titles are read straight from the streamed layer table rather than a layer object at a time
+            self.names = list(contents.names)
+            self.titles = list(contents.titles)
+        else:
+            self.names = []  # WMS Layer <Name> Machine-Readable, in wms.contents order
+            self.titles = []  # WMS Layer <Title> Human-Readable, in wms.contents order
+            for i in contents:
+                self.names.append(wms[i].name)
+                self.titles.append(wms[i].title)
+        self.positions = {}  # name -> position
+        self.title_positions = {}  # title -> position of first layer with that title
+        for position, (name, title) in enumerate(zip(self.names, self.titles)):
+            self.positions.setdefault(name, position)
+            self.title_positions.setdefault(title, position)
+
+        self._lock = threading.Lock()
+        self._postings = None  # q-gram -> (positions array, counts array), built on first fuzzy match
+        self._lengths = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def exact_position(self, title):
+        """
+        :param title: title to look for
+        :return: position of the first layer whose title is exactly title, or None
+        """
+        return self.title_positions.get(title)
+
+    def closest_position(self, title):
+        """
+        the first layer whose title is the smallest Levenshtein distance from title
+
+        :param title: title to match
+        :return: (position, distance) or (None, None) if there are no layers
+        """
+        if len(self.titles) < self.prune_min_layers or title is None or None in self.title_positions:
+            return self._scan(title)
+
+        self._build_postings()
+
+        # count the q-grams (as a multiset) each title shares with title
+        common = np.zeros(len(self.titles), dtype=np.int32)
+        for gram, count in qgrams(title).items():
+            posting = self._postings.get(gram)
+            if posting is not None:
+                common[posting[0]] += np.minimum(posting[1], count)
+
+        title_len = len(title)
+        longest = np.maximum(self._lengths, title_len)
+        gram_bound = -((common - longest + Q - 1) // Q)  # ceil((longest - Q + 1 - common) / Q)
+        lower_bounds = np.maximum(np.abs(self._lengths - title_len), gram_bound)
+
+        order = np.argsort(lower_bounds, kind='stable')
+        sorted_bounds = lower_bounds[order]
+        run_starts = np.flatnonzero(np.r_[True, sorted_bounds[1:] != sorted_bounds[:-1]]).tolist()
+
+        best_position = None
+        best_dist = None
+        # verify titles a run of equal lower bound at a time, each run in layer order
+        for run_start, run_end in zip(run_starts, run_starts[1:] + [len(order)]):
+            lower_bound = int(sorted_bounds[run_start])
+            positions = order[run_start:run_end].tolist()
+            if best_dist is not None:
+                if lower_bound > best_dist:
+                    break
+                if lower_bound == best_dist:
+                    # can at best tie, which only counts for a layer ahead of the best so far
+                    positions = [p for p in positions if p < best_position]
+                    if len(positions) == 0:
+                        break
+
+            dists = [bounded_distance(title, self.titles[p], best_dist) for p in positions]
+            run_best = min(dists)
+            run_best_position = positions[dists.index(run_best)]
+            if best_dist is None or run_best < best_dist or (run_best == best_dist and run_best_position < best_position):
+                best_position = run_best_position
+                best_dist = run_best
+
+        return best_position, best_dist
+
+    def _scan(self, title):
+        best_position = None
+        best_dist = None
+        for position, layer_title in enumerate(self.titles):
+            dist = Lvn.distance(title, layer_title)
+            if best_dist is None or dist < best_dist:
+                best_position = position
+                best_dist = dist
+
+        return best_position, best_dist
+
+    def _build_postings(self):
+        with self._lock:
+            if self._postings is not None:
+                return
+            postings = {}
+            for position, layer_title in enumerate(self.titles):
+                for gram, count in qgrams(layer_title).items():
+                    posting = postings.setdefault(gram, ([], []))
+                    posting[0].append(position)
+                    posting[1].append(count)
+            self._lengths = np.array([len(t) for t in self.titles], dtype=np.int32)
+            self._postings = {
+                gram: (np.array(posting[0], dtype=np.int32), np.array(posting[1], dtype=np.int32))
+                for gram, posting in postings.items()
+            }
+
+
+_build_lock = threading.Lock()
+
+
+def layer_index(wms):
+    """
+    the LayerIndex of wms, built on first use and kept on the WebMapService object itself so it lives exactly as long
+    as the parsed capabilities (i.e. for the run, in the capabilities cache)
+
+    :param wms: OWSLib WebMapService object
+    :return: LayerIndex
+    """
+    index = getattr(wms, '_layer_index', None)
+    if index is None:
+        with _build_lock:
+            index = getattr(wms, '_layer_index', None)
+            if index is None:
+                index = LayerIndex(wms)
+                wms._layer_index = index
+
+    return index
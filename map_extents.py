@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import threading
+import weakref
+import numpy as np
+
+from wms_capabilities import LayerTable
+
+
+# region sets the GetMap request extents can be clipped to, name -> (minx, miny, maxx, maxy) in wgs84
+REGION_SETS = {
+    # the ogc_inspector.UkRegions extents, in wgs84
+    'uk': {
+        'northern_ireland': (-8.3, 53.94, -5.4, 55.34),
+        'scotland': (-9.23, 54.51, -0.71, 60.87),
+        'england': (-7.05, 49.86, 2.07, 55.81),
+        'wales': (-5.81, 51.32, -2.64, 53.46)
+    }
+}
+
+# an extent covering at least this fraction of the width and height of the world is taken to be a default extent
+# rather than one describing where the layer has data
+WORLD_FRACTION = 0.9
+
+# width / height in degrees a point (or line) extent is widened to, servers reject a GetMap bbox of no area
+MIN_SPAN = 0.01
+
+
+def load_regions(value):
+    """
+    :param value: name of one of REGION_SETS, or a JSON file of region name -> [minx, miny, maxx, maxy] in wgs84
+    :return: dict of region name -> bbox
+    """
+    if value in REGION_SETS:
+        return REGION_SETS[value]
+    if os.path.isfile(value):
+        with open(value, 'r') as inpf:
+            return {name: tuple(float(v) for v in bbox) for name, bbox in json.load(inpf).items()}
+    raise ValueError('{0} is neither a region set ({1}) nor a file'.format(value, ', '.join(sorted(REGION_SETS))))
+
+
+def bbox_areas(bboxes):
+    """
+    :param bboxes: (n, 4) array of minx, miny, maxx, maxy
+    :return: (n,) array of areas (in square degrees), nan for no bbox
+    """
+    return (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+
+
+def whole_world(bboxes, fraction=WORLD_FRACTION):
+    """
+    :param bboxes: (n, 4) array of wgs84 minx, miny, maxx, maxy
+    :return: (n,) bool array, True for the extents that cover (all but the edges of) the world
+    """
+    with np.errstate(invalid='ignore'):
+        return ((bboxes[:, 2] - bboxes[:, 0]) >= 360.0 * fraction) & ((bboxes[:, 3] - bboxes[:, 1]) >= 180.0 * fraction)
+
+
+def clip_to_regions(bboxes, regions, covering_only=None):
+    """
+    clip each bbox to the region it overlaps most
+
+    :param bboxes: (n, 4) array of minx, miny, maxx, maxy
+    :param regions: (m, 4) array of region bboxes
+    :param covering_only: optional (n,) bool array, True for the bboxes only clipped to a region they cover the whole
+    of, so that a bbox describing where a layer has data is not cut down to the sliver of it inside a region
+    :return: (clipped bboxes, (n,) array of the index of the region clipped to, -1 where no region overlaps)
+    """
+    if len(regions) == 0:
+        return bboxes.copy(), np.full(len(bboxes), -1, dtype=np.int64)
+    # (n, m) intersections of every bbox with every region
+    mins = np.maximum(bboxes[:, None, :2], regions[None, :, :2])
+    maxs = np.minimum(bboxes[:, None, 2:], regions[None, :, 2:])
+    with np.errstate(invalid='ignore'):
+        overlaps = np.clip(maxs - mins, 0.0, None).prod(axis=2)
+        if covering_only is not None:
+            covers = (bboxes[:, None, :2] <= regions[None, :, :2]).all(axis=2) & (bboxes[:, None, 2:] >= regions[None, :, 2:]).all(axis=2)
+            overlaps = np.where(covering_only[:, None] & ~covers, 0.0, overlaps)
+    overlaps = np.nan_to_num(overlaps, nan=0.0)
+    best = overlaps.argmax(axis=1)
+    rows = np.arange(len(bboxes))
+    region_is = np.where(overlaps[rows, best] > 0.0, best, -1)
+
+    clipped = bboxes.copy()
+    has_region = region_is >= 0
+    clipped[has_region, :2] = mins[rows, best][has_region]
+    clipped[has_region, 2:] = maxs[rows, best][has_region]
+    return clipped, region_is
+
+
+class ExtentPlanner:
+    """
+    Picks the extent (and image size) of the GetMap request that validates each layer, in place of the whole layer
+    extent at 400x400, which for the many layers advertising whole world / whole country extents is slow for servers
+    to render and usually comes back blank at that scale.
+
+    Extents are worked out with numpy for all the layers of a WMS at once, the first time any of them is requested,
+    and kept for as long as the WebMapService object is. Each layer extent is
+        1. clipped to the world
+        2. clipped to the region (of the region set, if any) it overlaps most, if it is a whole world extent or covers
+        the whole of the region. Other extents say where the layer has data and are left as they are
+        3. shrunk around its centre to at most max_span degrees across, unless it is a whole world extent (a default
+        rather than where the layer has data) that no region was clipped from
+    and the image size keeps its aspect ratio with its longer side max_size pixels.
+    """
+    def __init__(self, regions=None, max_span=2.0, max_size=400):
+        """
+        :param regions: optional dict of region name -> wgs84 bbox to clip extents to, see REGION_SETS
+        :param max_span: max width / height of a request extent in degrees
+        :param max_size: width / height (whichever is the longer side) of the map image in pixels
+        """
+        self.region_names = list(regions) if regions is not None else []
+        self.regions = np.array([regions[n] for n in self.region_names], dtype=np.float64).reshape(-1, 4)
+        self.max_span = max_span
+        self.max_size = max_size
+        self._plans = weakref.WeakKeyDictionary()  # WebMapService -> (name -> row, extents, sizes)
+        self._lock = threading.Lock()
+        self.layers = 0
+        self.whole_world = 0
+        self.clipped = 0
+        self.shrunk = 0
+        self.requests = 0
+
+    def plan(self, bboxes):
+        """
+        :param bboxes: (n, 4) array of wgs84 layer extents, nan for none
+        :return: ((n, 4) array of request extents, nan where there is no layer extent, (n, 2) int array of image
+        width and height, dict of the number of layers whole_world, clipped (to a region) and shrunk)
+        """
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        extents = bboxes.copy()
+        extents[:, :2] = np.maximum(extents[:, :2], (-180.0, -90.0))
+        extents[:, 2:] = np.minimum(extents[:, 2:], (180.0, 90.0))
+        world = whole_world(extents)
+
+        # only default (whole world) extents, and those covering the whole of a region, are clipped to a region
+        extents, region_is = clip_to_regions(extents, self.regions, covering_only=~world)
+
+        centres = (extents[:, :2] + extents[:, 2:]) / 2.0
+        spans = np.maximum(extents[:, 2:] - extents[:, :2], MIN_SPAN)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scale = np.minimum(1.0, self.max_span / spans.max(axis=1))
+            # the middle of a default (whole world) extent says nothing about where the layer has data, so unless it
+            # has been clipped to a region it is requested as it is
+            scale[world & (region_is < 0)] = 1.0
+            shrunk = scale < 1.0
+            spans = spans * scale[:, None]
+            extents = np.hstack([centres - spans / 2.0, centres + spans / 2.0])
+
+            # the longer side is max_size
+            longest = spans.max(axis=1)
+            sizes = np.where(longest[:, None] > 0.0, np.rint(self.max_size * spans / longest[:, None]), self.max_size)
+        sizes = np.clip(np.nan_to_num(sizes, nan=self.max_size), 1, self.max_size).astype(np.int64)
+
+        return extents, sizes, {
+            'whole_world': int(world.sum()),
+            'clipped': int((region_is >= 0).sum()),
+            'shrunk': int(shrunk.sum())
+        }
+
+    def _wms_plan(self, wms):
+        with self._lock:
+            plan = self._plans.get(wms)
+        if plan is not None:
+            return plan
+
+        contents = wms.contents
+        if isinstance(contents, LayerTable):
+            names = contents.names
+            bboxes = np.array(contents.wgs84_bbox_values(), dtype=np.float64).reshape(-1, 4)
+        else:
+            names = list(contents)
+            bboxes = np.array([
+                contents[n].boundingBoxWGS84 if contents[n].boundingBoxWGS84 is not None else (np.nan,) * 4 for n in names
+            ], dtype=np.float64).reshape(-1, 4)
+
+        extents, sizes, counts = self.plan(bboxes)
+        plan = ({n: i for i, n in enumerate(names)}, extents, sizes)
+        with self._lock:
+            self._plans[wms] = plan
+            self.layers += len(names)
+            self.whole_world += counts['whole_world']
+            self.clipped += counts['clipped']
+            self.shrunk += counts['shrunk']
+        return plan
+
+    def request_extent(self, wms, wms_layer_name):
+        """
+        :param wms: OWSLib WebMapService object (or a streamed one)
+        :param wms_layer_name: name of a layer of wms
+        :return: (bbox, (width, height)) of the GetMap request for the layer, or None if it has no wgs84 extent
+        """
+        rows, extents, sizes = self._wms_plan(wms)
+        row = rows.get(wms_layer_name)
+        if row is None or np.isnan(extents[row]).any():
+            return None
+        with self._lock:
+            self.requests += 1
+        return tuple(extents[row].tolist()), tuple(sizes[row].tolist())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'layers': self.layers,
+                'whole_world': self.whole_world,
+                'clipped': self.clipped,
+                'shrunk': self.shrunk,
+                'requests': self.requests
+            }
+
+    def log_stats(self):
+        logging.info('GetMap extent planner: %s', self.stats())
@@ -0,0 +1,181 @@
+import hashlib
+from io import BytesIO
+import json
+import logging
+import os
+import threading
+import numpy as np
+from PIL import Image
+
+
+# image_status values written to wms_layers.csv
+IMAGE_POPULATED = "seems to be populated"
+# other cause of this could be that data is not visible at this scale
+IMAGE_BACKGROUND = "seems to all be background / no layer features in extent?"
+IMAGE_NO_SIZE = "seems to be a nosize img"
+IMAGE_INVALID = "Invalid"
+
+# pixels compared to the first pixel per numpy operation when looking for a second colour
+SCAN_CHUNK_PIXELS = 16384
+
+
+def has_more_than_one_colour(im):
+    """
+    True if the image has more than one distinct pixel value (as im.getcolors() would count them) without building a
+    colour histogram.
+
+    Single band images (incl. palette images, where the palette index is the pixel value) are settled by the band`s
+    extrema. Multi band images are compared against their first pixel a chunk at a time, stopping at the first pixel
+    that differs, which for a populated map is usually within the first few rows
+
+    :param im: PIL Image
+    :return: bool
+    """
+    if len(im.getbands()) == 1:
+        extrema = im.getextrema()
+        return extrema[0] != extrema[1]
+
+    pixels = np.asarray(im)
+    pixels = pixels.reshape(-1, pixels.shape[-1]) if pixels.ndim == 3 else pixels.reshape(-1)
+    first = pixels[0]
+    for start in range(0, len(pixels), SCAN_CHUNK_PIXELS):
+        if (pixels[start:start + SCAN_CHUNK_PIXELS] != first).any():
+            return True
+
+    return False
+
+
+def check_map_image_bytes(img):
+    """
+    validate a GetMap response held in memory
+
+    :param img: image bytes
+    :return: one of the IMAGE_ statuses
+    """
+    if len(img) == 0:
+        status = IMAGE_NO_SIZE
+    else:
+        try:
+            # only the header is read here, a response that is not an image fails straight away
+            with Image.open(BytesIO(img)) as im:
+                if has_more_than_one_colour(im):
+                    status = IMAGE_POPULATED
+                else:
+                    status = IMAGE_BACKGROUND
+        # TODO improve caught exception specifity
+        except Exception:
+            logging.exception("Exception raised when checking image.")
+            status = IMAGE_INVALID
+
+    logging.info('Image Status is: %s', status)
+    return status
+
+
+DEFAULT_SIGNATURES_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mapcatalogue', 'map_image_signatures.json')
+
+# statuses of the responses worth remembering between runs, servers return byte-identical blank / error images for
+# every layer that has nothing to draw or has failed
+SIGNATURE_STATUSES = (IMAGE_BACKGROUND, IMAGE_NO_SIZE, IMAGE_INVALID)
+
+
+class MapImageStore:
+    """
+    Validates GetMap images and writes them to out_path under their content hash (<sha256>_wms_map.png) so that
+    identical images are only written, and only decoded, once.
+
+    The sha256 of every blank / error image seen is kept in a signatures file which should live outside out_path
+    (tidy() purges that at the start of every run) so that in later runs a matching response is classified without
+    decoding it at all.
+    """
+    def __init__(self, out_path, signatures_fname=None, write_images=True):
+        """
+        :param out_path: where to write images
+        :param signatures_fname: optional JSON file of known blank / error image signatures, read now and written by
+            save_signatures()
+        :param write_images: write images to out_path, otherwise they are only validated
+        """
+        self.out_path = out_path
+        self.signatures_fname = signatures_fname
+        self.write_images = write_images
+        self.checked = 0
+        self.signature_hits = 0
+        self.decoded = 0
+        self.written = 0
+        self._lock = threading.Lock()
+        self._statuses = {}  # sha256 -> status of every image seen this run
+        self._signatures = {hashlib.sha256(b'').hexdigest(): IMAGE_NO_SIZE}  # sha256 -> status, known blank / error
+        self._written = set()  # sha256 of images written this run
+
+        if signatures_fname is not None and os.path.exists(signatures_fname):
+            with open(signatures_fname, 'r') as inpf:
+                self._signatures.update(json.load(inpf))
+            logging.info('Loaded %s known map image signatures', len(self._signatures))
+
+    def check(self, img):
+        """
+        validate a GetMap image (and write it if writing images)
+
+        :param img: image bytes
+        :return: (image status, image file name or None)
+        """
+        sha256 = hashlib.sha256(img).hexdigest()
+        with self._lock:
+            self.checked += 1
+            status = self._statuses.get(sha256)
+            if status is None:
+                status = self._signatures.get(sha256)
+                if status is not None:
+                    self.signature_hits += 1
+
+        if status is None:
+            status = check_map_image_bytes(img)
+            with self._lock:
+                self.decoded += 1
+                self._statuses[sha256] = status
+                if status in SIGNATURE_STATUSES:
+                    self._signatures[sha256] = status
+        else:
+            logging.info('Image Status is: %s (known image %s)', status, sha256)
+
+        out_image_fname = None
+        if self.write_images:
+            out_image_fname = os.path.join(self.out_path, "".join([sha256, "_wms_map.png"]))
+            with self._lock:
+                write = sha256 not in self._written and not os.path.exists(out_image_fname)
+                self._written.add(sha256)
+            if write:
+                tmp_fname = '{0}.{1}.tmp'.format(out_image_fname, threading.get_ident())
+                with open(tmp_fname, 'wb') as outpf:
+                    outpf.write(img)
+                os.replace(tmp_fname, out_image_fname)
+                with self._lock:
+                    self.written += 1
+
+        return status, out_image_fname
+
+    def save_signatures(self):
+        if self.signatures_fname is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.signatures_fname)), exist_ok=True)
+        with self._lock:
+            signatures = dict(self._signatures)
+        tmp_fname = self.signatures_fname + '.tmp'
+        with open(tmp_fname, 'w') as outpf:
+            json.dump(signatures, outpf)
+        os.replace(tmp_fname, self.signatures_fname)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'signature_hits': self.signature_hits,
+                'decoded': self.decoded,
+                'written': self.written,
+                'known_signatures': len(self._signatures)
+            }
+
+    def log_stats(self):
+        logging.info(
+            'Map images: {checked} checked, {signature_hits} known signatures, {decoded} decoded, {written} written, '
+            '{known_signatures} signatures known'.format(**self.stats())
+        )
@@ -9,6 +9,9 @@ from PIL import Image
 import requests
 from shapely.geometry import box
 
+from extent_index import ExtentIndex
+from harvest_record import parse_bbox
+
 
 class UkRegions:
     def __init__(self):
@@ -140,6 +143,9 @@ def interrogate_wms_layers(in_fn='/home/james/geocrud/wms_layers_w_bbox.csv'):
 
     uk_regions = (UkRegions()).as_dict()
     uk = uk_regions['uk']
+    # the regions a layer bbox intersects are looked up in an index of the region extents
+    region_names = [rgn for rgn in uk_regions if rgn != 'uk']
+    regions_index = ExtentIndex.from_bboxes([uk_regions[rgn].bounds for rgn in region_names])
 
     c = 0
     all_srs = {}
@@ -154,12 +160,7 @@ def interrogate_wms_layers(in_fn='/home/james/geocrud/wms_layers_w_bbox.csv'):
                 title = r['title']
                 url = r['url']
                 lyr_name = r['wms_layer_for_record']
-                lyr_bbox = ((r['bb'])[1:-1]).split(',')
-                xmin = float(lyr_bbox[0])
-                ymin = float(lyr_bbox[1])
-                xmax = float(lyr_bbox[2])
-                ymax = float(lyr_bbox[3])
-                srs = (lyr_bbox[4].replace("'", "")).strip()
+                xmin, ymin, xmax, ymax, srs = parse_bbox(r['bb'])
                 print(c, "For Layer {}".format(title))
                 is_bng = False
                 if srs is not None:
@@ -180,14 +181,13 @@ def interrogate_wms_layers(in_fn='/home/james/geocrud/wms_layers_w_bbox.csv'):
                         print("\t\tBBox IS NOT equal to UK standard BBox".format(title))
                         print("\t\tIt however intersects with the following regions:")
 
-                        for rgn in uk_regions:
-                            if rgn != 'uk':
-                                rgn_g = uk_regions[rgn]
-                                if wms_bbox.intersects(rgn_g):
+                        for i in sorted(regions_index.query_bbox(wms_bbox.bounds)):
+                            rgn = region_names[i]
+                            rgn_g = uk_regions[rgn]
 
-                                    crude_comparision = round(((wms_bbox.area / rgn_g.area) * 100.0), 4)
+                            crude_comparision = round(((wms_bbox.area / rgn_g.area) * 100.0), 4)
 
-                                    print("\t\t\t {} ({}%)".format(rgn, crude_comparision))
+                            print("\t\t\t {} ({}%)".format(rgn, crude_comparision))
 
                     print("\tMaking GetMap() request using Layer BBox...")
                     wms_error, out_fn = interrogate_wms_layer(
@@ -0,0 +1,394 @@
+import abc
+import csv
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from harvest_record import BOOL_FIELDS, HarvestRecord, WMS_LAYERS_FIELDS
+
+
+class _AfterWritten:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+
+class RecordSink(abc.ABC):
+    """
+    Where harvest rows end up. write() is only ever called from the one writer thread
+    """
+    @abc.abstractmethod
+    def write(self, record):
+        """
+        :param record: HarvestRecord (or a list of values, for sinks that take them)
+        """
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        """
+        make everything written so far durable
+        """
+        self.flush()
+
+    def close(self):
+        pass
+
+
+class CsvSink(RecordSink):
+    """
+    Appends rows to a CSV file, quoting the non-numeric values
+    """
+    def __init__(self, fname, header=None):
+        """
+        :param fname: CSV file to append to
+        :param header: list of field names written first if fname does not yet exist
+        """
+        self.fname = fname
+        write_header = header is not None and not os.path.exists(fname)
+        self._outpf = open(fname, 'a', newline='')
+        self._writer = csv.writer(self._outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        if write_header:
+            self._writer.writerow(header)
+
+    def write(self, record):
+        self._writer.writerow(record.as_row() if isinstance(record, HarvestRecord) else record)
+
+    def flush(self):
+        self._outpf.flush()
+
+    def sync(self):
+        self._outpf.flush()
+        os.fsync(self._outpf.fileno())
+
+    def close(self):
+        self._outpf.close()
+
+
+class JsonLinesSink(RecordSink):
+    """
+    Appends HarvestRecords to a JSON Lines file, one object per record with the bboxes as arrays of numbers
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self._outpf = open(fname, 'a')
+
+    def write(self, record):
+        self._outpf.write(json.dumps(record.as_dict()) + '\n')
+
+    def flush(self):
+        self._outpf.flush()
+
+    def sync(self):
+        self._outpf.flush()
+        os.fsync(self._outpf.fileno())
+
+    def close(self):
+        self._outpf.close()
+
+
+# SQLite column types of the wms_layers table, the bboxes are held as typed coordinate columns
+SQLITE_COLUMNS = [
+    (f, 'INTEGER' if f in BOOL_FIELDS else 'NUMERIC' if f == 'match_dist' else 'TEXT')
+    for f in WMS_LAYERS_FIELDS if f not in ('bbox_wgs84', 'bbox_projected')
+] + [(c, 'REAL') for c in ('min_x', 'min_y', 'max_x', 'max_y', 'proj_min_x', 'proj_min_y', 'proj_max_x', 'proj_max_y')] + [
+    ('proj_crs', 'TEXT')
+]
+
+
+def sqlite_values(record):
+    """
+    :param record: HarvestRecord
+    :return: tuple of values for SQLITE_COLUMNS, None for no bbox
+    """
+    values = []
+    for c, _ in SQLITE_COLUMNS:
+        v = getattr(record, c)
+        values.append(None if isinstance(v, float) and v != v else v)
+    return tuple(values)
+
+
+def sqlite_record(row):
+    """
+    :param row: sqlite3.Row of the wms_layers table
+    :return: HarvestRecord
+    """
+    values = {f: row[f] for f in WMS_LAYERS_FIELDS if f not in ('bbox_wgs84', 'bbox_projected')}
+    for f in BOOL_FIELDS:
+        values[f] = bool(values[f]) if values[f] is not None else None
+    if row['min_x'] is not None:
+        values['bbox_wgs84'] = (row['min_x'], row['min_y'], row['max_x'], row['max_y'])
+    if row['proj_min_x'] is not None:
+        values['bbox_projected'] = (row['proj_min_x'], row['proj_min_y'], row['proj_max_x'], row['proj_max_y'], row['proj_crs'])
+    return HarvestRecord(**values)
+
+
+class SqliteSink(RecordSink):
+    """
+    Inserts HarvestRecords into the wms_layers table of a SQLite db, committing in batches
+    """
+    def __init__(self, fname, commit_every=1000):
+        """
+        :param fname: SQLite db file, created if it does not exist
+        :param commit_every: rows per transaction
+        """
+        self.fname = fname
+        self.commit_every = commit_every
+        # opened here but only ever written from the writer thread
+        self._conn = sqlite3.connect(fname, check_same_thread=False)
+        self._create_tables()
+        self._insert_sql = self._insert_statement()
+        self._pending = []
+
+    def _create_tables(self):
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS wms_layers ({0})'.format(', '.join('{0} {1}'.format(c, t) for c, t in SQLITE_COLUMNS))
+        )
+
+    def _insert_statement(self):
+        return 'INSERT INTO wms_layers ({0}) VALUES ({1})'.format(
+            ', '.join(c for c, _ in SQLITE_COLUMNS), ', '.join('?' * len(SQLITE_COLUMNS))
+        )
+
+    def write(self, record):
+        self._pending.append(sqlite_values(record))
+        if len(self._pending) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending) > 0:
+            self._conn.executemany(self._insert_sql, self._pending)
+            self._pending = []
+        self._conn.commit()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class TeeSink(RecordSink):
+    """
+    Writes each record to several sinks. A failure of the first sink is raised as usual (stopping the writer), any
+    other sink that fails is logged and left out from then on so it cannot hold up the first
+    """
+    def __init__(self, sinks):
+        """
+        :param sinks: list of RecordSink, the first being the one that matters
+        """
+        self.sinks = list(sinks)
+        self.fname = getattr(self.sinks[0], 'fname', None)
+
+    def _each(self, method, *args):
+        getattr(self.sinks[0], method)(*args)
+        for sink in self.sinks[1:]:
+            try:
+                getattr(sink, method)(*args)
+            # TODO improve caught exception specifity
+            except Exception:
+                logging.exception('Exception raised when writing to %s, no longer writing to it', getattr(sink, 'fname', sink))
+                self.sinks.remove(sink)
+                try:
+                    sink.close()
+                except Exception:
+                    pass
+
+    def write(self, record):
+        self._each('write', record)
+
+    def flush(self):
+        self._each('flush')
+
+    def sync(self):
+        self._each('sync')
+
+    def close(self):
+        for sink in self.sinks[1:]:
+            try:
+                sink.close()
+            # TODO improve caught exception specifity
+            except Exception:
+                logging.exception('Exception raised when closing %s', getattr(sink, 'fname', sink))
+        self.sinks[0].close()
+
+
+# output formats that can be written alongside wms_layers.csv, format -> (file name, sink class)
+OUTPUT_FORMATS = {
+    'jsonl': ('wms_layers.jsonl', JsonLinesSink),
+    'sqlite': ('wms_layers.sqlite', SqliteSink)
+}
+
+
+def open_sink(output_format, out_path):
+    """
+    :param output_format: key of OUTPUT_FORMATS
+    :param out_path: folder to write the output to
+    :return: RecordSink, writing to a new file
+    """
+    fname, sink_class = OUTPUT_FORMATS[output_format]
+    fname = os.path.join(out_path, fname)
+    if os.path.exists(fname):
+        os.remove(fname)
+    return sink_class(fname)
+
+
+def read_records(fname):
+    """
+    :param fname: wms_layers.csv
+    :return: iterator of HarvestRecords
+    """
+    with open(fname, 'r', newline='') as inpf:
+        reader = csv.reader(inpf)
+        fields = next(reader, None)
+        if fields is None:
+            return
+        for r in reader:
+            yield HarvestRecord.from_row(fields, r)
+
+
+def export_records(rows_fname, sinks):
+    """
+    write every row of wms_layers.csv to each of sinks, closing them
+
+    :param rows_fname: wms_layers.csv
+    :param sinks: list of RecordSink
+    :return: number of records written
+    """
+    n = 0
+    try:
+        for record in read_records(rows_fname):
+            for sink in sinks:
+                sink.write(record)
+            n += 1
+    finally:
+        for sink in sinks:
+            sink.close()
+    return n
+
+
+class StreamingWriter:
+    """
+    Writes harvest rows to a RecordSink from a single background thread, in the order producers hand them over
+    (i.e. as each worker finishes with a record rather than in page submission order).
+
+    Rows go via a bounded queue so if the writer falls behind, put() blocks the producing worker threads until there
+    is room (backpressure), keeping memory use flat no matter how big the catalogue is. The sink is flushed every
+    flush_every rows and whenever flush_seconds pass without one.
+    """
+    _done = object()  # queue sentinel
+
+    def __init__(self, sink, max_queued_rows=1000, flush_every=100, flush_seconds=5.0):
+        """
+        :param sink: RecordSink to write to
+        :param max_queued_rows: rows that can be waiting to be written before put() blocks
+        :param flush_every: flush after this many rows
+        :param flush_seconds: flush if this long has passed since the last flush
+        """
+        self.sink = sink
+        self.fname = getattr(sink, 'fname', None)
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.rows_written = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_queued_rows)
+
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        """
+        queue a row for writing, blocking while the queue is full
+
+        :param row: HarvestRecord (or list of values)
+        """
+        self._queue.put(row)
+
+    def after_written(self, fn, *args):
+        """
+        call fn(*args) on the writer thread once every row put so far has been written and flushed to disk. fn is not
+        called if any row could not be written
+
+        :param fn: callable
+        """
+        self._queue.put(_AfterWritten(fn, args))
+
+    def _run(self):
+        unflushed = 0
+        last_flush = time.time()
+        while True:
+            try:
+                row = self._queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                row = None
+
+            if row is self._done:
+                break
+
+            if isinstance(row, _AfterWritten):
+                if self._error is None:
+                    try:
+                        self.sink.sync()
+                    except Exception as ex:
+                        logging.exception('Exception raised when syncing %s', self.fname)
+                        self._error = ex
+                unflushed = 0
+                last_flush = time.time()
+                # rows that were never written must not be taken as done, i.e. journaled as a completed page
+                if self._error is not None:
+                    logging.error('Skipped after_written callback as rows could not be written to %s', self.fname)
+                    continue
+                try:
+                    row.fn(*row.args)
+                except Exception:
+                    logging.exception('Exception raised in after_written callback')
+                continue
+
+            if row is not None and self._error is None:
+                try:
+                    self.sink.write(row)
+                    self.rows_written += 1
+                    unflushed += 1
+                # keep draining the queue after a failure so producers blocked on put() are not deadlocked
+                except Exception as ex:
+                    logging.exception('Exception raised when writing row to %s', self.fname)
+                    self._error = ex
+
+            if unflushed > 0 and (unflushed >= self.flush_every or time.time() - last_flush >= self.flush_seconds):
+                self.sink.flush()
+                unflushed = 0
+                last_flush = time.time()
+
+        if self._error is None:
+            self.sink.flush()
+
+    def close(self):
+        """
+        write any rows still queued and close the sink. Re-raises the first exception hit when writing
+        """
+        self._queue.put(self._done)
+        self._thread.join()
+        self.sink.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class StreamingCsvWriter(StreamingWriter):
+    """
+    StreamingWriter of a CsvSink
+    """
+    def __init__(self, fname, header=None, max_queued_rows=1000, flush_every=100, flush_seconds=5.0):
+        """
+        :param fname: CSV file to append to
+        :param header: list of field names written first if fname does not yet exist
+        """
+        super().__init__(CsvSink(fname, header=header), max_queued_rows=max_queued_rows, flush_every=flush_every, flush_seconds=flush_seconds)
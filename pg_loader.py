@@ -0,0 +1,228 @@
+import csv
+import io
+import logging
+import os
+from postgres import Postgres
+
+from harvest_record import parse_bbox
+from harvest_state import CHANGE_UPDATED, CHANGE_VANISHED, read_rows
+
+
+DEFAULT_TABLE = 'discovery.wms_layers'
+
+# fields identifying a row of discovery.wms_layers, the upsert key
+KEY_FIELDS = ('csw_url', 'csw_record_identifier', 'wms_url')
+
+# typed columns filled from the bbox_wgs84 / bbox_projected text of wms_layers.csv (see harvest_record.format_bbox)
+BBOX_WGS84_COLUMNS = ['min_x', 'min_y', 'max_x', 'max_y']
+BBOX_PROJECTED_COLUMNS = ['proj_min_x', 'proj_min_y', 'proj_max_x', 'proj_max_y', 'proj_crs']
+
+# NULL marker of the staging COPY
+NULL = '\\N'
+
+
+class WmsLayersLoader:
+    """
+    Loads the rows of wms_layers.csv into the discovery.wms_layers PostGIS table (see SQL/) with COPY, batch_size
+    rows at a time. Each batch is copied into a temporary staging table then upserted on
+    (csw_url, csw_record_identifier, wms_url), so loading the output of every run (incremental or not) into the same
+    table keeps one row per record / WMS. Rows that have not changed since they were last loaded are left untouched.
+
+    The typed bbox columns are filled as rows are loaded, the geometry is a stored generated column built from them.
+    """
+    def __init__(self, pg_conn_str, table=DEFAULT_TABLE, batch_size=10000):
+        """
+        :param pg_conn_str: Pg connection string of the db holding table
+        :param table: table to load rows into
+        :param batch_size: rows copied / upserted per transaction
+        """
+        self.db = Postgres(pg_conn_str)
+        self.table = table
+        self.batch_size = batch_size
+        self.rows_loaded = 0
+        self.rows_deleted = 0
+        self.batches = 0
+
+    @staticmethod
+    def load_columns(fields):
+        """
+        :param fields: header of wms_layers.csv
+        :return: table columns a row of wms_layers.csv is loaded into
+        """
+        return list(fields) + BBOX_WGS84_COLUMNS + BBOX_PROJECTED_COLUMNS
+
+    @staticmethod
+    def load_values(fields, row):
+        """
+        :param fields: header of wms_layers.csv
+        :param row: list of values of a row of wms_layers.csv, None for no value
+        :return: list of values for load_columns(fields)
+        """
+        values = list(row)
+        # NULLs are never equal so would never match the upsert key, a missing key value is loaded as ''
+        for f in KEY_FIELDS:
+            i = fields.index(f)
+            if values[i] is None:
+                values[i] = ''
+
+        bbox_wgs84 = parse_bbox(row[fields.index('bbox_wgs84')])
+        values.extend(bbox_wgs84[:4] if bbox_wgs84 is not None else [None] * 4)
+
+        bbox_projected = parse_bbox(row[fields.index('bbox_projected')])
+        if bbox_projected is not None:
+            values.extend(bbox_projected[:4])
+            values.append(bbox_projected[4] if len(bbox_projected) == 5 else None)
+        else:
+            values.extend([None] * 5)
+        return values
+
+    def _upsert_sql(self, columns):
+        key = ', '.join(KEY_FIELDS)
+        updated = [c for c in columns if c not in KEY_FIELDS]
+        return """
+        INSERT INTO {table} AS t ({columns})
+        SELECT {columns} FROM wms_layers_load
+        ON CONFLICT ({key}) DO UPDATE SET ({updated}) = ({excluded})
+        WHERE ({current}) IS DISTINCT FROM ({excluded})
+        """.format(
+            table=self.table,
+            columns=', '.join(columns),
+            key=key,
+            updated=', '.join(updated),
+            excluded=', '.join('excluded.' + c for c in updated),
+            current=', '.join('t.' + c for c in updated)
+        )
+
+    def _load_batch(self, conn, columns, batch):
+        buf = io.StringIO()
+        # None is written as \N, the NULL of the COPY below, so that '' is loaded as an empty string
+        csv.writer(buf).writerows([NULL if v is None else v for v in values] for values in batch.values())
+        buf.seek(0)
+        cursor = conn.cursor()
+        cursor.copy_expert(
+            "COPY wms_layers_load ({0}) FROM STDIN WITH (FORMAT csv, NULL '{1}')".format(', '.join(columns), NULL), buf
+        )
+        cursor.execute(self._upsert_sql(columns))
+        cursor.execute('TRUNCATE wms_layers_load')
+        conn.commit()
+        self.rows_loaded += len(batch)
+        self.batches += 1
+        logging.info('Loaded batch of %s rows into %s', len(batch), self.table)
+
+    def load(self, rows_fname):
+        """
+        :param rows_fname: wms_layers.csv to load
+        """
+        with open(rows_fname, 'r', newline='') as inpf:
+            reader = csv.reader(inpf)
+            fields = next(reader, None)
+            if fields is None:
+                return
+            columns = self.load_columns(fields)
+            key_is = [fields.index(f) for f in KEY_FIELDS]
+
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'CREATE TEMP TABLE IF NOT EXISTS wms_layers_load AS SELECT {0} FROM {1} WITH NO DATA'.format(
+                        ', '.join(columns), self.table
+                    )
+                )
+                batch = {}  # key -> values, a record / WMS written more than once in a batch is loaded once (the last)
+                for r in reader:
+                    values = self.load_values(fields, [None if v == '' else v for v in r])
+                    batch[tuple(values[i] for i in key_is)] = values
+                    if len(batch) >= self.batch_size:
+                        self._load_batch(conn, columns, batch)
+                        batch = {}
+                if len(batch) > 0:
+                    self._load_batch(conn, columns, batch)
+
+    @staticmethod
+    def changed_records(changes_fname):
+        """
+        :param changes_fname: record_changes.csv of the run
+        :return: set of (csw_url, csw_record_identifier) of the records that were updated or have vanished
+        """
+        header, changes = read_rows(changes_fname)
+        if header is None:
+            return set()
+        return set(
+            (r[header.index('csw_url')], r[header.index('csw_record_identifier')] or '') for r in changes
+            if r[header.index('change')] in (CHANGE_UPDATED, CHANGE_VANISHED)
+        )
+
+    @staticmethod
+    def current_keys(changed, rows_fname):
+        """
+        :param changed: set of (csw_url, csw_record_identifier) of the updated / vanished records
+        :param rows_fname: the (merged) wms_layers.csv of the run
+        :return: list of the (csw_url, csw_record_identifier, wms_url) keys of the rows of wms_layers.csv of changed
+        """
+        header, rows = read_rows(rows_fname)
+        if header is None:
+            return []
+        key_is = [header.index(f) for f in KEY_FIELDS]
+        keys = (tuple(r[i] or '' for i in key_is) for r in rows)
+        return [k for k in keys if k[:2] in changed]
+
+    def _delete_stale_sql(self):
+        # one statement for all the changed records, their keys and those of their current rows sent as arrays (one
+        # per field) as geocoder.BATCH_SQL does
+        return """
+        DELETE FROM {table} t
+        USING unnest(%(csw_urls)s::text[], %(identifiers)s::text[]) AS c(csw_url, csw_record_identifier)
+        WHERE t.csw_url = c.csw_url AND t.csw_record_identifier = c.csw_record_identifier
+        AND NOT EXISTS (
+            SELECT 1
+            FROM unnest(%(current_csw_urls)s::text[], %(current_identifiers)s::text[], %(current_wms_urls)s::text[]) AS k(csw_url, csw_record_identifier, wms_url)
+            WHERE k.csw_url = t.csw_url AND k.csw_record_identifier = t.csw_record_identifier AND k.wms_url = t.wms_url
+        )
+        """.format(table=self.table)
+
+    def delete_stale(self, rows_fname, changes_fname):
+        """
+        delete the rows of records that have vanished from their CSW, and those of updated records for WMSs they no
+        longer reference, as CatalogueStore.apply_changes does
+
+        :param rows_fname: the (merged) wms_layers.csv of the run
+        :param changes_fname: record_changes.csv of the run
+        """
+        changed = self.changed_records(changes_fname)
+        if len(changed) == 0:
+            return
+        current = self.current_keys(changed, rows_fname)
+        changed = sorted(changed)
+        with self.db.get_cursor() as cursor:
+            cursor.execute(self._delete_stale_sql(), {
+                'csw_urls': [c[0] for c in changed],
+                'identifiers': [c[1] for c in changed],
+                'current_csw_urls': [k[0] for k in current],
+                'current_identifiers': [k[1] for k in current],
+                'current_wms_urls': [k[2] for k in current]
+            })
+            deleted = cursor.rowcount
+        self.rows_deleted += deleted
+        logging.info('Deleted %s rows of %s updated / vanished records from %s', deleted, len(changed), self.table)
+
+    def stats(self):
+        return {'rows_loaded': self.rows_loaded, 'rows_deleted': self.rows_deleted, 'batches': self.batches}
+
+    def log_stats(self):
+        logging.info('PostGIS load: %s', self.stats())
+
+
+def load_wms_layers(pg_conn_str, out_path, changes_fname=None, table=DEFAULT_TABLE, batch_size=10000):
+    """
+    load wms_layers.csv of out_path into table, removing the rows of vanished records and those of updated records for
+    WMSs they no longer reference
+
+    :return: WmsLayersLoader
+    """
+    loader = WmsLayersLoader(pg_conn_str, table=table, batch_size=batch_size)
+    rows_fname = os.path.join(out_path, 'wms_layers.csv')
+    loader.load(rows_fname)
+    if changes_fname is not None:
+        loader.delete_stale(rows_fname, changes_fname)
+    loader.log_stats()
+    return loader
@@ -0,0 +1,171 @@
+import logging
+import queue
+import threading
+
+
+class Stage:
+    """
+    One stage of a harvest pipeline: a bounded queue of items served by its own pool of worker threads.
+
+    Each item is passed to fn, which returns the items (if any) to hand on to the next stage. If the next stage`s
+    queue is full the workers here wait (backpressure), so a slow stage throttles the ones before it instead of
+    letting items pile up in memory. An exception raised by fn is logged and the item dropped.
+    """
+    _done = object()  # queue sentinel
+
+    def __init__(self, name, fn, workers=4, max_queued=1000):
+        """
+        :param name: stage name, used in logs and stats
+        :param fn: callable taking an item and returning an iterable of items for the next stage or None
+        :param workers: number of worker threads
+        :param max_queued: items that can be waiting in the queue before put() blocks
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.emit = None  # callable the items fn returns are handed to, set by Pipeline
+        self.on_drop = None  # optional callable items that go no further are handed to, set by Pipeline
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name='{0}_{1}'.format(self.name, i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def put(self, item):
+        """
+        queue an item, blocking while the queue is full
+        """
+        self._queue.put(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._done:
+                self._queue.task_done()
+                break
+
+            with self._lock:
+                self.busy += 1
+            dropped = True
+            try:
+                out_items = self.fn(item)
+                if out_items is not None:
+                    for out_item in out_items:
+                        dropped = False
+                        if self.emit is not None:
+                            self.emit(out_item)
+            # TODO improve caught exception specifity
+            except Exception:
+                logging.exception('Exception raised in pipeline stage %s', self.name)
+                with self._lock:
+                    self.errors += 1
+            finally:
+                if dropped and self.on_drop is not None:
+                    self.on_drop(item)
+                with self._lock:
+                    self.busy -= 1
+                    self.processed += 1
+                self._queue.task_done()
+
+    def join(self):
+        """
+        wait until every item queued so far has been processed (and handed on)
+        """
+        self._queue.join()
+
+    def close(self):
+        for t in self._threads:
+            self._queue.put(self._done)
+        for t in self._threads:
+            t.join()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self._queue.qsize(),
+                'busy': self.busy,
+                'processed': self.processed,
+                'errors': self.errors
+            }
+
+
+class Pipeline:
+    """
+    Chains Stages together, each handing its items to the next and the last one handing them to sink. Items enter
+    the pipeline through put(). Items a stage drops (returns no items for, or fails on) are handed to on_drop, so
+    between them sink and on_drop see every item that leaves the pipeline.
+
+    The queue depth of every stage (plus any upstream queues, i.e. the discovery scheduler) is logged every
+    monitor_seconds so the concurrency of each stage can be tuned to wherever the work is piling up.
+    """
+    def __init__(self, stages, sink=None, on_drop=None, upstream_depths=None, monitor_seconds=10.0):
+        """
+        :param stages: list of Stage in pipeline order
+        :param sink: optional callable each item coming out of the last stage is passed to
+        :param on_drop: optional callable each item dropped by a stage is passed to
+        :param upstream_depths: optional dict of name -> callable returning the depth of a queue feeding the pipeline
+        :param monitor_seconds: how often to log queue depths, 0 for never
+        """
+        self.stages = stages
+        self.upstream_depths = upstream_depths if upstream_depths is not None else {}
+        self.monitor_seconds = monitor_seconds
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.emit = next_stage.put
+        stages[-1].emit = sink
+        for stage in stages:
+            stage.on_drop = on_drop
+
+        self._stop = threading.Event()
+        self._monitor = None
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.monitor_seconds > 0:
+            self._monitor = threading.Thread(target=self._run_monitor, name='PipelineMonitor', daemon=True)
+            self._monitor.start()
+        return self
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def depths(self):
+        depths = {name: depth() for name, depth in self.upstream_depths.items()}
+        for stage in self.stages:
+            depths[stage.name] = stage.depth()
+        return depths
+
+    def _run_monitor(self):
+        while not self._stop.wait(self.monitor_seconds):
+            logging.info('Pipeline queue depths: %s', self.depths())
+
+    def close(self):
+        """
+        wait for every item put so far to pass through all the stages, then stop the workers. Items only ever move
+        downstream so joining the stages in order drains the whole pipeline
+        """
+        for stage in self.stages:
+            stage.join()
+        for stage in self.stages:
+            stage.close()
+        self._stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def log_stats(self):
+        for stage in self.stages:
+            logging.info('Pipeline stage %s: %s', stage.name, stage.stats())
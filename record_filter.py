@@ -0,0 +1,107 @@
+import logging
+import threading
+from owslib.fes import PropertyIsLike
+
+
+# queryable a record filter without a property= prefix applies to
+DEFAULT_FILTER_PROPERTY = 'csw:AnyText'
+
+# record filter value (i.e. in the -csv_file record_filter column) that switches filtering off for a CSW
+NO_FILTER = 'none'
+
+
+def parse_record_filter(spec):
+    """
+    OGC Filter constraint for a record filter given as [property=]pattern i.e. %WMS% (csw:AnyText is like %WMS%) or
+    dc:type=service. The pattern uses % as its wildcard
+
+    :param spec: record filter string or None
+    :return: OWSLib fes PropertyIsLike or None for no filter
+    """
+    if spec is None or spec.strip() == '' or spec.strip().lower() == NO_FILTER:
+        return None
+    prop, sep, pattern = spec.strip().partition('=')
+    if sep == '' or ':' not in prop:
+        # a bare pattern (which may itself contain =)
+        prop, pattern = DEFAULT_FILTER_PROPERTY, spec.strip()
+    return PropertyIsLike(prop, pattern, wildCard='%', singleChar='_', escapeChar='\\')
+
+
+def and_constraints(constraints):
+    """
+    :param constraints: list of OWSLib fes constraints, any of which may be None
+    :return: OWSLib getrecords2() constraints list requiring all of them
+    """
+    constraints = [c for c in constraints if c is not None]
+    if len(constraints) <= 1:
+        return constraints
+    # a nested list is And-ed by OWSLib, a flat one Or-ed
+    return [constraints]
+
+
+class RecordFilters:
+    """
+    Server-side filtering of the records asked for from each CSW, so that records which cannot reference an OGC
+    service are never transferred. Each CSW gets the run`s default record filter unless one is configured for it.
+
+    A CSW that rejects its filter (i.e. the queryable or PropertyIsLike is not supported) falls back to being paged
+    through unfiltered. The number of records in each CSW with and without the filter is kept so the records saved
+    can be reported.
+    """
+    def __init__(self, default_spec=None, specs=None):
+        """
+        :param default_spec: record filter for CSWs without one of their own, or None
+        :param specs: optional dict of csw_url -> record filter, '' for the default or 'none' for no filter
+        """
+        self.default_spec = default_spec
+        self.specs = specs if specs is not None else {}
+        self._lock = threading.Lock()
+        self._counts = {}  # csw_url -> (record filter, records, records matching filter or None if rejected)
+
+    def spec(self, csw_url):
+        spec = self.specs.get(csw_url)
+        if spec is None or spec.strip() == '':
+            spec = self.default_spec
+        if parse_record_filter(spec) is None:
+            return None
+        return spec
+
+    def constraint(self, csw_url):
+        """
+        :return: OWSLib fes constraint for csw_url or None
+        """
+        return parse_record_filter(self.spec(csw_url))
+
+    def record(self, csw_url, total_records, matched_records):
+        """
+        :param total_records: number of records in the CSW
+        :param matched_records: number of them matching the filter, or None if the CSW rejected the filter
+        """
+        spec = self.spec(csw_url)
+        with self._lock:
+            self._counts[csw_url] = (spec, total_records, matched_records)
+        if matched_records is None:
+            logging.info('CSW %s rejected record filter %s, retrieving all %s records', csw_url, spec, total_records)
+        else:
+            logging.info(
+                'Record filter %s matched %s of %s records in CSW %s, %s records not retrieved',
+                spec, matched_records, total_records, csw_url, total_records - matched_records
+            )
+
+    def stats(self):
+        with self._lock:
+            counts = list(self._counts.values())
+        filtered = [c for c in counts if c[2] is not None]
+        return {
+            'csws_filtered': len(filtered),
+            'csws_rejected': len(counts) - len(filtered),
+            'records': sum(c[1] for c in filtered),
+            'records_matched': sum(c[2] for c in filtered),
+            'records_saved': sum(c[1] - c[2] for c in filtered)
+        }
+
+    def log_stats(self):
+        logging.info(
+            'Record filters: {csws_filtered} CSWs filtered ({csws_rejected} rejected the filter), {records_matched} of '
+            '{records} records matched, {records_saved} records not retrieved'.format(**self.stats())
+        )
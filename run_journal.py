@@ -0,0 +1,181 @@
+import csv
+import json
+import logging
+import os
+import threading
+import time
+
+
+JOURNAL_FNAME = 'harvest_journal.jsonl'
+
+
+def repair_csv_tail(fname):
+    """
+    drop a partly written last line (i.e. left by a crash mid-write) so that rows appended to fname start on a line of
+    their own
+
+    :param fname: CSV file
+    """
+    if not os.path.exists(fname):
+        return
+    with open(fname, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        f.seek(0)
+        content = f.read()
+        keep = content.rfind(b'\n') + 1
+        f.truncate(keep)
+        logging.info('Dropped partly written last line of %s', fname)
+
+
+def written_row_keys(fname, key_fields):
+    """
+    :param fname: CSV file with a header row
+    :param key_fields: names of the fields identifying a row
+    :return: set of key tuples of the rows in fname
+    """
+    keys = set()
+    if not os.path.exists(fname):
+        return keys
+    with open(fname, 'r', newline='') as inpf:
+        for r in csv.DictReader(inpf):
+            keys.add(tuple(r.get(f) for f in key_fields))
+    return keys
+
+
+class RunJournal:
+    """
+    Durable journal of a harvest run, one JSON object per line, so that an interrupted run can be resumed.
+
+    A CSW page is journaled once every row found in it has been written (and flushed) to wms_layers.csv, so on resume
+    the page can be skipped outright. The rows already in wms_layers.csv are the record of which endpoint references
+    have been validated; pages that were in progress when the run stopped are fetched again but references already
+    in wms_layers.csv are skipped rather than validated and written a second time.
+    """
+    # fields identifying a row of wms_layers.csv
+    row_key_fields = ('csw_url', 'csw_record_identifier', 'wms_url')
+
+    def __init__(self, out_path, resume=False, rows_fname=None):
+        """
+        :param out_path: folder holding the journal
+        :param resume: carry on from the journal (and rows) of an earlier run, otherwise start a new journal
+        :param rows_fname: wms_layers.csv of the run
+        """
+        self.fname = os.path.join(out_path, JOURNAL_FNAME)
+        self.resume = resume
+        self.completed_pages = {}  # csw_url -> list of (startposition, number of records)
+        self.written_keys = set()
+        self.pages_journaled = 0
+        self.rows_skipped = 0
+        self.out_writer = None  # StreamingCsvWriter of the rows, set once it is open. Pages are journaled through it
+        self._lock = threading.Lock()
+
+        if resume:
+            if os.path.exists(self.fname):
+                with open(self.fname, 'r') as inpf:
+                    for line in inpf:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # partly written last line
+                            continue
+                        if entry.get('event') == 'page':
+                            self.completed_pages.setdefault(entry['csw_url'], []).append((entry['start'], entry['count']))
+            if rows_fname is not None:
+                repair_csv_tail(rows_fname)
+                self.written_keys = written_row_keys(rows_fname, self.row_key_fields)
+            logging.info(
+                'Resuming run: %s pages complete, %s rows written',
+                sum(len(p) for p in self.completed_pages.values()), len(self.written_keys)
+            )
+
+        self._outpf = open(self.fname, 'a' if resume else 'w')
+        self._append({'event': 'run_started', 'resume': resume})
+
+    def _append(self, entry):
+        entry['time'] = time.time()
+        with self._lock:
+            self._outpf.write(json.dumps(entry) + '\n')
+            self._outpf.flush()
+            os.fsync(self._outpf.fileno())
+
+    def completed_ranges(self, csw_url):
+        """
+        :return: list of (startposition, number of records) pages of csw_url completed by earlier runs
+        """
+        return self.completed_pages.get(csw_url, [])
+
+    def already_written(self, ref):
+        """
+        :param ref: reference dict keyed on wms_layers.csv field names
+        :return: True if an earlier run wrote the row for ref
+        """
+        if len(self.written_keys) == 0:
+            return False
+        # values come back from the CSV as strings, with None written as ''
+        written = tuple('' if ref.get(f) is None else str(ref.get(f)) for f in self.row_key_fields) in self.written_keys
+        if written:
+            with self._lock:
+                self.rows_skipped += 1
+        return written
+
+    def page_done(self, csw_url, start, count):
+        self._append({'event': 'page', 'csw_url': csw_url, 'start': start, 'count': count})
+        with self._lock:
+            self.pages_journaled += 1
+
+    def page(self, csw_url, start, count):
+        """
+        :return: JournalPage tracking the references of a page through to wms_layers.csv
+        """
+        return JournalPage(self, csw_url, start, count)
+
+    def close(self):
+        self._append({'event': 'run_finished'})
+        self._outpf.close()
+
+    def stats(self):
+        with self._lock:
+            return {'pages_journaled': self.pages_journaled, 'rows_skipped': self.rows_skipped}
+
+
+class JournalPage:
+    """
+    Counts the references of one CSW page still being worked on. Once the page has been fully read (seal()) and the
+    last of its references has been written or dropped (ref_done()) the page is journaled, via the writer so that it
+    only happens after the page`s rows are flushed to disk.
+    """
+    def __init__(self, journal, csw_url, start, count):
+        self.journal = journal
+        self.csw_url = csw_url
+        self.start = start
+        self.count = count
+        self.outstanding = 0
+        self.sealed = False
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def ref_done(self):
+        with self._lock:
+            self.outstanding -= 1
+            done = self.sealed and self.outstanding == 0
+        if done:
+            self._journal()
+
+    def seal(self):
+        with self._lock:
+            self.sealed = True
+            done = self.outstanding == 0
+        if done:
+            self._journal()
+
+    def _journal(self):
+        self.journal.out_writer.after_written(self.journal.page_done, self.csw_url, self.start, self.count)
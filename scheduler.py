@@ -0,0 +1,147 @@
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
+import logging
+import threading
+from urllib.parse import urlsplit
+
+
+def url_host(url):
+    """
+    :param url: a url
+    :return: lowercased host[:port] of the url
+    """
+    return urlsplit(url).netloc.lower()
+
+
+class HostScheduler:
+    """
+    One worker pool shared by the whole harvest run (the global worker budget) which runs jobs from every catalogue.
+
+    Each job is queued against a host. Hosts with queued jobs are served round-robin and no more than max_per_host
+    jobs run against any one host at a time, so a slow or large catalogue cannot starve the others and fast hosts
+    keep the pool busy without any single server being hammered.
+
+    Jobs that go on to make requests to other hosts (i.e. a CSW paging job hitting the WMS its records reference)
+    should wrap those requests in host_slot(), which caps the number of concurrent connections to that host at
+    max_per_host as well.
+    """
+    def __init__(self, max_workers=20, max_per_host=4):
+        """
+        :param max_workers: global number of worker threads
+        :param max_per_host: max jobs running against / connections open to any one host
+        """
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='HostScheduler')
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # host -> deque of queued (future, fn, args, kwargs), in round-robin order
+        self._running = {}  # host -> number of jobs running
+        self._total_running = 0
+        self._slots = {}  # host -> BoundedSemaphore capping connections to it
+        self.completed = 0
+
+    def submit(self, host, fn, *args, **kwargs):
+        """
+        queue fn(*args, **kwargs) to run against host
+
+        :return: concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            self._queues.setdefault(host, deque()).append((future, fn, args, kwargs))
+        self._dispatch()
+        return future
+
+    def executor(self, host):
+        """
+        :return: object with an Executor style submit(fn, *args) that queues jobs against host
+        """
+        return HostExecutor(self, host)
+
+    def _dispatch(self):
+        with self._lock:
+            dispatched = True
+            while dispatched and self._total_running < self.max_workers:
+                dispatched = False
+                for host in list(self._queues):
+                    if self._total_running >= self.max_workers:
+                        break
+                    if self._running.get(host, 0) >= self.max_per_host:
+                        continue
+                    jobs = self._queues[host]
+                    job = jobs.popleft()
+                    if len(jobs) == 0:
+                        del self._queues[host]
+                    else:
+                        # send host to the back of the round-robin
+                        self._queues.move_to_end(host)
+                    self._running[host] = self._running.get(host, 0) + 1
+                    self._total_running += 1
+                    self._pool.submit(self._run, host, job)
+                    dispatched = True
+
+    def _run(self, host, job):
+        future, fn, args, kwargs = job
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+
+        with self._lock:
+            self._running[host] -= 1
+            self._total_running -= 1
+            self.completed += 1
+        self._dispatch()
+
+    def host_slot(self, url):
+        """
+        context manager holding one of the max_per_host connection slots for the host of url
+        """
+        host = url_host(url)
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            slot = self._slots[host]
+
+        return slot
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._total_running,
+                'queued': sum(len(q) for q in self._queues.values()),
+                'hosts_queued': len(self._queues),
+                'completed': self.completed
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+        logging.info('Scheduler shut down: %s', self.stats())
+
+
+class HostExecutor:
+    """
+    Executor-like view of a HostScheduler that queues everything against one host
+    """
+    def __init__(self, scheduler, host):
+        self.scheduler = scheduler
+        self.host = host
+
+    def submit(self, fn, *args, **kwargs):
+        return self.scheduler.submit(self.host, fn, *args, **kwargs)
+
+
+def host_slot(scheduler, url):
+    """
+    scheduler.host_slot(url) or a no-op context manager if there is no scheduler
+
+    :param scheduler: HostScheduler or None
+    :param url: url about to be requested
+    """
+    if scheduler is None or url is None:
+        return contextlib.nullcontext()
+    return scheduler.host_slot(url)
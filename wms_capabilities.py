@@ -0,0 +1,324 @@
+from array import array
+from collections.abc import Mapping
+from io import BytesIO
+import logging
+import math
+import warnings
+from owslib.crs import Crs
+from owslib.etree import etree
+from owslib.map import wms111, wms130
+from owslib.map.common import WMSCapabilitiesReader
+from owslib.util import Authentication, openURL, strip_bom, testXMLValue
+from owslib.wms import WebMapService
+
+
+class LayerRow:
+    """
+    the fields of one named layer, as held by the OWSLib ContentMetadata the harvest reads them from
+    """
+    __slots__ = ('id', 'name', 'title', 'boundingBoxWGS84', 'boundingBox')
+
+    def __init__(self, name, title, wgs84_bbox, bbox):
+        self.id = self.name = name
+        self.title = title
+        self.boundingBoxWGS84 = wgs84_bbox
+        self.boundingBox = bbox
+
+
+class LayerTable(Mapping):
+    """
+    The named layers of a WMS in the order (and with the duplicate name handling) of OWSLib WebMapService.contents,
+    one row per layer held in flat arrays rather than an object (and XML element tree) per layer.
+
+    Stands in for wms.contents, a LayerRow is built for a layer when it is looked up.
+    """
+    def __init__(self):
+        self.names = []  # WMS Layer <Name>, in contents order
+        self.titles = []  # WMS Layer <Title>, in contents order
+        self._rows = {}  # name -> row
+        self._wgs84 = array('d')  # 4 values per row, nan for no bbox
+        self._bbox = array('d')  # 4 values per row
+        self._bbox_len = array('b')  # 0 for no bbox, 4 for a wgs84 bbox, 5 for a bbox with its crs
+        self._bbox_crs = []  # crs of each bbox (or None)
+
+    def add(self, name, title, wgs84_bbox, bbox):
+        """
+        :param name: layer name
+        :param title: layer title
+        :param wgs84_bbox: (minx, miny, maxx, maxy) or None
+        :param bbox: (minx, miny, maxx, maxy), (minx, miny, maxx, maxy, crs) or None
+        """
+        wgs84_values = wgs84_bbox if wgs84_bbox is not None else (math.nan,) * 4
+        bbox_values = bbox[:4] if bbox is not None else (math.nan,) * 4
+        bbox_len = len(bbox) if bbox is not None else 0
+        bbox_crs = bbox[4] if bbox_len == 5 else None
+
+        row = self._rows.get(name)
+        if row is None:
+            self._rows[name] = len(self.names)
+            self.names.append(name)
+            self.titles.append(title)
+            self._wgs84.extend(wgs84_values)
+            self._bbox.extend(bbox_values)
+            self._bbox_len.append(bbox_len)
+            self._bbox_crs.append(bbox_crs)
+        else:
+            # as OWSLib, the later layer replaces the earlier one but keeps its place
+            warnings.warn('Content metadata for layer "%s" already exists. Using child layer' % name)
+            self.titles[row] = title
+            self._wgs84[row * 4:row * 4 + 4] = array('d', wgs84_values)
+            self._bbox[row * 4:row * 4 + 4] = array('d', bbox_values)
+            self._bbox_len[row] = bbox_len
+            self._bbox_crs[row] = bbox_crs
+
+    def wgs84_bbox_values(self):
+        """
+        :return: array('d') of the wgs84 bbox values of every layer, 4 per layer in contents order, nan for no bbox
+        """
+        return self._wgs84
+
+    def __getitem__(self, name):
+        row = self._rows[name]
+        wgs84_bbox = tuple(self._wgs84[row * 4:row * 4 + 4])
+        if math.isnan(wgs84_bbox[0]):
+            wgs84_bbox = None
+        bbox = None
+        if self._bbox_len[row] > 0:
+            bbox = tuple(self._bbox[row * 4:row * 4 + 4])
+            if self._bbox_len[row] == 5:
+                bbox += (self._bbox_crs[row],)
+        return LayerRow(name, self.titles[row], wgs84_bbox, bbox)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class _OpenLayer:
+    """
+    a Layer element being parsed
+    """
+    def __init__(self, elem, parent):
+        self.elem = elem
+        self.parent = parent
+        self.name = None
+        self.title = None
+        self.wgs84_bbox = None
+        self.bbox = None
+        self.seen = set()  # tags of the fields read so far, only the first of each counts
+        self.registered = False
+
+
+class UnsupportedCapabilities(Exception):
+    """
+    the GetCapabilities doc is one the streaming parser leaves to OWSLib
+    """
+
+
+class _StreamedWebMapServiceMixin:
+    """
+    Builds an OWSLib WebMapService from a GetCapabilities doc parsed incrementally, keeping only the service
+    identification, operations (so getmap() works as usual) and, for each named layer, its Name, Title and bboxes in a
+    LayerTable. Each Layer element is dropped from the tree once it has been read so memory use does not grow with
+    the number of layers.
+
+    Anything the parser does not expect (another root element, layer fields after nested layers etc) raises
+    UnsupportedCapabilities so the doc can be handed to OWSLib instead.
+    """
+    ns = ''
+    root_tag = None
+    wgs84_tag = None
+    owslib_module = None
+
+    def __init__(self, url, xml, version, timeout=30, headers=None, auth=None):
+        self.url = url
+        self.version = version
+        self.timeout = timeout
+        self.headers = headers
+        self.auth = auth or Authentication()
+        self.request = None
+        self._capabilities = None
+        self.identification = None
+        self.provider = None
+        self.operations = []
+        self.exceptions = []
+        self.contents = LayerTable()
+        self._parse(xml)
+
+    def _tag(self, name):
+        return self.ns + name
+
+    def _parse(self, xml):
+        layer_tag = self._tag('Layer')
+        capability_tag = self._tag('Capability')
+        service_tag = self._tag('Service')
+        request_tag = self._tag('Request')
+        exception_tag = self._tag('Exception')
+        format_tag = self._tag('Format')
+        field_tags = {self._tag('Name'), self._tag('Title'), self._tag(self.wgs84_tag), self._tag('BoundingBox')}
+        stack = []  # elements from the root down to the current one
+        open_layers = []  # _OpenLayer of each Layer element from the outermost down to the current one
+        capability = None
+
+        if not isinstance(xml, bytes):
+            raise UnsupportedCapabilities('GetCapabilities doc is not bytes')
+        for event, elem in etree.iterparse(BytesIO(strip_bom(xml)), events=('start', 'end')):
+            if event == 'start':
+                parent = stack[-1] if len(stack) > 0 else None
+                if parent is None:
+                    if elem.tag != self.root_tag:
+                        raise UnsupportedCapabilities('root element is {0}'.format(elem.tag))
+                    self.updateSequence = elem.attrib.get('updateSequence')
+                elif elem.tag == capability_tag and parent is stack[0] and capability is None:
+                    capability = elem
+                elif elem.tag == layer_tag and (parent is capability or (len(open_layers) > 0 and parent is open_layers[-1].elem)):
+                    parent_layer = None
+                    if len(open_layers) > 0 and parent is open_layers[-1].elem:
+                        parent_layer = open_layers[-1]
+                        # the parent`s own fields come before its nested layers
+                        self._register(parent_layer)
+                    open_layers.append(_OpenLayer(elem, parent_layer))
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            parent = stack[-1] if len(stack) > 0 else None
+            if len(open_layers) > 0 and elem is open_layers[-1].elem:
+                layer = open_layers.pop()
+                self._register(layer)
+                elem.clear()
+                parent.remove(elem)
+            elif len(open_layers) > 0 and parent is open_layers[-1].elem and elem.tag in field_tags:
+                self._read_field(open_layers[-1], elem)
+            elif elem.tag == service_tag and parent is not None and parent is stack[0]:
+                self.identification = self.owslib_module.ServiceIdentification(elem, self.version)
+                self.provider = self.owslib_module.ServiceProvider(elem)
+            elif elem.tag == request_tag and parent is capability and capability is not None and len(self.operations) == 0:
+                self.operations = [self.owslib_module.OperationMetadata(e) for e in elem[:]]
+            elif elem.tag == format_tag and parent is not None and parent.tag == exception_tag and len(stack) > 1 and stack[-2] is capability:
+                self.exceptions.append(elem.text)
+
+        if self.identification is None:
+            raise UnsupportedCapabilities('no Service element')
+
+    def _read_field(self, layer, elem):
+        if layer.registered:
+            raise UnsupportedCapabilities('Layer fields after nested Layer')
+        field = elem.tag[len(self.ns):]
+        if field == 'BoundingBox':
+            self._read_bbox(layer, elem)
+        elif field not in layer.seen:
+            if field == 'Name':
+                layer.name = testXMLValue(elem)
+            elif field == 'Title':
+                title = testXMLValue(elem)
+                if title is not None:
+                    layer.title = title.strip()
+            else:
+                layer.wgs84_bbox = self._wgs84_bbox(elem)
+        layer.seen.add(field)
+
+    def _register(self, layer):
+        """
+        add a layer (if named) to contents once all its own fields have been read, bboxes are inherited from the
+        parent layer as OWSLib does
+        """
+        if layer.registered:
+            return
+        layer.registered = True
+        parent = layer.parent
+        if self.wgs84_tag not in layer.seen and parent is not None:
+            layer.wgs84_bbox = parent.wgs84_bbox
+        self._inherit_bbox(layer)
+        if layer.name:
+            self.contents.add(layer.name, layer.title, layer.wgs84_bbox, layer.bbox)
+
+
+class StreamedWebMapService_1_3_0(_StreamedWebMapServiceMixin, wms130.WebMapService_1_3_0):
+    ns = '{http://www.opengis.net/wms}'
+    root_tag = ns + 'WMS_Capabilities'
+    wgs84_tag = 'EX_GeographicBoundingBox'
+    owslib_module = wms130
+
+    def _wgs84_bbox(self, elem):
+        values = [elem.find(self._tag(t)) for t in ('westBoundLongitude', 'southBoundLatitude', 'eastBoundLongitude', 'northBoundLatitude')]
+        return tuple(map(float, [v.text if v is not None else None for v in values]))
+
+    def _read_bbox(self, layer, elem):
+        # every BoundingBox is read (so a bad one fails as in OWSLib) but only the first is kept
+        srs_str = elem.attrib.get('CRS', None)
+        srs = Crs(srs_str)
+        box = tuple(map(float, [elem.attrib['minx'], elem.attrib['miny'], elem.attrib['maxx'], elem.attrib['maxy']]))
+        if srs and srs.axisorder == 'yx':
+            box = (box[1], box[0], box[3], box[2])
+        if 'BoundingBox' not in layer.seen:
+            layer.bbox = box + (srs_str,)
+
+    def _inherit_bbox(self, layer):
+        # no BoundingBox of its own falls back to the layer`s wgs84 bbox
+        if 'BoundingBox' not in layer.seen:
+            layer.bbox = layer.wgs84_bbox
+
+
+class StreamedWebMapService_1_1_1(_StreamedWebMapServiceMixin, wms111.WebMapService_1_1_1):
+    root_tag = 'WMT_MS_Capabilities'
+    wgs84_tag = 'LatLonBoundingBox'
+    owslib_module = wms111
+
+    def _wgs84_bbox(self, elem):
+        return tuple(float(elem.attrib[k]) for k in ('minx', 'miny', 'maxx', 'maxy'))
+
+    def _read_bbox(self, layer, elem):
+        if 'BoundingBox' in layer.seen:
+            return
+        layer.bbox = tuple(float(elem.attrib[k]) for k in ('minx', 'miny', 'maxx', 'maxy')) + (elem.attrib.get('SRS'),)
+
+    def _inherit_bbox(self, layer):
+        # no BoundingBox of its own inherits the parent`s
+        if 'BoundingBox' not in layer.seen and layer.parent is not None:
+            layer.bbox = layer.parent.bbox
+
+
+STREAMED_VERSIONS = {
+    '1.1.1': StreamedWebMapService_1_1_1,
+    '1.3.0': StreamedWebMapService_1_3_0
+}
+
+
+def web_map_service(wms_url, xml=None, version='1.3.0', timeout=30):
+    """
+    OWSLib WebMapService for wms_url. Where the GetCapabilities doc is at hand it is parsed by the streaming parser
+    (see _StreamedWebMapServiceMixin), falling back to OWSLib for docs the streaming parser does not handle
+
+    :param wms_url: WMS url
+    :param xml: GetCapabilities doc or None to have OWSLib request it
+    :param version: WMS version
+    :param timeout: HTTP timeout in seconds
+    :return: WebMapService object
+    """
+    streamed_wms = STREAMED_VERSIONS.get(version)
+    if xml is not None and streamed_wms is not None:
+        try:
+            return streamed_wms(wms_url, xml, version, timeout=timeout)
+        # TODO improve caught exception specifity
+        except Exception as ex:
+            logging.info('Streaming parse of GetCapabilities of WMS %s failed (%s), parsing with OWSLib', wms_url, ex)
+
+    return WebMapService(wms_url, version=version, xml=xml, timeout=timeout)
+
+
+def load_web_map_service(wms_url, version='1.3.0', timeout=30):
+    """
+    fetch the GetCapabilities doc of wms_url (as OWSLib would) and return its web_map_service()
+    """
+    caps_url = WMSCapabilitiesReader(version).capabilities_url(wms_url)
+    spliturl = caps_url.split('?')
+    xml = openURL(spliturl[0], spliturl[1], method='Get', timeout=timeout).read()
+    wms = web_map_service(wms_url, xml=xml, version=version, timeout=timeout)
+    wms.request = caps_url
+    return wms
@@ -3,13 +3,11 @@ from concurrent.futures import ThreadPoolExecutor
 import os
 import glob
 import shutil
-import uuid
+import time
 import xml
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 import Levenshtein as Lvn # https://rawgit.com/ztane/python-Levenshtein/master/docs/Levenshtein.html
 import owslib
-from owslib.csw import CatalogueServiceWeb
-from owslib.wms import WebMapService
 from pyproj import Transformer
 from PIL import Image
 import requests
@@ -18,9 +16,15 @@ import click
 from click_option_group import optgroup, RequiredMutuallyExclusiveOptionGroup
 
 import cataloger as ctlg
+from capabilities_cache import CapabilitiesCache
+from csw_client import HarvestCatalogueServiceWeb, pooled_session
+from csw_paging import iter_pages, PageCursor, PageSizeController
+from map_images import MapImageStore
+from output_writer import StreamingCsvWriter
+from wms_capabilities import load_web_map_service
 
 
-def validate_getmap_req(wms_url, wms_layer, aoi_bbox, srs, out_path, wms_timeout=30):
+def validate_getmap_req(wms_url, wms_layer, aoi_bbox, srs, out_path, wms_timeout=30, wms_cache=None, image_store=None):
     wms_get_cap_error = False
     wms_get_map_error = False
     made_get_map_req = False
@@ -28,7 +32,10 @@ def validate_getmap_req(wms_url, wms_layer, aoi_bbox, srs, out_path, wms_timeout
     image_status = None
 
     try:
-        wms = WebMapService(wms_url, timeout=wms_timeout)
+        if wms_cache is not None:
+            wms = wms_cache.get(wms_url)
+        else:
+            wms = load_web_map_service(wms_url, version='1.1.1', timeout=wms_timeout)
     # TODO improve caught exception specifity
     except Exception:
         logging.exception("Exception raised when instantiating WMS.")
@@ -50,16 +57,9 @@ def validate_getmap_req(wms_url, wms_layer, aoi_bbox, srs, out_path, wms_timeout
             wms_get_map_error = True
         else:
             logging.info('GetMap request made OK')
-            logging.info('Writing map to temp image')
-            out_image_fname = os.path.join(
-                out_path,
-                "".join([str(uuid.uuid1().int), "_wms_map.png"])
-            )
-            with open(out_image_fname, 'wb') as outpf:
-                outpf.write(img.read())
-
-            if os.path.exists(out_image_fname):
-                image_status = ctlg.check_wms_map_image(out_image_fname)
+            if image_store is None:
+                image_store = MapImageStore(out_path)
+            image_status, out_image_fname = image_store.check(img.read())
 
     return {
         'wms_get_cap_error': wms_get_cap_error,
@@ -70,7 +70,7 @@ def validate_getmap_req(wms_url, wms_layer, aoi_bbox, srs, out_path, wms_timeout
     }
 
 
-def retrieve_wms_layers(wms_url, csw_url, record_title, wms_timeout=30):
+def retrieve_wms_layers(wms_url, csw_url, record_title, wms_timeout=30, wms_cache=None):
     wms_layer_name = None
     wms_layer_title = None
     wms_layer_bbox = None
@@ -81,7 +81,10 @@ def retrieve_wms_layers(wms_url, csw_url, record_title, wms_timeout=30):
     logging.info('Retrieving WMS layers from: {}'.format(wms_url))
 
     try:
-        wms = WebMapService(wms_url, timeout=wms_timeout)
+        if wms_cache is not None:
+            wms = wms_cache.get(wms_url)
+        else:
+            wms = load_web_map_service(wms_url, version='1.1.1', timeout=wms_timeout)
     # TODO improve caught exception specifity
     except Exception:
         logging.exception("Exception raised when instantiating WMS.")
@@ -122,89 +125,97 @@ def retrieve_and_loop_through_csw_recordset(params):
     resultset_size = params[2]
     ogc_srv_type = params[3]
     out_path = params[4]
+    wms_cache = params[5]
+    csw = params[6]
+    page_cursor = params[7]
+    out_writer = params[8]
     all_wms_layers = []
 
+    # csw client (and its parsed GetCapabilities) is shared by all the paging jobs for the catalogue
+    page_started = time.time()
     try:
-        csw = CatalogueServiceWeb(csw_url)
+        csw = csw.getrecords_page(startposition=start_pos, maxrecords=resultset_size)
     # TODO improve caught exception specifity
     except Exception:
-        logging.exception("Exception raised when subsequentially instantiating CSW.")
+        logging.exception("Exception raised when retrieving subsequent set of records from CSW.")
+        page_cursor.page_failed(start_pos, resultset_size)
     else:
-        try:
-            csw.getrecords2(startposition=start_pos, maxrecords=resultset_size)
-        # TODO improve caught exception specifity
-        except Exception:
-            logging.exception("Exception raised when retrieving subsequent set of records from CSW.")
-        else:
-            for rec in csw.records:
-                r = None
-                r = csw.records[rec]
-
-                if r is not None:
-                    # fetch / clean-up title
-                    title = r.title
-                    if title is not None:
-                        title = title.replace("\n", "")
-
-                    # fetch / clean-up subjects
-                    # convert the list of subjects to a string. Sometimes the list has a None, so filter these off
-                    subjects = r.subjects
-                    if subjects is not None:
-                        subjects = ', '.join(list(filter(None, subjects)))
-
-                    # fetch / clean-up references
-                    references = r.references
-                    if references is not None:
-                        ogc_urls = []
-                        for ref in references:
-                            url = ref['url']
-                            ogc_url_type = None
-                            logging.info('Found URL {} in record references'.format(url))
-                            if url is not None:
-                                ogc_url_type = ctlg.get_ogc_type(url)
-                            if ogc_url_type is not None:
-                                if ogc_url_type == ogc_srv_type:
-                                    wms_url = url
-                                    wms_layers = None
-                                    logging.info('URL ogc_url_type is: {} SO searching for Matching WMS Layer'.format(ogc_url_type))
-
-                                    # TODO if we have already encountered a WMS before, here or in another thread, how
-                                    #  do we avoid hitting the WMS again?
-
+        page_cursor.page_done(
+            start_pos,
+            resultset_size,
+            returned=csw.results['returned'],
+            elapsed=time.time() - page_started,
+            nbytes=len(csw.response)
+        )
+        for rec in csw.records:
+            r = None
+            r = csw.records[rec]
+
+            if r is not None:
+                # fetch / clean-up title
+                title = r.title
+                if title is not None:
+                    title = title.replace("\n", "")
+
+                # fetch / clean-up subjects
+                # convert the list of subjects to a string. Sometimes the list has a None, so filter these off
+                subjects = r.subjects
+                if subjects is not None:
+                    subjects = ', '.join(list(filter(None, subjects)))
+
+                # fetch / clean-up references
+                references = r.references
+                if references is not None:
+                    ogc_urls = []
+                    for ref in references:
+                        url = ref['url']
+                        ogc_url_type = None
+                        logging.info('Found URL {} in record references'.format(url))
+                        if url is not None:
+                            ogc_url_type = ctlg.get_ogc_type(url)
+                        if ogc_url_type is not None:
+                            if ogc_url_type == ogc_srv_type:
+                                wms_url = url
+                                wms_layers = None
+                                logging.info('URL ogc_url_type is: {} SO searching for Matching WMS Layer'.format(ogc_url_type))
+
+                                # WMS already encountered here or in another thread are served from wms_cache
+                                # rather than being hit again
+
+                                if out_writer is not None:
+                                    out_writer.put([csw_url, title, wms_url, None, None, None, None, None])
+                                else:
                                     all_wms_layers.append([csw_url, title, wms_url, None, None, None, None, None])
 
-                                    # wms_layers = retrieve_wms_layers(wms_url, csw_url, record_title=title, wms_timeout=30)
-                                    # if wms_layers is not None:
-                                    #     if len(wms_layers) > 0:
-                                    #         all_wms_layers += wms_layers
+                                # wms_layers = retrieve_wms_layers(wms_url, csw_url, record_title=title, wms_timeout=30, wms_cache=wms_cache)
+                                # if wms_layers is not None:
+                                #     if len(wms_layers) > 0:
+                                #         all_wms_layers += wms_layers
 
-                                else:
-                                    logging.info('URL ogc_url_type is NONE-WMS OGC SERVICE: {} SO SKIPPING searching for record title'.format(ogc_url_type))
                             else:
-                                logging.info('URL ogc_url_type is None i.e. NOT AN OGC SERVICE SO SKIPPING')
+                                logging.info('URL ogc_url_type is NONE-WMS OGC SERVICE: {} SO SKIPPING searching for record title'.format(ogc_url_type))
+                        else:
+                            logging.info('URL ogc_url_type is None i.e. NOT AN OGC SERVICE SO SKIPPING')
 
     return all_wms_layers
 
 
-def search_csw_for_ogc_endpoints(out_path, csw_url, limit_count=0, ogc_srv_type='WMS:GetCapabilties', restrict_wms_layers_to_match=True):
+def search_csw_for_ogc_endpoints(out_path, csw_url, limit_count=0, ogc_srv_type='WMS:GetCapabilties', restrict_wms_layers_to_match=True, wms_cache=None, out_writer=None):
     limit_count = limit_count
-    all_retrieved_wms_layers_in_csw = []
+    if wms_cache is None:
+        wms_cache = CapabilitiesCache(loader=lambda url: load_web_map_service(url, version='1.1.1', timeout=30))
+    max_workers = 10
     try:
-        csw = CatalogueServiceWeb(csw_url)
+        csw = HarvestCatalogueServiceWeb(csw_url, session=pooled_session(max_workers), timeout=30)
     # TODO improve caught exception specifity
     except Exception:
         logging.exception("Exception raised when initially instantiating CSW.")
     else:
-        # MaxRecordDefault Constraint under OperationsMetadata indicates maximum number of
-        # records that can be returned per query. It may be obtained using:
-        # resultset_size = int(csw.constraints['MaxRecordDefault'].values[0])
-        # however it is not always available. By default OWSLib getrecords2() has maxrecords=10
-        # so just go with this.
-        resultset_size = 10
-        logging.info('NOT using MaxRecordDefault CSW Constraint. Using default of 10')
+        # page size starts from the MaxRecordDefault CSW Constraint where available and adapts from there
+        page_sizer = PageSizeController.for_csw(csw)
 
         try:
-            csw.getrecords2(startposition=0)
+            csw.getrecords2(resulttype='hits')
         # TODO improve caught exception specifity
         except Exception:
             logging.exception("Exception raised when retrieving initial records from CSW.")
@@ -217,29 +228,31 @@ def search_csw_for_ogc_endpoints(out_path, csw_url, limit_count=0, ogc_srv_type=
                 limited = True
                 if limit_count < num_records:
                     num_records = limit_count
-                if limit_count < resultset_size:
-                    resultset_size = limit_count
 
             logging.info('CSW Records to retrieve: %s', str(num_records))
 
-            # create job list
-            jobs = [[csw_url, start_pos, resultset_size, ogc_srv_type, out_path] for start_pos in range(0, num_records, resultset_size)]
+            page_cursor = PageCursor(num_records, page_sizer)
+
+            # rather than collecting every row for the CSW in memory and writing them at the end, workers hand rows
+            # to a single writer thread (so no 2 threads write to the file at once) as they go. The writer`s queue is
+            # bounded so workers wait for it if it falls behind
+            owns_writer = False
+            if out_writer is None:
+                out_writer = StreamingCsvWriter(os.path.join(out_path, 'just_wms_layers.csv'))
+                owns_writer = True
 
-            pool = ThreadPoolExecutor(max_workers=10)
+            def page_job(start_pos, resultset_size):
+                return retrieve_and_loop_through_csw_recordset([csw_url, start_pos, resultset_size, ogc_srv_type, out_path, wms_cache, csw, page_cursor, out_writer])
 
-            for job in pool.map(retrieve_and_loop_through_csw_recordset, jobs):
-                retrieved_wms_layers = job
-                if len(retrieved_wms_layers) > 0:
-                    all_retrieved_wms_layers_in_csw += retrieved_wms_layers
+            pool = ThreadPoolExecutor(max_workers=max_workers)
 
-            # write to CSV. I assume (OK, I don`t know/understand if we try to do this inside
-            # the above for loop we could create problems where 2 or more threads try to open/write to
-            # the same file?. Doing it this will way eat memory? (again I don`t really understand) though
-            if os.path.exists(os.path.join(out_path, 'just_wms_layers.csv')):
-                with open(os.path.join(out_path, 'just_wms_layers.csv'), 'a') as outpf:
-                    my_writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-                    for wms_layer in all_retrieved_wms_layers_in_csw:
-                        my_writer.writerow(wms_layer)
+            try:
+                for job in iter_pages(pool, page_cursor, page_job, max_in_flight=max_workers):
+                    pass
+            finally:
+                pool.shutdown()
+                if owns_writer:
+                    out_writer.close()
 
 
 def validate_outputs(out_path):
@@ -334,6 +347,9 @@ def wms_layer_finder(**params):
         my_writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
         my_writer.writerow(csv_header)
 
+    wms_cache = CapabilitiesCache(loader=lambda url: load_web_map_service(url, version='1.1.1', timeout=30))
+    out_writer = StreamingCsvWriter(os.path.join(out_path, 'just_wms_layers.csv'))
+
     # go through each CSW in turn and search for records that have associated OGC endpoints
     for csw_url in csw_list:
         print('Searching CSW: ', csw_url)
@@ -342,9 +358,13 @@ def wms_layer_finder(**params):
             out_path=out_path,
             csw_url=csw_url,
             limit_count=search_limit,
-            ogc_srv_type='WMS:GetCapabilties'
+            ogc_srv_type='WMS:GetCapabilties',
+            wms_cache=wms_cache,
+            out_writer=out_writer
         )
 
+    out_writer.close()
+    wms_cache.log_stats()
     logging.info('Done')
 
     validate_outputs(out_path)